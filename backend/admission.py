@@ -0,0 +1,128 @@
+# admission.py
+"""
+任务创建的准入控制和完成时间估算
+
+过载时在入口直接拒绝新任务（429 + Retry-After），而不是让任务在pending中无限堆积：
+- 调度器对应通道的排队数超过上限
+- 正在Suno生成中的任务数超过上游并发额度
+- Gemini或Suno熔断器处于打开状态（配置为暂缓任务时不拒绝，等待时间计入估算）
+
+完成时间按最近完成任务的阶段时间线估算：
+排队等待 ≈ 前面排队的任务数 / 通道并发数 × 单个任务占用处理线程的时间，
+之后再加上从开始处理到完成的典型耗时。
+"""
+import math
+import os
+from dataclasses import dataclass
+from typing import Iterable, Optional
+
+from task_timeline import load_events, percentile
+
+ADMISSION_MAX_QUEUED = int(os.getenv('ADMISSION_MAX_QUEUED', 50))  # 每个进程interactive通道的排队上限
+ADMISSION_MAX_BATCH_QUEUED = int(os.getenv('ADMISSION_MAX_BATCH_QUEUED', 1000))
+ADMISSION_MAX_SUNO_IN_FLIGHT = int(os.getenv('ADMISSION_MAX_SUNO_IN_FLIGHT', 100))  # 所有进程合计
+ESTIMATE_SAMPLE_SIZE = int(os.getenv('ESTIMATE_SAMPLE_SIZE', 200))
+
+# 没有历史样本时使用的默认耗时（秒）
+DEFAULT_PROCESSING_SECONDS = 40.0
+DEFAULT_COMPLETION_SECONDS = 180.0
+
+MIN_RETRY_AFTER = 1
+MAX_RETRY_AFTER = 600
+
+
+@dataclass
+class StageEstimates:
+    """最近完成任务的典型耗时（秒）"""
+    processing_seconds: float  # 开始处理到提交Suno（占用调度器线程的时间）
+    completion_seconds: float  # 开始处理到完成
+    suno_seconds: float  # 提交Suno到完成
+    samples: int
+
+
+@dataclass
+class Decision:
+    """准入结果；拒绝时reason和retry_after有值"""
+    admitted: bool
+    reason: Optional[str] = None
+    retry_after: Optional[int] = None
+    queue_position: int = 0
+    estimated_wait_seconds: float = 0.0
+    estimated_completion_seconds: float = 0.0
+
+
+def _offset(events, *stages) -> Optional[int]:
+    for stage in stages:
+        for name, offset_ms in events:
+            if name == stage:
+                return offset_ms
+    return None
+
+
+def estimate_from_timelines(timelines: Iterable[Optional[str]]) -> StageEstimates:
+    """从已完成任务的时间线计算各段耗时的中位数"""
+    processing, completion, suno = [], [], []
+    samples = 0
+    for timeline in timelines:
+        events = load_events(timeline)
+        # 早期任务没有dispatched阶段，用进入analyzing的时间代替
+        started = _offset(events, 'dispatched', 'analyzing')
+        submitted = _offset(events, 'suno_submitted')
+        completed = _offset(events, 'completed')
+        if started is None or completed is None:
+            continue
+        samples += 1
+        completion.append((completed - started) / 1000)
+        if submitted is not None:
+            processing.append((submitted - started) / 1000)
+            suno.append((completed - submitted) / 1000)
+
+    processing_seconds = percentile(processing, 50) or DEFAULT_PROCESSING_SECONDS
+    completion_seconds = percentile(completion, 50) or DEFAULT_COMPLETION_SECONDS
+    return StageEstimates(
+        processing_seconds=processing_seconds,
+        completion_seconds=completion_seconds,
+        suno_seconds=percentile(suno, 50) or max(0.0, completion_seconds - processing_seconds),
+        samples=samples
+    )
+
+
+def _clamp_retry(seconds: float) -> int:
+    return int(min(MAX_RETRY_AFTER, max(MIN_RETRY_AFTER, math.ceil(seconds))))
+
+
+def evaluate(estimates: StageEstimates, queued: int, running: int, lane_limit: int, max_queued: int,
+             suno_in_flight: int, incoming: int = 1, upstream_retry_in: float = 0.0,
+             park_upstream: bool = False) -> Decision:
+    """
+    判断是否接受incoming个新任务。
+    queued/running/lane_limit 是调度器对应通道的排队数、处理中任务数和并发上限；
+    upstream_retry_in > 0 表示有上游熔断器打开，park_upstream=True 时接受任务（任务会被暂缓到熔断器半开）。
+    """
+    slots = max(1, lane_limit)
+
+    if upstream_retry_in > 0 and not park_upstream:
+        return Decision(False, 'upstream_unavailable', _clamp_retry(upstream_retry_in))
+
+    if suno_in_flight + incoming > ADMISSION_MAX_SUNO_IN_FLIGHT:
+        # Suno任务大致均匀地完成，释放一个额度的时间约为 生成耗时 / 并发数
+        excess = suno_in_flight + incoming - ADMISSION_MAX_SUNO_IN_FLIGHT
+        per_slot = estimates.suno_seconds / max(1, ADMISSION_MAX_SUNO_IN_FLIGHT)
+        return Decision(False, 'suno_in_flight', _clamp_retry(excess * per_slot))
+
+    if queued + incoming > max_queued:
+        excess = queued + incoming - max_queued
+        return Decision(False, 'queue_full', _clamp_retry(excess / slots * estimates.processing_seconds))
+
+    # 空闲线程能接下的任务无需等待，其余按每轮slots个任务估算（估算的是最后一个新任务）
+    free = max(0, slots - running)
+    waiting = queued + incoming - free
+    wait = math.ceil(waiting / slots) * estimates.processing_seconds if waiting > 0 else 0.0
+    # 熔断期间接受的任务要等熔断器半开后才开始处理
+    wait += upstream_retry_in
+    return Decision(
+        True,
+        queue_position=queued + 1,
+        estimated_wait_seconds=round(wait, 1),
+        estimated_completion_seconds=round(wait + estimates.completion_seconds, 1)
+    )
@@ -1,16 +1,39 @@
 # app.py
 
 
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, send_file, redirect, g, Response, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import IntegrityError
 from flask_cors import CORS
 import uuid
 import os
-from datetime import datetime
+import hashlib
+import math
+from datetime import datetime, timedelta, timezone
 import json
 from music_agent import MusicGenerationAgent
+from response_cache import ResponseCache
+from audio_cache import AudioCache
+from task_cache import create_task_cache
+import image_variants
+import image_selection
+import prompt_builder
+from schema import upgrade_schema
+from compressed_text import CompressedText
+import geo_index
+import metrics
+import circuit_breaker
+from deadline import Deadline, DeadlineExceeded, stage_budget
+from scheduler import FairScheduler, INTERACTIVE, BATCH, process_identity, process_alive
+import admission
+import notify_bus
+from log_config import setup_logging, get_logger
+import task_timeline
 import threading
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional
 from werkzeug.utils import secure_filename
 import shutil
 import time
@@ -19,6 +42,9 @@ import requests
 app = Flask(__name__)
 CORS(app)
 
+setup_logging()
+logger = get_logger('app')
+
 # 数据库配置
 app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('DATABASE_URL', 'sqlite:///music_generation.db')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
@@ -31,9 +57,57 @@ MAX_CONTENT_LENGTH = 16 * 1024 * 1024  # 16MB per file
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = MAX_CONTENT_LENGTH
 
+# 图片尺寸变体缓存目录（位于上传目录下）
+VARIANT_FOLDER = os.path.join(UPLOAD_FOLDER, image_variants.VARIANT_FOLDER_NAME)
+IMAGE_CACHE_MAX_AGE = 365 * 24 * 3600  # 上传文件名唯一且不可变
+
 # 确保上传目录存在
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
+# LLM文本响应缓存配置（RESPONSE_CACHE_PATH 设为空字符串可关闭缓存）
+RESPONSE_CACHE_PATH = os.getenv('RESPONSE_CACHE_PATH', os.path.join('cache', 'llm_responses.sqlite3'))
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv('RESPONSE_CACHE_MAX_MB', 64)) * 1024 * 1024
+RESPONSE_CACHE_TTL = int(os.getenv('RESPONSE_CACHE_TTL_HOURS', 24 * 30)) * 3600
+
+# 本地音频缓存配置
+AUDIO_CACHE_DIR = os.getenv('AUDIO_CACHE_DIR', os.path.join('cache', 'audio'))
+AUDIO_CACHE_MAX_BYTES = int(os.getenv('AUDIO_CACHE_MAX_MB', 1024)) * 1024 * 1024
+AUDIO_CACHE_MAX_AGE = int(os.getenv('AUDIO_CACHE_MAX_AGE', 24 * 3600))  # 浏览器缓存时间（秒）
+# 由前置的nginx等通过X-Sendfile发送文件
+app.config['USE_X_SENDFILE'] = os.getenv('USE_X_SENDFILE', 'false').lower() == 'true'
+
+# 批量生成配置
+BATCH_MAX_TASKS = int(os.getenv('BATCH_MAX_TASKS', 200))
+
+# 统计接口缓存时间（秒）
+STATS_CACHE_SECONDS = int(os.getenv('STATS_CACHE_SECONDS', 5))
+# 任务导出每批从数据库读取的行数
+EXPORT_BATCH_SIZE = int(os.getenv('EXPORT_BATCH_SIZE', 1000))
+# 完成时间估算的缓存时间（秒）
+ESTIMATE_CACHE_SECONDS = int(os.getenv('ESTIMATE_CACHE_SECONDS', 30))
+# 任务状态长轮询的最长等待时间（秒），需小于gunicorn的超时时间
+TASK_STATUS_MAX_WAIT = float(os.getenv('TASK_STATUS_MAX_WAIT', 20))
+
+# 孤立文件清理配置
+RECONCILE_PAGE_SIZE = int(os.getenv('RECONCILE_PAGE_SIZE', 500))
+RECONCILE_GRACE_SECONDS = int(os.getenv('RECONCILE_GRACE_MINUTES', 60)) * 60  # 新上传的文件在此时间内不会被清理
+
+# 幂等键的有效期
+IDEMPOTENCY_TTL_SECONDS = int(os.getenv('IDEMPOTENCY_TTL_HOURS', 24)) * 3600
+IDEMPOTENCY_KEY_MAX_LENGTH = 200
+
+# 单个任务最多接受的图片数（实际发送给视觉模型的代表图片数见 MAX_ANALYSIS_IMAGES）
+MAX_TASK_IMAGES = int(os.getenv('MAX_TASK_IMAGES', 50))
+
+# 附近歌曲复用配置（米）
+REUSE_RADIUS_METERS = float(os.getenv('REUSE_RADIUS_METERS', 150))
+REUSE_MAX_RADIUS_METERS = float(os.getenv('REUSE_MAX_RADIUS_METERS', 5000))
+REUSE_CANDIDATE_LIMIT = 200
+
+# 上游熔断时对新任务的处理方式：fail 立即失败，park 暂缓并在熔断器半开后重试
+BREAKER_OPEN_ACTION = os.getenv('BREAKER_OPEN_ACTION', 'fail')
+BREAKER_MAX_PARKS = int(os.getenv('BREAKER_MAX_PARKS', 5))
+
 db = SQLAlchemy(app)
 
 # 数据库模型
@@ -45,16 +119,21 @@ class MusicTask(db.Model):
     image_paths = db.Column(db.Text, nullable=False)  # JSON格式存储图片路径列表
 
     # 任务状态
-    status = db.Column(db.String(50), default='pending')  # pending, analyzing, generating, completed, failed
+    # active_history保证状态变化时能拿到旧值，用于增量维护统计计数
+    status = db.column_property(
+        db.Column(db.String(50), default='pending'),  # pending, analyzing, generating, completed, failed
+        active_history=True
+    )
     progress = db.Column(db.Integer, default=0)  # 进度百分比 0-100
 
     # AI分析结果
     analysis_result = db.Column(db.Text, nullable=True)  # JSON格式
     music_description = db.Column(db.Text, nullable=True)
+    lyrics = db.deferred(db.Column(db.Text, nullable=True))  # 生成的歌词（按需加载）
 
     # Suno API相关
     suno_task_id = db.Column(db.String(100), nullable=True)
-    suno_response = db.Column(db.Text, nullable=True)  # JSON格式存储完整响应
+    suno_response = db.deferred(db.Column(CompressedText, nullable=True))  # JSON格式存储完整响应（压缩，按需加载）
 
     # 生成的音乐信息
     music_urls = db.Column(db.Text, nullable=True)  # JSON格式存储多个URL
@@ -63,13 +142,39 @@ class MusicTask(db.Model):
     music_duration = db.Column(db.Integer, nullable=True)  # 音乐时长（秒）
 
     # 时间戳
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     completed_at = db.Column(db.DateTime, nullable=True)
 
     # 错误信息
     error_message = db.Column(db.Text, nullable=True)
 
+    # 坐标及geohash空间索引（可选，用于复用附近已完成的歌曲）
+    latitude = db.Column(db.Float, nullable=True)
+    longitude = db.Column(db.Float, nullable=True)
+    geohash = db.Column(db.String(12), nullable=True)
+
+    # 所属批次（批量生成接口创建的任务）
+    batch_id = db.Column(db.String(36), nullable=True, index=True)
+
+    # 阶段时间线（紧凑JSON：[[阶段, 相对创建时间的毫秒数], ...]）
+    timeline = db.Column(db.Text, nullable=True)
+
+    # 代表图片选择时丢弃的近似重复或超出数量的图片数
+    dropped_images = db.Column(db.Integer, nullable=True)
+
+    # 排队处理该任务的进程（scheduler.process_identity），进程退出后由其他worker接管
+    scheduler_owner = db.Column(db.String(255), nullable=True)
+
+    __table_args__ = (
+        db.Index('ix_music_task_status_geohash', 'status', 'geohash'),
+        db.Index('ix_music_task_status_created_at', 'status', 'created_at'),
+    )
+
+    def mark_stage(self, stage):
+        """记录阶段时间（随下一次提交保存）"""
+        self.timeline = task_timeline.append_event(self.timeline, stage, self.created_at or datetime.utcnow())
+
     def to_dict(self, include_details=False):
         """转换为字典格式"""
         basic_info = {
@@ -78,6 +183,10 @@ class MusicTask(db.Model):
             'location': self.location,
             'status': self.status,
             'progress': self.progress,
+            'batch_id': self.batch_id,
+            'dropped_images': self.dropped_images,
+            'latitude': self.latitude,
+            'longitude': self.longitude,
             'created_at': self.created_at.isoformat(),
             'updated_at': self.updated_at.isoformat()
         }
@@ -94,6 +203,7 @@ class MusicTask(db.Model):
             if self.status == 'completed':
                 basic_info.update({
                     'music_url': self.selected_music_url,
+                    'audio_url': f'/api/audio/{self.id}',
                     'music_urls': json.loads(self.music_urls) if self.music_urls else [],
                     'sono_response':json.loads(self.suno_response) if self.suno_response else None,
                 })
@@ -116,17 +226,322 @@ class CallbackLog(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     task_id = db.Column(db.String(36), db.ForeignKey('music_task.id'), nullable=False)
     callback_type = db.Column(db.String(50), nullable=False)  # text, first, complete
-    callback_data = db.Column(db.Text, nullable=False)  # JSON格式
+    callback_data = db.deferred(db.Column(CompressedText, nullable=False))  # JSON格式（压缩）
     received_at = db.Column(db.DateTime, default=datetime.utcnow)
 
-# 创建数据库表
-with app.app_context():
-    db.create_all()
+class UploadedFile(db.Model):
+    """上传文件索引表"""
+    path = db.Column(db.String(500), primary_key=True)
+    size = db.Column(db.Integer, nullable=True)
+    uploaded_at = db.Column(db.DateTime, default=datetime.utcnow)
+    digest = db.Column(db.String(64), nullable=True)  # 文件内容的SHA-256
+
+class TaskRequestKey(db.Model):
+    """任务创建请求的去重键：'idem:' 开头的是客户端幂等键，'flight:' 开头的是相同输入的合并键"""
+    key = db.Column(db.String(300), primary_key=True)
+    task_id = db.Column(db.String(36), nullable=False, index=True)
+    request_hash = db.Column(db.String(64), nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class FileReference(db.Model):
+    """任务对上传文件的引用（孤立文件清理使用）"""
+    path = db.Column(db.String(500), primary_key=True)
+    task_id = db.Column(db.String(36), primary_key=True, index=True)
+
+class MaintenanceState(db.Model):
+    """维护任务的状态记录（断点续跑的检查点、水位线等）"""
+    key = db.Column(db.String(100), primary_key=True)
+    value = db.Column(db.Text, nullable=False)  # JSON格式
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
-# 初始化音乐生成代理
+    @classmethod
+    def load(cls, key, default=None):
+        """读取状态，不存在时返回默认值"""
+        state = cls.query.get(key)
+        if not state:
+            return default
+        try:
+            return json.loads(state.value)
+        except ValueError:
+            return default
+
+    @classmethod
+    def save(cls, key, value):
+        """写入状态（由调用方提交事务）"""
+        state = cls.query.get(key)
+        if not state:
+            state = cls(key=key)
+            db.session.add(state)
+        state.value = json.dumps(value)
+
+class PrewarmedAnalysis(db.Model):
+    """热门地点预先生成的分析结果、音乐描述和歌词（被一个真实任务使用后删除）"""
+    location_key = db.Column(db.String(200), primary_key=True)  # 规范化后的地点名
+    location = db.Column(db.String(200), nullable=False)
+    image_paths = db.Column(db.Text, nullable=False)  # JSON格式
+    images_fingerprint = db.Column(db.String(64), nullable=True)  # 生成时所用图片的内容指纹
+    analysis_result = db.Column(db.Text, nullable=False)  # JSON格式
+    music_description = db.Column(db.Text, nullable=False)
+    lyrics = db.Column(db.Text, nullable=False)
+    prompt_versions = db.Column(db.String(100), nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+
+class StatCounter(db.Model):
+    """增量维护的统计计数（各状态任务数、回调数）"""
+    name = db.Column(db.String(100), primary_key=True)
+    value = db.Column(db.Integer, nullable=False, default=0)
+
+TASK_STATUSES = ['pending', 'analyzing', 'generating', 'completed', 'failed']
+CALLBACK_COUNTER = 'callbacks'
+
+def task_counter_name(status):
+    """任务状态对应的计数名"""
+    return f'tasks:{status}'
+
+_UPSERT_DIALECTS = {'sqlite': sqlite_insert, 'postgresql': postgresql_insert}
+
+def apply_counter_deltas(connection, deltas):
+    """
+    在当前事务中累加计数，计数行不存在时插入。
+    SQLite和PostgreSQL用 INSERT ... ON CONFLICT DO UPDATE 原子地完成，并发事务首次写同一计数不会主键冲突；
+    按计数名顺序更新，多行更新的事务总以相同顺序加锁，不会互相死锁。
+    """
+    table = StatCounter.__table__
+    upsert = _UPSERT_DIALECTS.get(connection.dialect.name)
+    for name in sorted(deltas):
+        delta = deltas[name]
+        if not delta:
+            continue
+        if upsert is not None:
+            statement = upsert(table).values(name=name, value=delta)
+            connection.execute(statement.on_conflict_do_update(
+                index_elements=[table.c.name], set_={'value': table.c.value + delta}
+            ))
+            continue
+        result = connection.execute(
+            table.update().where(table.c.name == name).values(value=table.c.value + delta)
+        )
+        if result.rowcount == 0:
+            connection.execute(table.insert().values(name=name, value=delta))
+
+@event.listens_for(db.session, 'before_flush')
+def _mark_final_stages(session, flush_context, instances):
+    """任务进入完成或失败状态时自动记录时间线"""
+    for obj in session.dirty:
+        if isinstance(obj, MusicTask) and obj.status in ('completed', 'failed'):
+            history = db.inspect(obj).attrs.status.history
+            if history.added:
+                obj.mark_stage(obj.status)
+
+@event.listens_for(db.session, 'after_flush')
+def _track_counter_changes(session, flush_context):
+    """ORM写入时根据任务状态变化增量更新计数"""
+    deltas = {}
+
+    def bump(name, delta):
+        deltas[name] = deltas.get(name, 0) + delta
+
+    for obj in session.new:
+        if isinstance(obj, MusicTask):
+            bump(task_counter_name(obj.status), 1)
+        elif isinstance(obj, CallbackLog):
+            bump(CALLBACK_COUNTER, 1)
+
+    for obj in session.deleted:
+        if isinstance(obj, MusicTask):
+            history = db.inspect(obj).attrs.status.history
+            old_status = history.deleted[0] if history.deleted else obj.status
+            bump(task_counter_name(old_status), -1)
+        elif isinstance(obj, CallbackLog):
+            bump(CALLBACK_COUNTER, -1)
+
+    for obj in session.dirty:
+        if isinstance(obj, MusicTask) and obj not in session.deleted:
+            history = db.inspect(obj).attrs.status.history
+            if history.deleted and history.added and history.deleted[0] != history.added[0]:
+                bump(task_counter_name(history.deleted[0]), -1)
+                bump(task_counter_name(history.added[0]), 1)
+
+    if any(deltas.values()):
+        apply_counter_deltas(session.connection(), deltas)
+
+def rebuild_stat_counters():
+    """根据实际数据重建统计计数"""
+    with app.app_context():
+        counts = {task_counter_name(status): 0 for status in TASK_STATUSES}
+        for status, count in db.session.query(MusicTask.status, db.func.count(MusicTask.id)).group_by(MusicTask.status):
+            counts[task_counter_name(status)] = count
+        counts[CALLBACK_COUNTER] = db.session.query(db.func.count(CallbackLog.id)).scalar()
+
+        db.session.execute(db.delete(StatCounter))
+        db.session.add_all([StatCounter(name=name, value=value) for name, value in counts.items()])
+        db.session.commit()
+        return counts
+
+def compute_task_stats():
+    """用一次分组查询计算各状态任务数和最近24小时任务数"""
+    last_24h = datetime.utcnow() - timedelta(hours=24)
+    rows = db.session.query(
+        MusicTask.status,
+        db.func.count(MusicTask.id),
+        db.func.sum(db.case((MusicTask.created_at >= last_24h, 1), else_=0))
+    ).group_by(MusicTask.status).all()
+
+    stats = {f'{status}_tasks': 0 for status in TASK_STATUSES}
+    total = 0
+    recent = 0
+    for status, count, recent_count in rows:
+        stats[f'{status}_tasks'] = count
+        total += count
+        recent += int(recent_count or 0)
+
+    stats['total_tasks'] = total
+    stats['tasks_last_24h'] = recent
+    stats['total_callbacks'] = db.session.query(db.func.count(CallbackLog.id)).scalar()
+    return stats
+
+def read_counter_stats():
+    """从计数表读取统计信息（O(1)）"""
+    counters = dict(db.session.query(StatCounter.name, StatCounter.value).all())
+    stats = {}
+    total = 0
+    for name, value in counters.items():
+        if name.startswith('tasks:'):
+            stats[f"{name.split(':', 1)[1]}_tasks"] = value
+            total += value
+    for status in TASK_STATUSES:
+        stats.setdefault(f'{status}_tasks', 0)
+    stats['total_tasks'] = total
+    stats['total_callbacks'] = counters.get(CALLBACK_COUNTER, 0)
+    return stats
+
+@event.listens_for(db.session, 'before_commit')
+def _start_commit_timer(session):
+    session.info['commit_started_at'] = time.perf_counter()
+
+@event.listens_for(db.session, 'after_commit')
+def _observe_commit_latency(session):
+    started_at = session.info.pop('commit_started_at', None)
+    if started_at is not None:
+        metrics.DB_COMMIT_SECONDS.observe(time.perf_counter() - started_at)
+
+@event.listens_for(db.session, 'after_rollback')
+def _discard_commit_timer(session):
+    session.info.pop('commit_started_at', None)
+
+def _notify_connection():
+    """通知监听使用的独立数据库连接（从连接池中分离）"""
+    with app.app_context():
+        connection = db.engine.raw_connection()
+    connection.detach()
+    return connection.driver_connection
+
+# 任务变更通知（状态或进度变化时通知所有worker）
+notification_bus = notify_bus.create_bus(app.config['SQLALCHEMY_DATABASE_URI'], connect=_notify_connection)
+
+@event.listens_for(db.session, 'after_flush')
+def _collect_task_events(session, flush_context):
+    """收集任务的新建、状态/进度变化和删除；PostgreSQL随事务发布，其他数据库提交后发布"""
+    pid = os.getpid()
+    events = []
+    for obj in session.new:
+        if isinstance(obj, MusicTask):
+            events.append(notify_bus.TaskEvent(obj.id, obj.status, obj.progress, pid=pid))
+    for obj in session.dirty:
+        if isinstance(obj, MusicTask) and obj not in session.deleted:
+            state = db.inspect(obj)
+            status_changed = state.attrs.status.history.has_changes()
+            if status_changed or state.attrs.progress.history.has_changes():
+                events.append(notify_bus.TaskEvent(obj.id, obj.status, obj.progress,
+                                                   status_changed=status_changed, pid=pid))
+    for obj in session.deleted:
+        if isinstance(obj, MusicTask):
+            events.append(notify_bus.TaskEvent(obj.id, None, None, deleted=True, pid=pid))
+    if not events:
+        return
+
+    if notification_bus.transactional:
+        notification_bus.publish(events, session.connection())
+    else:
+        pending = session.info.setdefault('task_events', {})
+        for task_event in events:
+            previous = pending.get(task_event.task_id)
+            task_event.status_changed = task_event.status_changed or bool(previous and previous.status_changed)
+            pending[task_event.task_id] = task_event
+
+@event.listens_for(db.session, 'after_commit')
+def _publish_task_events(session):
+    events = session.info.pop('task_events', None)
+    if events:
+        notification_bus.publish(list(events.values()))
+
+@event.listens_for(db.session, 'after_rollback')
+def _discard_task_events(session):
+    session.info.pop('task_events', None)
+
+@app.before_request
+def _start_request_timer():
+    g.request_started_at = time.perf_counter()
+    notification_bus.ensure_started()
+
+@app.after_request
+def _observe_request_latency(response):
+    started_at = getattr(g, 'request_started_at', None)
+    if started_at is not None:
+        metrics.HTTP_REQUEST_SECONDS.labels(
+            method=request.method,
+            endpoint=request.endpoint or 'unknown',
+            status=response.status_code
+        ).observe(time.perf_counter() - started_at)
+    return response
+
+def prepare_database() -> List[str]:
+    """
+    创建数据库表、为旧表补充新增的列和索引，计数表为空时（首次部署或新建数据库）根据实际数据初始化，
+    返回执行的结构变更。导入模块时不执行，由 setup_database.py（gunicorn主进程启动时调用 upgrade）
+    或开发服务器执行一次；完成后关闭连接池，之后fork出的进程不会继承数据库连接。
+    """
+    with app.app_context():
+        db.create_all()
+        changes = upgrade_schema(db)
+        if not StatCounter.query.first():
+            rebuild_stat_counters()
+        db.engine.dispose()
+        return changes
+
+def init_worker():
+    """
+    在每个gunicorn worker中调用（post_fork）：预加载时重新启动日志线程，
+    丢弃从主进程继承的连接池（不关闭连接，它们仍属于主进程），
+    启动线程数指标的刷新线程，并接管已退出的worker留下的pending任务
+    """
+    setup_logging()
+    metrics.start_thread_gauge_updater()
+    with app.app_context():
+        db.engine.dispose(close=False)
+    recover_orphaned_tasks()
+
+# 初始化文本响应缓存
+response_cache = None
+if RESPONSE_CACHE_PATH:
+    response_cache = ResponseCache(
+        RESPONSE_CACHE_PATH,
+        max_bytes=RESPONSE_CACHE_MAX_BYTES,
+        ttl_seconds=RESPONSE_CACHE_TTL
+    )
+
+# 初始化本地音频缓存
+audio_cache = AudioCache(AUDIO_CACHE_DIR, max_bytes=AUDIO_CACHE_MAX_BYTES)
+
+# 任务状态和任务列表的缓存（配置REDIS_URL时多个worker共享）
+task_cache = create_task_cache()
+
+# 初始化音乐生成代理（Gemini客户端在第一次调用时才创建）
 agent = MusicGenerationAgent(
     gemini_api_key=os.getenv('GEMINI_API_KEY'),
-    suno_api_key=os.getenv('SUNO_API_KEY')
+    suno_api_key=os.getenv('SUNO_API_KEY'),
+    response_cache=response_cache
 )
 
 def allowed_file(filename):
@@ -141,6 +556,159 @@ def generate_unique_filename(original_filename):
     unique_name = f"{name}_{uuid.uuid4().hex[:8]}{ext}"
     return unique_name
 
+def build_music_task(location, image_paths, user_id=None, coordinates=None, batch_id=None):
+    """构造待处理的任务记录（不提交）"""
+    task = MusicTask(
+        id=str(uuid.uuid4()),
+        created_at=datetime.utcnow(),
+        user_id=user_id,
+        location=location,
+        image_paths=json.dumps(image_paths),
+        status='pending',
+        progress=0,
+        batch_id=batch_id,
+        scheduler_owner=process_identity()
+    )
+    if coordinates:
+        task.latitude, task.longitude = coordinates
+        task.geohash = geo_index.encode(*coordinates)
+    task.mark_stage('queued')
+    return task
+
+def file_references_for(task, image_paths):
+    """构造任务对上传文件的引用记录"""
+    return [FileReference(path=path, task_id=task.id) for path in sorted(set(image_paths))]
+
+def remove_file_references(task_ids, removed_paths=()):
+    """删除任务的文件引用，以及已删除文件的索引记录（由调用方提交事务）"""
+    if task_ids:
+        db.session.execute(db.delete(FileReference).where(FileReference.task_id.in_(task_ids)))
+    if removed_paths:
+        db.session.execute(db.delete(UploadedFile).where(UploadedFile.path.in_(list(removed_paths))))
+
+def unreferenced_paths(paths) -> List[str]:
+    """没有任何任务引用的文件路径（在删除本次任务的引用之后调用）"""
+    paths = sorted(set(paths))
+    referenced = set()
+    for start in range(0, len(paths), 500):
+        chunk = paths[start:start + 500]
+        referenced.update(db.session.execute(
+            db.select(FileReference.path).where(FileReference.path.in_(chunk)).distinct()
+        ).scalars())
+    return [path for path in paths if path not in referenced]
+
+def remove_request_keys(task_ids):
+    """删除指向这些任务的请求去重键（由调用方提交事务）"""
+    if task_ids:
+        db.session.execute(db.delete(TaskRequestKey).where(TaskRequestKey.task_id.in_(task_ids)))
+
+def hash_request(payload) -> str:
+    """请求内容的规范化哈希"""
+    canonical = json.dumps(payload, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+def file_digest(path) -> str:
+    """文件内容的SHA-256"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(64 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def image_digests(image_paths) -> List[str]:
+    """图片内容摘要（去重并排序，优先使用上传时记录的摘要）"""
+    known = dict(db.session.execute(
+        db.select(UploadedFile.path, UploadedFile.digest)
+        .where(UploadedFile.path.in_(image_paths), UploadedFile.digest.isnot(None))
+    ).all())
+    return sorted({known.get(path) or file_digest(path) for path in image_paths})
+
+def images_fingerprint(image_paths) -> str:
+    """一组图片内容的指纹，与图片顺序和路径无关"""
+    return hash_request(image_digests(image_paths))
+
+def coalescing_key(user_id, location, image_paths) -> str:
+    """同一用户相同地点和相同图片内容的请求共用一个合并键"""
+    return 'flight:' + hash_request({
+        'user_id': user_id,
+        'location': ' '.join(location.lower().split()),
+        'images': image_digests(image_paths)
+    })
+
+def request_key_holder(key):
+    """返回 (键记录, 仍然有效的持有任务)；幂等键在有效期内有效，合并键在任务处理中时有效"""
+    row = db.session.get(TaskRequestKey, key)
+    if row is None:
+        return None, None
+    task = db.session.get(MusicTask, row.task_id)
+    if key.startswith('idem:'):
+        valid = task is not None and (datetime.utcnow() - row.created_at).total_seconds() < IDEMPOTENCY_TTL_SECONDS
+    else:
+        valid = task is not None and task.status in ('pending', 'analyzing', 'generating')
+    return row, task if valid else None
+
+class RequestKeyConflict(Exception):
+    """并发请求抢先接管了同一个请求键"""
+
+
+def claim_request_key(key, task_id, request_hash):
+    """
+    在当前事务中为任务占用请求键。键已被有效任务持有时返回该任务；
+    并发请求抢先占用时抛出IntegrityError（插入冲突）或RequestKeyConflict（接管失败），
+    由调用方回滚后重试。
+    """
+    row, holder = request_key_holder(key)
+    if holder:
+        return holder
+    if row is None:
+        db.session.add(TaskRequestKey(key=key, task_id=task_id, request_hash=request_hash))
+        db.session.flush()
+        return None
+
+    # 原任务已失效：比较并交换，避免多个请求同时接管同一个键
+    result = db.session.execute(
+        db.update(TaskRequestKey)
+        .where(TaskRequestKey.key == key, TaskRequestKey.task_id == row.task_id)
+        .values(task_id=task_id, request_hash=request_hash, created_at=datetime.utcnow())
+    )
+    if result.rowcount == 0:
+        raise RequestKeyConflict(key)
+    return None
+
+def remove_image_file(path):
+    """删除上传的图片及其缓存的尺寸变体"""
+    image_variants.remove_variants(VARIANT_FOLDER, os.path.basename(path))
+    if os.path.exists(path):
+        os.remove(path)
+        return True
+    return False
+
+def find_nearby_completed_task(latitude: float, longitude: float, radius_meters: float):
+    """在geohash索引上查找半径范围内最近的已完成任务，返回 (task, 距离米)"""
+    cell_filters = []
+    for prefix in geo_index.cover_cells(latitude, longitude, radius_meters):
+        low, high = geo_index.prefix_range(prefix)
+        if high is None:
+            cell_filters.append(MusicTask.geohash >= low)
+        else:
+            cell_filters.append(db.and_(MusicTask.geohash >= low, MusicTask.geohash < high))
+
+    candidates = MusicTask.query.filter(
+        MusicTask.status == 'completed',
+        MusicTask.selected_music_url.isnot(None),
+        db.or_(*cell_filters)
+    ).order_by(MusicTask.completed_at.desc()).limit(REUSE_CANDIDATE_LIMIT).all()
+
+    best_task = None
+    best_distance = None
+    for candidate in candidates:
+        distance = geo_index.haversine_meters(latitude, longitude, candidate.latitude, candidate.longitude)
+        if distance <= radius_meters and (best_distance is None or distance < best_distance):
+            best_task = candidate
+            best_distance = distance
+
+    return best_task, best_distance
+
 def update_task_progress(task_id, progress, status=None):
     """更新任务进度"""
     try:
@@ -152,49 +720,63 @@ def update_task_progress(task_id, progress, status=None):
                     task.status = status
                 db.session.commit()
     except Exception as e:
-        print(f"Error updating task progress: {e}")
+        logger.error("Error updating task progress: %s", e, extra={'task_id': task_id})
 
-def poll_suno_task_status(task_id: str, suno_task_id: str):
-    """轮询Suno任务状态"""
+@metrics.POLLING_TASKS.track_inprogress()
+def poll_suno_task_status(task_id: str, suno_task_id: str, deadline: Optional[Deadline] = None):
+    """轮询Suno任务状态（同时受最大轮询次数和任务截止时间限制）"""
     max_attempts = 30  # 最多轮询30次（10分钟）
     attempt = 0
+    last_status = None
     
-    while attempt < max_attempts:
+    while attempt < max_attempts and not (deadline and deadline.expired()):
         try:
             with app.app_context():
                 task = MusicTask.query.get(task_id)
                 if not task or task.status in ['completed', 'failed']:
                     break
+
+                # 先计算超时（截止时间已到时在占用探测名额之前退出），
+                # Suno熔断期间暂停轮询，不消耗轮询次数，并释放数据库连接
+                poll_timeout = stage_budget(deadline, 'suno_poll')
+                if not agent.suno_breaker.allow():
+                    db.session.close()
+                    time.sleep(min(max(agent.suno_breaker.retry_in(), 1), 20))
+                    continue
                 
                 # 调用获取音乐生成详情API
+                poll_started = time.monotonic()
                 try:
-                    response = requests.get(
-                        f"https://apibox.erweima.ai/api/v1/generate/record-info",
-                        params={'taskId': suno_task_id},
-                        headers={
-                            'Authorization': f'Bearer {os.getenv("SUNO_API_KEY")}',
-                            'Content-Type': 'application/json'
-                        },
-                        timeout=30  # 设置请求超时
-                    )
+                    with metrics.stage_timer('suno_poll'):
+                        response = requests.get(
+                            f"https://apibox.erweima.ai/api/v1/generate/record-info",
+                            params={'taskId': suno_task_id},
+                            headers={
+                                'Authorization': f'Bearer {os.getenv("SUNO_API_KEY")}',
+                                'Content-Type': 'application/json'
+                            },
+                            timeout=poll_timeout  # 设置请求超时
+                        )
                 except requests.exceptions.RequestException as e:
-                    print(f"Request error polling task {task_id}: {e}")
+                    agent.suno_breaker.record(False, time.monotonic() - poll_started)
+                    logger.warning("Request error polling Suno task: %s", e, extra={'task_id': task_id})
                     attempt += 1
                     time.sleep(20)
                     continue
+                agent.suno_breaker.record(response.status_code < 500, time.monotonic() - poll_started)
                 
                 if response.status_code == 200:
                     try:
                         result = response.json()
-                        print(f"sono_task_status_response {result}")  # 调试输出
+                        logger.debug("Suno task status response", extra={'task_id': task_id, 'response': result, 'sample_key': task_id})
                     except json.JSONDecodeError as e:
-                        print(f"JSON decode error for task {task_id}: {e}, response: {response.text}")
+                        logger.warning("JSON decode error polling Suno task: %s", e, extra={'task_id': task_id, 'response': response.text})
                         attempt += 1
                         time.sleep(20)
                         continue
                     
                     if not result:
-                        print(f"Empty response for task {task_id}")
+                        logger.warning("Empty Suno poll response", extra={'task_id': task_id})
                         attempt += 1
                         time.sleep(20)
                         continue
@@ -202,7 +784,7 @@ def poll_suno_task_status(task_id: str, suno_task_id: str):
                     if result.get('code') == 200:
                         data = result.get('data')
                         if not data:
-                            print(f"No data in response for task {task_id}")
+                            logger.warning("No data in Suno poll response", extra={'task_id': task_id})
                             attempt += 1
                             time.sleep(20)
                             continue
@@ -211,7 +793,14 @@ def poll_suno_task_status(task_id: str, suno_task_id: str):
                         status = data.get('status', 'PENDING')
                         response_data = data.get('response', {})
                         
-                        print(f"Polling attempt {attempt + 1}, task: {task_id}, suno_task: {suno_task_id}, status: {status}")
+                        poll_fields = {'task_id': task_id, 'suno_task_id': suno_task_id, 'attempt': attempt + 1, 'status': status}
+                        if status != last_status:
+                            logger.info("Suno task status changed", extra=poll_fields)
+                            last_status = status
+                        else:
+                            # 重复的轮询结果按比例采样输出
+                            logger.info("Suno task status unchanged", extra=dict(poll_fields, sample_key=task_id))
+                        task.mark_stage(f'suno_{status}')
                         
                         # 更新任务状态和进度
                         if status == 'PENDING':
@@ -222,6 +811,7 @@ def poll_suno_task_status(task_id: str, suno_task_id: str):
                             task.progress = 90
                         elif status == 'SUCCESS':
                             # 任务完成，提取音乐信息
+                            audio_url = None
                             suno_data = response_data.get('sunoData', [])
                             if suno_data:
                                 # 提取所有音频URL - 使用 sourceAudioUrl
@@ -250,25 +840,36 @@ def poll_suno_task_status(task_id: str, suno_task_id: str):
                                     task.status = 'completed'
                                     task.progress = 100
                                     task.completed_at = datetime.utcnow()
+                                    metrics.TASK_TIME_TO_SUCCESS_SECONDS.observe(
+                                        (task.completed_at - task.created_at).total_seconds()
+                                    )
                                     
                                     # 保存完整的Suno响应
                                     task.suno_response = json.dumps(data)
                                     
-                                    print(f"Task {task_id} completed successfully with {len(music_urls)} tracks")
-                                    print(f"Selected music URL: {task.selected_music_url}")
-                                    print(f"All music URLs: {music_urls}")
+                                    audio_url = task.selected_music_url
+
+                                    logger.info("Task completed", extra={
+                                        'task_id': task_id,
+                                        'tracks': len(music_urls),
+                                        'music_url': task.selected_music_url,
+                                        'music_urls': music_urls
+                                    })
                                 else:
                                     task.status = 'failed'
                                     task.error_message = 'No valid audio URLs received'
                                     task.progress = 0
-                                    print(f"Task {task_id} failed: no valid audio URLs")
+                                    logger.warning("Task failed: no valid audio URLs", extra={'task_id': task_id})
                             else:
                                 task.status = 'failed'
                                 task.error_message = 'No audio clips received'
                                 task.progress = 0
-                                print(f"Task {task_id} failed: no audio clips")
+                                logger.warning("Task failed: no audio clips", extra={'task_id': task_id})
                             
                             db.session.commit()
+                            # 提交成功后才在后台下载音频到本地缓存
+                            if audio_url:
+                                audio_cache.enqueue(task_id, audio_url)
                             break
                             
                         elif status in ['CREATE_TASK_FAILED', 'GENERATE_AUDIO_FAILED', 'CALLBACK_EXCEPTION', 'SENSITIVE_WORD_ERROR']:
@@ -282,7 +883,7 @@ def poll_suno_task_status(task_id: str, suno_task_id: str):
                             task.error_message = error_message
                             task.progress = 0
                             db.session.commit()
-                            print(f"Task {task_id} failed: {error_message}")
+                            logger.warning("Task failed: %s", error_message, extra={'task_id': task_id, 'status': status})
                             break
                         
                         # 保存进度更新
@@ -291,7 +892,7 @@ def poll_suno_task_status(task_id: str, suno_task_id: str):
                     else:
                         # API返回错误
                         error_msg = result.get('msg', 'Unknown API error')
-                        print(f"API error for task {task_id}: {error_msg}")
+                        logger.warning("Suno API error while polling: %s", error_msg, extra={'task_id': task_id, 'code': result.get('code')})
                         
                         # 如果是认证错误或其他严重错误，直接失败
                         if result.get('code') in [401, 403, 404]:
@@ -302,7 +903,7 @@ def poll_suno_task_status(task_id: str, suno_task_id: str):
                             break
                             
                 else:
-                    print(f"HTTP error polling task {task_id}: {response.status_code}, response: {response.text}")
+                    logger.warning("HTTP error polling Suno task", extra={'task_id': task_id, 'status_code': response.status_code, 'response': response.text})
                     
                     # 如果是认证错误，直接失败
                     if response.status_code in [401, 403]:
@@ -316,93 +917,247 @@ def poll_suno_task_status(task_id: str, suno_task_id: str):
                 time.sleep(20)
                 attempt += 1
                 
-        except Exception as e:
-            print(f"Error polling task status for {task_id}: {e}")
-            import traceback
-            traceback.print_exc()
+        except DeadlineExceeded:
+            break
+        except Exception:
+            logger.exception("Error polling task status", extra={'task_id': task_id})
             attempt += 1
             time.sleep(20)
     
-    # 如果超过最大尝试次数，标记任务为失败
-    if attempt >= max_attempts:
+    # 如果超过最大尝试次数或任务截止时间，标记任务为失败
+    deadline_exceeded = bool(deadline and deadline.expired())
+    if attempt >= max_attempts or deadline_exceeded:
         try:
             with app.app_context():
                 task = MusicTask.query.get(task_id)
                 if task and task.status not in ['completed', 'failed']:
                     task.status = 'failed'
-                    task.error_message = f'Polling timeout: task took too long to complete after {max_attempts} attempts'
+                    if deadline_exceeded:
+                        task.error_message = f'Deadline exceeded: task did not complete within {deadline.seconds:.0f}s'
+                        metrics.DEADLINE_EXCEEDED.labels(stage='suno_poll').inc()
+                    else:
+                        task.error_message = f'Polling timeout: task took too long to complete after {max_attempts} attempts'
                     task.progress = 0
                     db.session.commit()
-                    print(f"Task {task_id} failed due to timeout after {max_attempts} attempts")
+                    logger.warning("Task failed due to polling timeout", extra={
+                        'task_id': task_id, 'attempts': attempt, 'deadline_exceeded': deadline_exceeded
+                    })
         except Exception as e:
-            print(f"Error updating task after timeout: {e}")
-
-def process_music_generation_async(task_id: str):
+            logger.error("Error updating task after timeout: %s", e, extra={'task_id': task_id})
+
+def unavailable_upstreams() -> List[str]:
+    """熔断器处于打开状态的上游服务"""
+    return [breaker.name for breaker in (agent.gemini_breaker, agent.suno_breaker) if breaker.is_open()]
+
+def location_key(location: str) -> str:
+    """规范化地点名（大小写和空白不影响匹配）"""
+    return ' '.join(location.lower().split())[:200]
+
+def prewarm_prompt_versions() -> str:
+    """预热结果对应的提示词版本，模板变化后旧的预热结果不再使用"""
+    return '/'.join((prompt_builder.ANALYSIS_PROMPT_VERSION, prompt_builder.DESCRIPTION_PROMPT_VERSION,
+                     prompt_builder.LYRICS_PROMPT_VERSION))
+
+def take_prewarmed_analysis(location: str, image_paths: List[str]):
+    """
+    取出并删除地点的预热结果，返回 (分析结果, 音乐描述, 歌词)，没有可用结果时返回None。
+    预热结果只在任务图片与生成时所用图片内容相同时使用，否则分析的不是用户自己的图片。
+    删除语句带上创建时间条件，并发任务中只有一个能拿到同一条预热结果。
+    """
+    key = location_key(location)
+    prewarmed = db.session.get(PrewarmedAnalysis, key)
+    if (not prewarmed or prewarmed.expires_at <= datetime.utcnow()
+            or prewarmed.prompt_versions != prewarm_prompt_versions()
+            or not prewarmed.images_fingerprint):
+        metrics.PREWARM_LOOKUPS.labels(result='miss').inc()
+        return None
+    try:
+        fingerprint = images_fingerprint(image_paths)
+    except OSError:
+        fingerprint = None
+    if fingerprint != prewarmed.images_fingerprint:
+        metrics.PREWARM_LOOKUPS.labels(result='miss').inc()
+        return None
+    claimed = db.session.execute(
+        db.delete(PrewarmedAnalysis).where(
+            PrewarmedAnalysis.location_key == key,
+            PrewarmedAnalysis.created_at == prewarmed.created_at
+        )
+    ).rowcount
+    db.session.commit()
+    if not claimed:
+        metrics.PREWARM_LOOKUPS.labels(result='miss').inc()
+        return None
+    metrics.PREWARM_LOOKUPS.labels(result='hit').inc()
+    return json.loads(prewarmed.analysis_result), prewarmed.music_description, prewarmed.lyrics
+
+def task_lane(task) -> str:
+    """批量任务走batch通道，其余为实时请求"""
+    return BATCH if task.batch_id else INTERACTIVE
+
+def schedule_task(task_id: str, user_id: Optional[str] = None, lane: str = INTERACTIVE, parks: int = 0):
+    """把任务交给调度器排队处理"""
+    task_scheduler.submit(task_id, parks, user_id=user_id, lane=lane)
+
+def recover_orphaned_tasks() -> int:
+    """
+    重新排队所属进程已退出的pending任务（进程内的调度队列和暂缓计时器随worker重启丢失）。
+    接管用比较并交换完成，多个worker同时启动时每个任务只会被一个worker接管；
+    其他主机上的进程无法判断存活，不会被接管。返回接管的任务数。
+    """
+    owner = process_identity()
+    recovered = 0
+    with app.app_context():
+        rows = db.session.execute(
+            db.select(MusicTask.id, MusicTask.user_id, MusicTask.batch_id, MusicTask.scheduler_owner)
+            .where(MusicTask.status == 'pending')
+            .order_by(MusicTask.created_at)
+        ).all()
+        for row in rows:
+            if row.scheduler_owner == owner:
+                continue
+            if row.scheduler_owner is not None and process_alive(row.scheduler_owner) is not False:
+                continue
+            previous = (MusicTask.scheduler_owner.is_(None) if row.scheduler_owner is None
+                        else MusicTask.scheduler_owner == row.scheduler_owner)
+            claimed = db.session.execute(
+                db.update(MusicTask)
+                .where(MusicTask.id == row.id, MusicTask.status == 'pending', previous)
+                .values(scheduler_owner=owner)
+            ).rowcount
+            db.session.commit()
+            if claimed:
+                schedule_task(row.id, row.user_id, task_lane(row))
+                recovered += 1
+    if recovered:
+        logger.info("Recovered orphaned pending tasks", extra={'tasks': recovered})
+    return recovered
+
+def park_task(task, parks: int, delay: float):
+    """上游熔断期间暂缓任务，熔断器进入半开状态后重新排队"""
+    timer = threading.Timer(delay, schedule_task, args=(task.id, task.user_id, task_lane(task), parks))
+    timer.daemon = True
+    timer.start()
+
+@metrics.IN_FLIGHT_TASKS.track_inprogress()
+def process_music_generation_async(task_id: str, parks: int = 0):
     """异步处理音乐生成任务"""
     try:
         with app.app_context():
             task = MusicTask.query.get(task_id)
-            if not task:
+            # 已被处理或已由其他进程接管的任务
+            if not task or task.status != 'pending' or task.scheduler_owner not in (None, process_identity()):
+                return
+
+            # 上游熔断时快速失败或暂缓，避免占用线程等待超时
+            unavailable = unavailable_upstreams()
+            if unavailable:
+                if BREAKER_OPEN_ACTION == 'park' and parks < BREAKER_MAX_PARKS:
+                    retry_in = max(agent.gemini_breaker.retry_in(), agent.suno_breaker.retry_in())
+                    task.mark_stage('parked')
+                    db.session.commit()
+                    park_task(task, parks + 1, retry_in + 1)
+                    logger.info("Task parked while upstream is unavailable", extra={
+                        'task_id': task_id, 'upstreams': unavailable, 'retry_in': round(retry_in, 1)
+                    })
+                    return
+                task.status = 'failed'
+                task.error_message = f"Upstream service unavailable: {', '.join(unavailable)}"
+                task.progress = 0
+                db.session.commit()
+                logger.warning("Task failed fast, upstream unavailable", extra={'task_id': task_id, 'upstreams': unavailable})
                 return
 
+            # 任务的端到端截止时间从开始处理时计算
+            deadline = Deadline()
+
             # 更新状态为分析中
+            task.mark_stage('dispatched')
             task.status = 'analyzing'
             task.progress = 10
             db.session.commit()
 
-            # 解析图片路径
-            image_paths = json.loads(task.image_paths)
-
-            # 验证图片文件是否存在
-            valid_image_paths = []
-            for path in image_paths:
-                if os.path.exists(path):
-                    valid_image_paths.append(path)
-                else:
-                    print(f"Warning: Image file not found: {path}")
+            # 热门地点已预先生成分析结果时直接进入Suno阶段
+            prewarmed = take_prewarmed_analysis(task.location, json.loads(task.image_paths or '[]'))
+            if prewarmed:
+                analysis, music_description, music_lyrics = prewarmed
+                task.analysis_result = json.dumps(analysis)
+                task.mark_stage('prewarm_hit')
+                logger.info("Using prewarmed analysis", extra={'task_id': task_id, 'location': task.location})
+            else:
+                # 解析图片路径
+                image_paths = json.loads(task.image_paths)
 
-            if not valid_image_paths:
-                task.status = 'failed'
-                task.error_message = "No valid image files found"
-                db.session.commit()
-                return
+                # 验证图片文件是否存在
+                valid_image_paths = []
+                for path in image_paths:
+                    if os.path.exists(path):
+                        valid_image_paths.append(path)
+                    else:
+                        logger.warning("Image file not found", extra={'task_id': task_id, 'path': path})
 
-            # 执行AI分析
-            update_task_progress(task_id, 30)
-            analysis = agent.analyze_images_and_location(valid_image_paths, task.location)
+                if not valid_image_paths:
+                    task.status = 'failed'
+                    task.error_message = "No valid image files found"
+                    db.session.commit()
+                    return
+
+                # 去除近似重复的图片，只把最多N张差异最大的代表图片发送给视觉模型
+                selection = image_selection.select_representatives(valid_image_paths)
+                task.dropped_images = selection.dropped
+                if selection.dropped:
+                    logger.info("Dropped similar images before analysis", extra={
+                        'task_id': task_id,
+                        'selected': len(selection.selected),
+                        'duplicates': len(selection.duplicates),
+                        'over_limit': len(selection.over_limit)
+                    })
+                valid_image_paths = selection.selected or valid_image_paths
+
+                # 执行AI分析
+                update_task_progress(task_id, 30)
+                analysis = agent.analyze_images_and_location(
+                    valid_image_paths, task.location, on_stage=task.mark_stage, deadline=deadline
+                )
+                task.mark_stage('analysis_returned')
+
+                if "error" in analysis:
+                    task.status = 'failed'
+                    task.error_message = f"Analysis failed: {analysis['error']}"
+                    db.session.commit()
+                    return
 
-            if "error" in analysis:
-                task.status = 'failed'
-                task.error_message = f"Analysis failed: {analysis['error']}"
+                # 保存分析结果
+                task.analysis_result = json.dumps(analysis)
+                logger.debug("AI analysis", extra={'task_id': task_id, 'analysis': analysis})
+                task.progress = 50
                 db.session.commit()
-                return
 
-            # 保存分析结果
-            task.analysis_result = json.dumps(analysis)
-            print("AI analysis", json.dumps(analysis))
-            task.progress = 50
-            db.session.commit()
-
-            # 生成音乐描述
-            music_description = agent.generate_music_description(analysis)
-            music_lyrics=agent.generate_lyrics(analysis)
+                # 生成音乐描述
+                music_description = agent.generate_music_description(analysis, deadline=deadline)
+                task.mark_stage('description_returned')
+                music_lyrics=agent.generate_lyrics(analysis, deadline=deadline)
+                task.mark_stage('lyrics_returned')
             task.music_description = music_description
-            print("music_description", music_description)
+            task.lyrics = music_lyrics
+            logger.debug("Music description generated", extra={'task_id': task_id, 'music_description': music_description})
 
             # 更新状态为生成中
             task.status = 'generating'
             task.progress = 70
             db.session.commit()
-            print("generating!!!!!!!!!!")
+            logger.info("Submitting task to Suno", extra={'task_id': task_id})
 
             # 调用Suno API，使用debug webhook URL
             debug_webhook_url = "https://webhook.site/f7efe110-a865-4fb4-a6f7-2791a73e5d13"
             music_result = agent.generate_music_with_suno(
             lyrics=music_lyrics,
             style_description=music_description,
-            callback_url=debug_webhook_url
+            callback_url=debug_webhook_url,
+            deadline=deadline
             )
-            print("suno_response", json.dumps(music_result))
+            task.mark_stage('suno_submitted')
+            logger.debug("Suno submit response", extra={'task_id': task_id, 'response': music_result})
 
             # 检查API调用是否成功
             if "error" in music_result:
@@ -444,12 +1199,12 @@ def process_music_generation_async(task_id: str):
                     # 启动轮询线程
                     polling_thread = threading.Thread(
                         target=poll_suno_task_status,
-                        args=(task_id, suno_task_id)
+                        args=(task_id, suno_task_id, deadline)
                     )
                     polling_thread.daemon = True
                     polling_thread.start()
                     
-                    print(f"Started polling for task {task_id} with suno task {suno_task_id}")
+                    logger.info("Started polling Suno task", extra={'task_id': task_id, 'suno_task_id': suno_task_id})
                 else:
                     task.status = 'failed'
                     task.error_message = f"No task ID received from Suno API. Response: {json.dumps(music_result)}"
@@ -457,6 +1212,8 @@ def process_music_generation_async(task_id: str):
                     db.session.commit()
 
     except Exception as e:
+        if isinstance(e, DeadlineExceeded):
+            metrics.DEADLINE_EXCEEDED.labels(stage=e.stage).inc()
         with app.app_context():
             task = MusicTask.query.get(task_id)
             if task:
@@ -464,7 +1221,80 @@ def process_music_generation_async(task_id: str):
                 task.error_message = str(e)
                 task.progress = 0
                 db.session.commit()
-        print(f"Error in async processing: {e}")
+        logger.exception("Error in async processing", extra={'task_id': task_id})
+
+def _observe_queue_wait(job, waited):
+    metrics.SCHEDULER_WAIT_SECONDS.labels(lane=job.lane).observe(waited)
+
+# 所有任务经调度器按用户公平分享处理线程（工作线程在首次提交时启动）
+task_scheduler = FairScheduler(process_music_generation_async, on_dispatch=_observe_queue_wait)
+
+_estimate_cache = {'expires_at': 0.0, 'data': None}
+_estimate_cache_lock = threading.Lock()
+
+def recent_stage_estimates():
+    """最近完成任务的典型阶段耗时（进程内缓存）"""
+    with _estimate_cache_lock:
+        now = time.monotonic()
+        if _estimate_cache['data'] is None or now >= _estimate_cache['expires_at']:
+            timelines = db.session.execute(
+                db.select(MusicTask.timeline)
+                .where(MusicTask.status == 'completed', MusicTask.timeline.isnot(None))
+                .order_by(MusicTask.created_at.desc())
+                .limit(admission.ESTIMATE_SAMPLE_SIZE)
+            ).scalars()
+            _estimate_cache['data'] = admission.estimate_from_timelines(timelines)
+            _estimate_cache['expires_at'] = now + ESTIMATE_CACHE_SECONDS
+        return _estimate_cache['data']
+
+def admission_decision(lane: str, incoming: int = 1) -> admission.Decision:
+    """根据调度器排队情况、Suno生成中的任务数和熔断器状态决定是否接受新任务"""
+    open_breakers = [breaker for breaker in (agent.gemini_breaker, agent.suno_breaker) if breaker.is_open()]
+    generating = db.session.get(StatCounter, task_counter_name('generating'))
+    lane_state = task_scheduler.snapshot()['lanes'][lane]
+    decision = admission.evaluate(
+        recent_stage_estimates(),
+        queued=lane_state['queued'],
+        running=lane_state['running'],
+        lane_limit=lane_state['limit'],
+        max_queued=admission.ADMISSION_MAX_BATCH_QUEUED if lane == BATCH else admission.ADMISSION_MAX_QUEUED,
+        suno_in_flight=generating.value if generating else 0,
+        incoming=incoming,
+        upstream_retry_in=max((breaker.retry_in() for breaker in open_breakers), default=0.0),
+        park_upstream=BREAKER_OPEN_ACTION == 'park'
+    )
+    if not decision.admitted:
+        metrics.ADMISSION_REJECTED.labels(lane=lane, reason=decision.reason).inc()
+        logger.warning("Task creation rejected by admission control", extra={
+            'lane': lane, 'reason': decision.reason, 'retry_after': decision.retry_after,
+            'sample_key': f'admission:{decision.reason}'
+        })
+    return decision
+
+def admission_rejected_response(decision: admission.Decision):
+    """过载时的429响应"""
+    response = jsonify({
+        'error': 'Server is busy, please retry later',
+        'reason': decision.reason,
+        'retry_after': decision.retry_after
+    })
+    response.status_code = 429
+    response.headers['Retry-After'] = str(decision.retry_after)
+    return response
+
+def completion_estimate(decision: admission.Decision) -> Dict[str, Any]:
+    """接受任务时返回给客户端的等待和完成时间估算"""
+    return {
+        'queue_position': decision.queue_position,
+        'estimated_wait_seconds': decision.estimated_wait_seconds,
+        'estimated_completion_at': (
+            datetime.utcnow() + timedelta(seconds=decision.estimated_completion_seconds)
+        ).isoformat()
+    }
+
+def json_response(payload: str):
+    """返回已序列化的JSON（缓存中的响应无需再解析）"""
+    return app.response_class(payload + '\n', mimetype=app.json.mimetype)
 
 @app.route('/api/upload-images', methods=['POST'])
 def upload_images():
@@ -499,14 +1329,23 @@ def upload_images():
         if not uploaded_paths:
             return jsonify({'error': 'No valid images uploaded'}), 400
 
+        # 记录到上传文件索引
+        db.session.add_all([
+            UploadedFile(path=path, size=os.path.getsize(path), digest=file_digest(path))
+            for path in uploaded_paths
+        ])
+        db.session.commit()
+
         return jsonify({
             'success': True,
             'message': f'Successfully uploaded {len(uploaded_paths)} images',
             'image_paths': uploaded_paths,
+            'image_urls': [f'/api/images/{os.path.basename(path)}' for path in uploaded_paths],
             'count': len(uploaded_paths)
         })
 
     except Exception as e:
+        db.session.rollback()
         # 清理已上传的文件（如果有错误）
         for path in uploaded_paths:
             try:
@@ -516,6 +1355,60 @@ def upload_images():
                 pass
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/images/<image_id>', methods=['GET'])
+def get_image(image_id):
+    """获取上传的图片，可通过 ?w= 获取固定尺寸的缩略图"""
+    try:
+        if secure_filename(image_id) != image_id or not allowed_file(image_id):
+            return jsonify({'error': 'Invalid image id'}), 400
+
+        source_path = os.path.join(app.config['UPLOAD_FOLDER'], image_id)
+        if not os.path.isfile(source_path):
+            return jsonify({'error': 'Image not found'}), 404
+
+        width = request.args.get('w')
+        if width is None:
+            path = source_path
+            etag = image_id
+        else:
+            try:
+                width = image_variants.pick_width(int(width))
+            except ValueError:
+                return jsonify({
+                    'error': f'w must be an integer, available widths: {list(image_variants.VARIANT_WIDTHS)}'
+                }), 400
+            path = image_variants.get_or_create_variant(source_path, VARIANT_FOLDER, width)
+            etag = f"{image_id}-w{width}"
+
+        response = send_file(
+            os.path.abspath(path),
+            conditional=True,
+            etag=etag,
+            max_age=IMAGE_CACHE_MAX_AGE
+        )
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+        return response
+
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+def idempotent_replay_response(row, task, request_hash):
+    """幂等键重复使用时返回原任务；请求内容不同时返回422"""
+    if row is not None and row.request_hash != request_hash:
+        return jsonify({
+            'error': 'Idempotency-Key was already used with a different request'
+        }), 422
+    metrics.DEDUPLICATED_REQUESTS.labels(reason='idempotency_key').inc()
+    return jsonify({
+        'success': True,
+        'task_id': task.id,
+        'status': task.status,
+        'progress': task.progress,
+        'idempotent_replay': True,
+        'message': 'Returned the music task created by the original request'
+    })
+
 @app.route('/api/generate-music', methods=['POST'])
 def generate_music():
     """创建音乐生成任务"""
@@ -537,6 +1430,53 @@ def generate_music():
             return jsonify({
                 'error': 'image_paths must be a non-empty array'
             }), 400
+        if len(image_paths) > MAX_TASK_IMAGES:
+            return jsonify({
+                'error': f'Too many images, at most {MAX_TASK_IMAGES} per task'
+            }), 400
+
+        # 客户端重试时通过幂等键返回原来的任务
+        idempotency_key = request.headers.get('Idempotency-Key')
+        request_hash = hash_request(data)
+        if idempotency_key:
+            if len(idempotency_key) > IDEMPOTENCY_KEY_MAX_LENGTH:
+                return jsonify({
+                    'error': f'Idempotency-Key must be at most {IDEMPOTENCY_KEY_MAX_LENGTH} characters'
+                }), 400
+            idempotency_key = f"idem:{user_id or ''}:{idempotency_key}"
+            row, original_task = request_key_holder(idempotency_key)
+            if original_task:
+                return idempotent_replay_response(row, original_task, request_hash)
+
+        # 可选坐标，用于空间索引和附近歌曲复用
+        coordinates = None
+        if data.get('latitude') is not None or data.get('longitude') is not None:
+            coordinates = geo_index.parse_coordinates(data.get('latitude'), data.get('longitude'))
+            if not coordinates:
+                return jsonify({
+                    'error': 'latitude and longitude must be valid coordinates'
+                }), 400
+
+        # 复用附近已完成的歌曲，直接返回而不启动新的生成流程
+        if data.get('reuse_nearby') and coordinates:
+            try:
+                radius = float(data.get('reuse_radius', REUSE_RADIUS_METERS))
+            except (TypeError, ValueError):
+                return jsonify({'error': 'reuse_radius must be a number'}), 400
+            radius = min(max(radius, 0), REUSE_MAX_RADIUS_METERS)
+
+            nearby_task, distance = find_nearby_completed_task(coordinates[0], coordinates[1], radius)
+            if nearby_task:
+                return jsonify({
+                    'success': True,
+                    'task_id': nearby_task.id,
+                    'status': nearby_task.status,
+                    'progress': nearby_task.progress,
+                    'reused': True,
+                    'distance_meters': round(distance, 1),
+                    'task': nearby_task.to_dict(include_details=True),
+                    'message': 'Reused a completed music task near this location'
+                })
 
         # 验证图片文件是否存在
         missing_files = []
@@ -549,46 +1489,263 @@ def generate_music():
                 'error': f'Image files not found: {", ".join(missing_files)}'
             }), 400
 
-        # 创建任务记录
-        task = MusicTask(
-            user_id=user_id,
-            location=location,
-            image_paths=json.dumps(image_paths),
-            status='pending',
-            progress=0
-        )
-
-        db.session.add(task)
-        db.session.commit()
+        # 相同地点和相同图片的请求合并到正在处理的任务上
+        flight_key = coalescing_key(user_id, location, image_paths)
+        for attempt in range(2):
+            task = build_music_task(location, image_paths, user_id=user_id, coordinates=coordinates)
+            try:
+                running_task = claim_request_key(flight_key, task.id, request_hash)
+                if not running_task:
+                    # 合并到已有任务不增加负载，只有新建任务需要经过准入控制
+                    decision = admission_decision(INTERACTIVE)
+                    if not decision.admitted:
+                        db.session.rollback()
+                        return admission_rejected_response(decision)
+                target = running_task or task
+                if idempotency_key:
+                    original_task = claim_request_key(idempotency_key, target.id, request_hash)
+                    if original_task:
+                        row = db.session.get(TaskRequestKey, idempotency_key)
+                        db.session.rollback()
+                        return idempotent_replay_response(row, original_task, request_hash)
+                if not running_task:
+                    db.session.add(task)
+                    db.session.add_all(file_references_for(task, image_paths))
+                db.session.commit()
+                break
+            except (IntegrityError, RequestKeyConflict):
+                # 并发的相同请求抢先占用了键，重新查询后合并到它创建的任务上
+                db.session.rollback()
+                if attempt:
+                    raise
+
+        if running_task:
+            metrics.DEDUPLICATED_REQUESTS.labels(reason='coalesced').inc()
+            return jsonify({
+                'success': True,
+                'task_id': running_task.id,
+                'status': running_task.status,
+                'progress': running_task.progress,
+                'coalesced': True,
+                'message': 'Attached to an identical music task already in progress'
+            })
 
-        # 启动异步处理
-        thread = threading.Thread(
-            target=process_music_generation_async,
-            args=(task.id,)
-        )
-        thread.daemon = True
-        thread.start()
+        # 排队异步处理
+        schedule_task(task.id, user_id=user_id)
 
         return jsonify({
             'success': True,
             'task_id': task.id,
             'status': 'pending',
             'progress': 0,
+            **completion_estimate(decision),
             'message': 'Music generation task created successfully'
         })
 
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/generate-music/batch', methods=['POST'])
+def generate_music_batch():
+    """批量创建音乐生成任务（一次事务写入，共享并发额度处理）"""
+    try:
+        data = request.get_json()
+
+        if not data or not isinstance(data.get('items'), list) or len(data['items']) == 0:
+            return jsonify({
+                'error': 'Missing required parameter: items must be a non-empty array'
+            }), 400
+
+        items = data['items']
+        user_id = data.get('user_id')
+
+        if len(items) > BATCH_MAX_TASKS:
+            return jsonify({
+                'error': f'Too many items in batch: {len(items)} > {BATCH_MAX_TASKS}'
+            }), 400
+
+        # 先校验所有条目，有任何错误时整个批次都不创建
+        errors = []
+        validated = []
+        for index, item in enumerate(items):
+            if not isinstance(item, dict) or not item.get('location'):
+                errors.append({'index': index, 'error': 'location is required'})
+                continue
+
+            image_paths = item.get('image_paths')
+            if not isinstance(image_paths, list) or len(image_paths) == 0:
+                errors.append({'index': index, 'error': 'image_paths must be a non-empty array'})
+                continue
+            if len(image_paths) > MAX_TASK_IMAGES:
+                errors.append({'index': index, 'error': f'Too many images, at most {MAX_TASK_IMAGES} per task'})
+                continue
+
+            missing_files = [path for path in image_paths if not os.path.exists(path)]
+            if missing_files:
+                errors.append({'index': index, 'error': f'Image files not found: {", ".join(missing_files)}'})
+                continue
+
+            coordinates = None
+            if item.get('latitude') is not None or item.get('longitude') is not None:
+                coordinates = geo_index.parse_coordinates(item.get('latitude'), item.get('longitude'))
+                if not coordinates:
+                    errors.append({'index': index, 'error': 'latitude and longitude must be valid coordinates'})
+                    continue
+
+            validated.append((item['location'], image_paths, coordinates))
+
+        if errors:
+            return jsonify({'error': 'Invalid batch items', 'items': errors}), 400
+
+        decision = admission_decision(BATCH, incoming=len(validated))
+        if not decision.admitted:
+            return admission_rejected_response(decision)
+
+        # 一次事务写入所有任务
+        batch_id = str(uuid.uuid4())
+        tasks = []
+        for location, image_paths, coordinates in validated:
+            task = build_music_task(location, image_paths, user_id=user_id, coordinates=coordinates, batch_id=batch_id)
+            tasks.append(task)
+            db.session.add(task)
+            db.session.add_all(file_references_for(task, image_paths))
+        db.session.commit()
+
+        # 在batch通道排队处理，不占用实时请求的处理份额
+        task_ids = [task.id for task in tasks]
+        for task_id in task_ids:
+            schedule_task(task_id, user_id=user_id, lane=BATCH)
+
+        return jsonify({
+            'success': True,
+            'batch_id': batch_id,
+            'task_ids': task_ids,
+            'count': len(task_ids),
+            'status_url': f'/api/generate-music/batch/{batch_id}',
+            **completion_estimate(decision),
+            'message': f'Batch with {len(task_ids)} music generation tasks created successfully'
+        })
+
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/generate-music/batch/<batch_id>', methods=['GET'])
+def get_batch_status(batch_id):
+    """获取批次的汇总进度"""
+    try:
+        rows = db.session.query(
+            MusicTask.status,
+            db.func.count(MusicTask.id),
+            db.func.coalesce(db.func.sum(MusicTask.progress), 0)
+        ).filter(MusicTask.batch_id == batch_id).group_by(MusicTask.status).all()
+
+        if not rows:
+            return jsonify({'error': 'Batch not found'}), 404
+
+        status_counts = {}
+        total = 0
+        progress_sum = 0
+        for status, count, status_progress in rows:
+            status_counts[status] = count
+            total += count
+            # 失败的任务也算作已结束
+            progress_sum += count * 100 if status == 'failed' else int(status_progress)
+
+        finished = status_counts.get('completed', 0) + status_counts.get('failed', 0)
+
+        return jsonify({
+            'batch_id': batch_id,
+            'total': total,
+            'finished': finished,
+            'status_counts': status_counts,
+            'progress': round(progress_sum / total) if total else 0,
+            'done': finished == total
+        })
+
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/api/task-status/<task_id>', methods=['GET'])
 def get_task_status(task_id):
-    """获取任务状态"""
+    """
+    获取任务状态。
+    长轮询：?wait=秒数&status=..&progress=.. 表示客户端已知的状态，
+    任务仍处于该状态时最多等待wait秒，任一worker更新任务后立即返回。
+    """
+    try:
+        try:
+            wait = float(request.args.get('wait', 0) or 0)
+        except ValueError:
+            wait = math.nan
+        if math.isnan(wait):
+            return jsonify({'error': 'Invalid wait parameter'}), 400
+        wait = min(max(wait, 0.0), TASK_STATUS_MAX_WAIT)
+        # 普通查询使用缓存；长轮询和时间线直接读取数据库
+        cacheable = wait <= 0 and request.args.get('timeline') not in ('1', 'true')
+        if cacheable:
+            version = task_cache.task_version(task_id)
+            cached = task_cache.get_task(task_id, version)
+            metrics.TASK_CACHE_REQUESTS.labels(kind='task', result='hit' if cached else 'miss').inc()
+            if cached:
+                return json_response(cached)
+
+        waiter = notification_bus.watch(task_id) if wait > 0 else None
+        try:
+            task = MusicTask.query.get(task_id)
+            if not task:
+                return jsonify({'error': 'Task not found'}), 404
+
+            unchanged = (request.args.get('status') == task.status
+                         and request.args.get('progress', str(task.progress)) == str(task.progress))
+            if waiter and unchanged and task.status not in ('completed', 'failed'):
+                # 等待期间归还数据库连接，之后用新的会话重新读取其他worker提交的变更
+                db.session.remove()
+                waiter.wait(wait)
+                task = MusicTask.query.get(task_id)
+                if not task:
+                    return jsonify({'error': 'Task not found'}), 404
+        finally:
+            if waiter:
+                notification_bus.unwatch(task_id, waiter)
+
+        result = task.to_dict(include_details=True)
+        if request.args.get('timeline') in ('1', 'true'):
+            result['timeline'] = task_timeline.expand(task.timeline, task.created_at)
+
+        payload = app.json.dumps(result)
+        if cacheable:
+            task_cache.set_task(task_id, version, payload)
+        return json_response(payload)
+
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/audio/<task_id>', methods=['GET'])
+def get_task_audio(task_id):
+    """播放已完成任务的音频（优先使用本地缓存，支持Range请求）"""
     try:
         task = MusicTask.query.get(task_id)
         if not task:
             return jsonify({'error': 'Task not found'}), 404
 
-        return jsonify(task.to_dict(include_details=True))
+        if task.status != 'completed' or not task.selected_music_url:
+            return jsonify({'error': 'Audio not available'}), 404
+
+        cached_path = audio_cache.get(task_id)
+        if cached_path:
+            # 缓存文件的修改时间用于LRU，ETag只取决于任务和文件大小
+            return send_file(
+                os.path.abspath(cached_path),
+                mimetype='audio/mpeg',
+                conditional=True,
+                etag=f"{task_id}-{os.path.getsize(cached_path)}",
+                max_age=AUDIO_CACHE_MAX_AGE
+            )
+
+        # 尚未缓存：触发后台下载，本次先重定向到上游地址
+        audio_cache.enqueue(task_id, task.selected_music_url)
+        return redirect(task.selected_music_url, code=302)
 
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -599,7 +1756,7 @@ def suno_callback(task_id):
     try:
         callback_data = request.get_json()
         
-        print(f"Debug callback received for task {task_id}: {json.dumps(callback_data, indent=2)}")
+        logger.info("Debug callback received", extra={'task_id': task_id, 'callback_data': callback_data})
 
         # 记录回调日志
         log = CallbackLog(
@@ -613,7 +1770,7 @@ def suno_callback(task_id):
         return jsonify({'success': True, 'message': 'Debug callback received'})
 
     except Exception as e:
-        print(f"Debug callback error: {e}")
+        logger.error("Debug callback error: %s", e, extra={'task_id': task_id})
         return jsonify({'error': str(e)}), 500
 
 @app.route('/api/tasks', methods=['GET'])
@@ -625,6 +1782,12 @@ def list_tasks():
         limit = int(request.args.get('limit', 50))
         offset = int(request.args.get('offset', 0))
 
+        cache_key = task_cache.list_key(user_id=user_id, status=status, limit=limit, offset=offset)
+        cached = task_cache.get_list(cache_key)
+        metrics.TASK_CACHE_REQUESTS.labels(kind='list', result='hit' if cached else 'miss').inc()
+        if cached:
+            return json_response(cached)
+
         query = MusicTask.query
 
         if user_id:
@@ -637,16 +1800,102 @@ def list_tasks():
 
         result = [task.to_dict() for task in tasks]
 
-        return jsonify({
+        payload = app.json.dumps({
             'tasks': result,
             'total': len(result),
             'offset': offset,
             'limit': limit
         })
+        task_cache.set_list(cache_key, payload)
+        return json_response(payload)
 
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+# 导出的基本列；analysis 和 lyrics 需要通过 include 参数指定
+EXPORT_COLUMNS = (
+    'id', 'user_id', 'location', 'status', 'progress', 'batch_id', 'latitude', 'longitude',
+    'music_title', 'selected_music_url', 'music_duration', 'music_description', 'dropped_images',
+    'error_message', 'created_at', 'completed_at'
+)
+EXPORT_OPTIONAL_COLUMNS = {'analysis': 'analysis_result', 'lyrics': 'lyrics'}
+
+def parse_export_time(name):
+    """解析ISO格式的时间参数（带时区偏移的换算为UTC，不带的视为UTC），格式错误时抛出ValueError"""
+    value = request.args.get(name)
+    if not value:
+        return None
+    try:
+        parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except ValueError:
+        raise ValueError(f'{name} must be an ISO 8601 timestamp')
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+def export_row(row, include):
+    """把一行导出为一条NDJSON记录"""
+    record = {}
+    for name in EXPORT_COLUMNS:
+        value = row._mapping[name]
+        record['task_id' if name == 'id' else name] = value.isoformat() if isinstance(value, datetime) else value
+    if 'analysis' in include:
+        analysis = row._mapping['analysis_result']
+        try:
+            record['analysis'] = json.loads(analysis) if analysis else None
+        except ValueError:
+            record['analysis'] = analysis
+    if 'lyrics' in include:
+        record['lyrics'] = row._mapping['lyrics']
+    return json.dumps(record, ensure_ascii=False, separators=(',', ':')) + '\n'
+
+@app.route('/api/tasks/export', methods=['GET'])
+def export_tasks():
+    """
+    以NDJSON流式导出任务（每行一个任务，按创建时间升序）。
+    过滤参数：user_id、status（可用逗号分隔多个）、created_after、created_before；
+    include=analysis,lyrics 导出分析结果和歌词。
+    单次查询按批读取（PostgreSQL使用服务端游标），内存占用与导出行数无关。
+    长时间的导出依赖gthread worker（gunicorn.conf.py），sync worker会在timeout后被杀掉。
+    """
+    try:
+        include = {item for item in request.args.get('include', '').split(',') if item}
+        unknown = include - set(EXPORT_OPTIONAL_COLUMNS)
+        if unknown:
+            return jsonify({'error': f"Unknown include option: {', '.join(sorted(unknown))}"}), 400
+        created_after = parse_export_time('created_after')
+        created_before = parse_export_time('created_before')
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    columns = [getattr(MusicTask, name) for name in EXPORT_COLUMNS]
+    columns += [getattr(MusicTask, EXPORT_OPTIONAL_COLUMNS[option]) for option in sorted(include)]
+    # 只选择需要的列，不构造ORM对象，避免身份映射随导出行数增长
+    query = db.select(*columns).order_by(MusicTask.created_at, MusicTask.id)
+    if request.args.get('user_id'):
+        query = query.where(MusicTask.user_id == request.args['user_id'])
+    if request.args.get('status'):
+        query = query.where(MusicTask.status.in_(request.args['status'].split(',')))
+    if created_after:
+        query = query.where(MusicTask.created_at >= created_after)
+    if created_before:
+        query = query.where(MusicTask.created_at < created_before)
+
+    def generate():
+        result = db.session.execute(query.execution_options(yield_per=EXPORT_BATCH_SIZE))
+        try:
+            for row in result:
+                yield export_row(row, include)
+        finally:
+            result.close()
+
+    filename = f"tasks-{datetime.utcnow().strftime('%Y%m%dT%H%M%SZ')}.ndjson"
+    return Response(
+        stream_with_context(generate()),
+        mimetype='application/x-ndjson',
+        headers={'Content-Disposition': f'attachment; filename="{filename}"'}
+    )
+
 @app.route('/api/task/<task_id>', methods=['DELETE'])
 def delete_task(task_id):
     """删除任务"""
@@ -655,90 +1904,278 @@ def delete_task(task_id):
         if not task:
             return jsonify({'error': 'Task not found'}), 404
 
-        # 删除相关的图片文件
-        if task.image_paths:
-            try:
-                image_paths = json.loads(task.image_paths)
-                for path in image_paths:
-                    if os.path.exists(path):
-                        os.remove(path)
-                        print(f"Deleted image file: {path}")
-            except Exception as e:
-                print(f"Error deleting image files: {e}")
+        try:
+            image_paths = json.loads(task.image_paths) if task.image_paths else []
+        except ValueError:
+            image_paths = []
 
-        # 删除相关的回调日志
-        CallbackLog.query.filter_by(task_id=task_id).delete()
+        # 删除相关的回调日志和文件引用（集合删除不触发ORM事件，手动扣减回调计数）
+        callbacks_deleted = CallbackLog.query.filter_by(task_id=task_id).delete()
+        apply_counter_deltas(db.session.connection(), {CALLBACK_COUNTER: -callbacks_deleted})
+        remove_file_references([task_id])
+        remove_request_keys([task_id])
 
         # 删除任务
         db.session.delete(task)
         db.session.commit()
 
+        # 删除本地缓存的音频
+        audio_cache.remove(task_id)
+
+        # 只删除已没有其他任务引用的图片文件及其索引记录
+        removed_paths = []
+        for path in unreferenced_paths(image_paths):
+            try:
+                if remove_image_file(path):
+                    removed_paths.append(path)
+                    logger.info("Deleted image file", extra={'task_id': task_id, 'path': path})
+            except OSError as e:
+                logger.error("Error deleting image file: %s", e, extra={'task_id': task_id, 'path': path})
+        if removed_paths:
+            remove_file_references([], removed_paths)
+            db.session.commit()
+
         return jsonify({'success': True, 'message': 'Task deleted successfully'})
 
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+RECONCILE_STATE_KEY = 'file_reconcile'
+BACKFILL_STATE_KEY = 'file_reference_backfill'
+
+def backfill_file_references(chunk_size=500):
+    """根据已有任务的image_paths补全文件引用表（按任务ID分页，可断点续跑）"""
+    with app.app_context():
+        state = MaintenanceState.load(BACKFILL_STATE_KEY, {'last_task_id': '', 'tasks': 0, 'finished': False})
+        if state.get('finished'):
+            return state
+
+        while True:
+            rows = db.session.execute(
+                db.select(MusicTask.id, MusicTask.image_paths)
+                .where(MusicTask.id > state['last_task_id'])
+                .order_by(MusicTask.id)
+                .limit(chunk_size)
+            ).all()
+            if not rows:
+                state['finished'] = True
+                MaintenanceState.save(BACKFILL_STATE_KEY, state)
+                db.session.commit()
+                return state
+
+            task_ids = [row[0] for row in rows]
+            existing = set(db.session.execute(
+                db.select(FileReference.task_id, FileReference.path)
+                .where(FileReference.task_id.in_(task_ids))
+            ).all())
+
+            for task_id, image_paths in rows:
+                try:
+                    paths = set(json.loads(image_paths)) if image_paths else set()
+                except ValueError:
+                    continue
+                db.session.add_all([
+                    FileReference(path=path, task_id=task_id)
+                    for path in paths if (task_id, path) not in existing
+                ])
+
+            state['last_task_id'] = task_ids[-1]
+            state['tasks'] += len(rows)
+            MaintenanceState.save(BACKFILL_STATE_KEY, state)
+            db.session.commit()
+
+def _reconcile_page(paths, dry_run):
+    """检查一页文件的引用情况，删除未被任何任务引用的文件"""
+    referenced = set(db.session.execute(
+        db.select(FileReference.path).where(FileReference.path.in_(paths)).distinct()
+    ).scalars())
+
+    orphaned = [path for path in paths if path not in referenced]
+    if dry_run or not orphaned:
+        return orphaned
+
+    deleted = []
+    for path in orphaned:
+        try:
+            remove_image_file(path)
+            deleted.append(path)
+            logger.info("Deleted orphaned file", extra={'path': path})
+        except Exception as e:
+            logger.error("Error deleting orphaned file: %s", e, extra={'path': path})
+
+    remove_file_references([], deleted)
+    db.session.commit()
+    return deleted
+
+def reconcile_uploads(full=False, dry_run=False, page_size=None, grace_seconds=None):
+    """增量清理孤立文件：只检查上次水位线之后、宽限期之前修改的文件"""
+    page_size = page_size or RECONCILE_PAGE_SIZE
+    grace_seconds = RECONCILE_GRACE_SECONDS if grace_seconds is None else grace_seconds
+
+    # 引用表补全之前不能判断旧任务的文件是否孤立
+    backfill_file_references()
+
+    with app.app_context():
+        state = MaintenanceState.load(RECONCILE_STATE_KEY, {'watermark': 0.0})
+        low = 0.0 if full else state.get('watermark', 0.0)
+        high = time.time() - grace_seconds
+
+        start_time = time.monotonic()
+        scanned = 0
+        inspected = 0
+        orphaned_count = 0
+        page = []
+
+        # 使用scandir流式遍历目录，按页批量查询引用
+        with os.scandir(app.config['UPLOAD_FOLDER']) as entries:
+            for entry in entries:
+                if not entry.is_file():
+                    continue
+                scanned += 1
+                mtime = entry.stat().st_mtime
+                if mtime <= low or mtime > high:
+                    continue
+
+                page.append(entry.path)
+                inspected += 1
+                if len(page) >= page_size:
+                    orphaned_count += len(_reconcile_page(page, dry_run))
+                    page = []
+
+        if page:
+            orphaned_count += len(_reconcile_page(page, dry_run))
+
+        summary = {
+            'watermark': high if not dry_run else state.get('watermark', 0.0),
+            'previous_watermark': low,
+            'scanned_files': scanned,
+            'inspected_files': inspected,
+            'orphaned_files': orphaned_count,
+            'dry_run': dry_run,
+            'full': full,
+            'elapsed_seconds': round(time.monotonic() - start_time, 3),
+            'finished_at': datetime.utcnow().isoformat()
+        }
+        MaintenanceState.save(RECONCILE_STATE_KEY, summary)
+        db.session.commit()
+        return summary
+
+_reconcile_lock = threading.Lock()
+
+def _run_reconcile_in_background(full, dry_run):
+    """后台执行孤立文件清理，同一进程内同时只运行一个"""
+    if not _reconcile_lock.acquire(blocking=False):
+        return
+    try:
+        summary = reconcile_uploads(full=full, dry_run=dry_run)
+        logger.info("Orphaned file reconcile finished", extra=summary)
+    except Exception:
+        logger.exception("Error reconciling uploads")
+    finally:
+        _reconcile_lock.release()
+
 @app.route('/api/cleanup-files', methods=['POST'])
 def cleanup_orphaned_files():
-    """清理孤立的文件（可选的维护接口）"""
+    """清理孤立的文件（可选的维护接口，在后台增量执行）"""
     try:
-        # 获取所有任务中使用的图片路径
-        used_paths = set()
-        tasks = MusicTask.query.all()
+        data = request.get_json(silent=True) or {}
+        full = bool(data.get('full', False))
+        dry_run = bool(data.get('dry_run', False))
 
-        for task in tasks:
-            if task.image_paths:
-                try:
-                    paths = json.loads(task.image_paths)
-                    used_paths.update(paths)
-                except:
-                    pass
-
-        # 获取上传目录中的所有文件
-        upload_dir = app.config['UPLOAD_FOLDER']
-        all_files = set()
-
-        for filename in os.listdir(upload_dir):
-            filepath = os.path.join(upload_dir, filename)
-            if os.path.isfile(filepath):
-                all_files.add(filepath)
-
-        # 找出孤立的文件
-        orphaned_files = all_files - used_paths
-
-        # 删除孤立的文件
-        deleted_count = 0
-        for filepath in orphaned_files:
-            try:
-                os.remove(filepath)
-                deleted_count += 1
-                print(f"Deleted orphaned file: {filepath}")
-            except Exception as e:
-                print(f"Error deleting {filepath}: {e}")
+        if _reconcile_lock.locked():
+            return jsonify({
+                'success': False,
+                'message': 'Orphaned file cleanup is already running',
+                'last_run': MaintenanceState.load(RECONCILE_STATE_KEY)
+            }), 409
+
+        thread = threading.Thread(target=_run_reconcile_in_background, args=(full, dry_run))
+        thread.daemon = True
+        thread.start()
 
         return jsonify({
             'success': True,
-            'message': f'Cleaned up {deleted_count} orphaned files',
-            'deleted_count': deleted_count,
-            'total_files': len(all_files),
-            'used_files': len(used_paths)
-        })
+            'message': 'Orphaned file cleanup started',
+            'full': full,
+            'dry_run': dry_run,
+            'last_run': MaintenanceState.load(RECONCILE_STATE_KEY)
+        }), 202
 
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+_stats_cache = {'expires_at': 0.0, 'data': None}
+_stats_cache_lock = threading.Lock()
+
+def _invalidate_task_caches(event):
+    """任务写入时删除任务缓存；状态变化时让统计缓存失效，任务完成时让完成时间估算失效"""
+    task_cache.invalidate(event.task_id)
+    if event.status_changed:
+        _stats_cache['expires_at'] = 0.0
+    if event.status == 'completed':
+        _estimate_cache['expires_at'] = 0.0
+
+notification_bus.subscribe(_invalidate_task_caches)
+
+@app.route('/api/stats', methods=['GET'])
+def get_stats():
+    """获取任务统计（读取计数表并在进程内短暂缓存，?exact=1 时执行分组查询）"""
+    try:
+        if request.args.get('exact') in ('1', 'true'):
+            stats = compute_task_stats()
+            stats['source'] = 'query'
+            stats['generated_at'] = datetime.utcnow().isoformat()
+            return jsonify(stats)
+
+        with _stats_cache_lock:
+            now = time.time()
+            if _stats_cache['data'] is None or now >= _stats_cache['expires_at']:
+                stats = read_counter_stats()
+                stats['tasks_last_24h'] = MusicTask.query.filter(
+                    MusicTask.created_at >= datetime.utcnow() - timedelta(hours=24)
+                ).count()
+                stats['source'] = 'counters'
+                stats['generated_at'] = datetime.utcnow().isoformat()
+                _stats_cache['data'] = stats
+                _stats_cache['expires_at'] = now + STATS_CACHE_SECONDS
+            stats = _stats_cache['data']
+
+        response = jsonify(stats)
+        response.cache_control.public = True
+        response.cache_control.max_age = STATS_CACHE_SECONDS
+        return response
+
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """Prometheus监控指标"""
+    content, content_type = metrics.render_metrics()
+    return Response(content, content_type=content_type)
+
 @app.route('/health', methods=['GET'])
 def health_check():
     """健康检查"""
+    breakers = circuit_breaker.snapshot_all()
+    degraded = any(breaker['state'] != circuit_breaker.CLOSED for breaker in breakers.values())
     return jsonify({
-        'status': 'healthy',
+        'status': 'degraded' if degraded else 'healthy',
         'timestamp': datetime.utcnow().isoformat(),
         'database': 'connected',
         'upload_folder': app.config['UPLOAD_FOLDER'],
-        'max_file_size': f"{app.config['MAX_CONTENT_LENGTH'] / (1024*1024):.1f}MB"
+        'max_file_size': f"{app.config['MAX_CONTENT_LENGTH'] / (1024*1024):.1f}MB",
+        'response_cache': response_cache.stats() if response_cache else None,
+        'audio_cache': audio_cache.stats(),
+        'circuit_breakers': breakers,
+        'scheduler': task_scheduler.snapshot(),
+        'notifications': notification_bus.stats(),
+        'task_cache': task_cache.stats()
     })
 
 if __name__ == '__main__':
+    prepare_database()
+    recover_orphaned_tasks()
     port = int(os.getenv('PORT', 5000))
     debug = os.getenv('FLASK_ENV') == 'development'
     app.run(host='0.0.0.0', port=port, debug=debug)
\ No newline at end of file
@@ -0,0 +1,161 @@
+# audio_cache.py
+"""
+已生成音频的本地缓存
+
+任务完成后由后台线程把Suno CDN上的音频下载到本地目录，
+之后的播放请求直接从本地文件返回（支持Range/ETag），
+缓存目录按总大小做LRU淘汰（以文件修改时间作为最近访问时间）。
+"""
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Optional
+
+import requests
+
+from log_config import get_logger
+
+logger = get_logger('audio_cache')
+
+AUDIO_FILE_SUFFIX = '.mp3'
+PARTIAL_FILE_SUFFIX = '.part'
+STALE_PARTIAL_SECONDS = 15 * 60
+
+
+class AudioCache:
+    """大小受限的本地音频缓存"""
+
+    def __init__(self, directory: str, max_bytes: int = 1024 * 1024 * 1024,
+                 fetch_workers: int = 2, timeout: int = 60):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self.fetch_workers = fetch_workers
+        self._executor = None
+        self._lock = threading.Lock()
+        self._in_flight = set()
+        self.hits = 0
+        self.misses = 0
+        self.fetched = 0
+        self.fetch_errors = 0
+        self.evictions = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def path_for(self, task_id: str) -> str:
+        """任务对应的缓存文件路径"""
+        return os.path.join(self.directory, f"{task_id}{AUDIO_FILE_SUFFIX}")
+
+    def get(self, task_id: str) -> Optional[str]:
+        """返回已缓存文件的路径，并刷新其最近访问时间"""
+        path = self.path_for(task_id)
+        try:
+            os.utime(path)
+        except OSError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return path
+
+    def enqueue(self, task_id: str, url: str) -> bool:
+        """提交后台下载，已缓存或正在下载时返回False"""
+        if not url or os.path.exists(self.path_for(task_id)):
+            return False
+
+        with self._lock:
+            if task_id in self._in_flight:
+                return False
+            self._in_flight.add(task_id)
+            # 线程池在首次使用时创建
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.fetch_workers,
+                    thread_name_prefix='audio-fetch'
+                )
+
+        self._executor.submit(self._fetch, task_id, url)
+        return True
+
+    def _fetch(self, task_id: str, url: str):
+        """下载音频到临时文件，完成后原子地替换为正式缓存文件"""
+        path = self.path_for(task_id)
+        partial_path = path + PARTIAL_FILE_SUFFIX
+        try:
+            # 用独占创建的临时文件作为跨worker的下载锁
+            try:
+                partial = open(partial_path, 'xb')
+            except FileExistsError:
+                if time.time() - os.path.getmtime(partial_path) < STALE_PARTIAL_SECONDS:
+                    return
+                os.remove(partial_path)
+                partial = open(partial_path, 'xb')
+
+            try:
+                with partial:
+                    with requests.get(url, stream=True, timeout=self.timeout) as response:
+                        response.raise_for_status()
+                        for chunk in response.iter_content(chunk_size=64 * 1024):
+                            if chunk:
+                                partial.write(chunk)
+                os.replace(partial_path, path)
+            except Exception:
+                if os.path.exists(partial_path):
+                    os.remove(partial_path)
+                raise
+
+            self.fetched += 1
+            logger.info("Cached audio", extra={'task_id': task_id, 'bytes': os.path.getsize(path)})
+            self.evict()
+
+        except Exception as e:
+            self.fetch_errors += 1
+            logger.warning("Error caching audio: %s", e, extra={'task_id': task_id})
+        finally:
+            with self._lock:
+                self._in_flight.discard(task_id)
+
+    def evict(self):
+        """按最近访问时间淘汰，直到缓存总大小低于上限"""
+        entries = []
+        total = 0
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if not entry.is_file() or not entry.name.endswith(AUDIO_FILE_SUFFIX):
+                    continue
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+
+        if total <= self.max_bytes:
+            return
+
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+                self.evictions += 1
+            except OSError:
+                pass
+
+    def remove(self, task_id: str):
+        """删除任务对应的缓存文件"""
+        try:
+            os.remove(self.path_for(task_id))
+        except OSError:
+            pass
+
+    def stats(self) -> Dict[str, Any]:
+        """返回缓存统计信息（当前进程）"""
+        return {
+            'directory': self.directory,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'fetched': self.fetched,
+            'fetch_errors': self.fetch_errors,
+            'evictions': self.evictions,
+            'in_flight': len(self._in_flight)
+        }
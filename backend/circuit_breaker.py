@@ -0,0 +1,195 @@
+# circuit_breaker.py
+"""
+上游服务（Gemini、Suno）的熔断器
+
+按最近N次调用的失败率和慢调用比例判断上游是否异常：
+- closed: 正常放行，统计调用结果
+- open: 直接拒绝调用，等待 open_seconds 后进入半开状态
+- half_open: 只放行少量探测请求，全部成功则恢复，任一失败则重新打开；
+  超过 probe_timeout 仍未报告结果的探测释放名额，避免调用方漏记结果后一直拒绝调用
+
+状态保存在进程内，每个gunicorn worker独立判断。
+"""
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Any, Dict, Optional
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+BREAKER_WINDOW_SIZE = int(os.getenv('BREAKER_WINDOW_SIZE', 20))
+BREAKER_MIN_CALLS = int(os.getenv('BREAKER_MIN_CALLS', 5))
+BREAKER_FAILURE_RATE = float(os.getenv('BREAKER_FAILURE_RATE', 0.5))
+BREAKER_SLOW_CALL_RATE = float(os.getenv('BREAKER_SLOW_CALL_RATE', 0.8))
+BREAKER_OPEN_SECONDS = float(os.getenv('BREAKER_OPEN_SECONDS', 60))
+BREAKER_HALF_OPEN_PROBES = int(os.getenv('BREAKER_HALF_OPEN_PROBES', 2))
+
+
+class CircuitOpenError(Exception):
+    """熔断器打开时拒绝调用"""
+
+    def __init__(self, name: str, retry_in: float):
+        super().__init__(f"{name} circuit breaker is open, retry in {retry_in:.0f}s")
+        self.name = name
+        self.retry_in = retry_in
+
+
+class CircuitBreaker:
+    """基于滑动窗口失败率和慢调用比例的熔断器"""
+
+    def __init__(self, name: str, slow_call_seconds: float,
+                 window_size: int = BREAKER_WINDOW_SIZE,
+                 min_calls: int = BREAKER_MIN_CALLS,
+                 failure_rate: float = BREAKER_FAILURE_RATE,
+                 slow_call_rate: float = BREAKER_SLOW_CALL_RATE,
+                 open_seconds: float = BREAKER_OPEN_SECONDS,
+                 half_open_probes: int = BREAKER_HALF_OPEN_PROBES,
+                 probe_timeout: Optional[float] = None):
+        self.name = name
+        self.slow_call_seconds = slow_call_seconds
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.slow_call_rate = slow_call_rate
+        self.open_seconds = open_seconds
+        self.half_open_probes = half_open_probes
+        # 探测超过慢调用阈值仍未返回时已经不可能成功，默认此时释放名额
+        self.probe_timeout = probe_timeout if probe_timeout is not None else slow_call_seconds
+
+        self._lock = threading.Lock()
+        self._calls = deque(maxlen=window_size)  # (是否失败, 是否慢调用)
+        self._state = CLOSED
+        self._opened_at = 0.0
+        self._probes = deque()  # 进行中的探测的开始时间
+        self._probes_succeeded = 0
+        self.rejected = 0
+        self.times_opened = 0
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._current_state()
+
+    def _current_state(self) -> str:
+        now = time.monotonic()
+        if self._state == OPEN and now - self._opened_at >= self.open_seconds:
+            self._state = HALF_OPEN
+            self._probes.clear()
+            self._probes_succeeded = 0
+        if self._state == HALF_OPEN:
+            while self._probes and now - self._probes[0] >= self.probe_timeout:
+                self._probes.popleft()
+        return self._state
+
+    def retry_in(self) -> float:
+        """距离允许探测还剩多少秒（未打开时为0）"""
+        with self._lock:
+            if self._current_state() != OPEN:
+                return 0.0
+            return max(0.0, self.open_seconds - (time.monotonic() - self._opened_at))
+
+    def is_open(self) -> bool:
+        """是否处于拒绝调用的状态（半开状态允许探测，不算打开）"""
+        return self.state == OPEN
+
+    def allow(self) -> bool:
+        """判断是否允许本次调用，半开状态下会占用一个探测名额"""
+        with self._lock:
+            state = self._current_state()
+            if state == CLOSED:
+                return True
+            if state == HALF_OPEN and len(self._probes) + self._probes_succeeded < self.half_open_probes:
+                self._probes.append(time.monotonic())
+                return True
+            self.rejected += 1
+            return False
+
+    def record(self, success: bool, duration: float):
+        """记录一次调用结果"""
+        slow = duration >= self.slow_call_seconds
+        with self._lock:
+            state = self._current_state()
+            if state == HALF_OPEN:
+                if self._probes:
+                    self._probes.popleft()
+                if not success or slow:
+                    self._open()
+                else:
+                    self._probes_succeeded += 1
+                    if self._probes_succeeded >= self.half_open_probes:
+                        self._state = CLOSED
+                        self._calls.clear()
+                return
+            if state == OPEN:
+                return
+
+            self._calls.append((not success, slow))
+            if len(self._calls) < self.min_calls:
+                return
+            failures = sum(1 for failed, _ in self._calls if failed)
+            slow_calls = sum(1 for _, is_slow in self._calls if is_slow)
+            if (failures / len(self._calls) >= self.failure_rate
+                    or slow_calls / len(self._calls) >= self.slow_call_rate):
+                self._open()
+
+    def _open(self):
+        self._state = OPEN
+        self._opened_at = time.monotonic()
+        self._calls.clear()
+        self.times_opened += 1
+
+    @contextmanager
+    def guard(self):
+        """包裹一次上游调用：熔断时抛出CircuitOpenError，异常计为失败"""
+        if not self.allow():
+            raise CircuitOpenError(self.name, self.retry_in())
+        started = time.monotonic()
+        try:
+            yield
+        except Exception:
+            self.record(False, time.monotonic() - started)
+            raise
+        self.record(True, time.monotonic() - started)
+
+    def snapshot(self) -> Dict[str, Any]:
+        """当前状态（用于 /health）"""
+        with self._lock:
+            state = self._current_state()
+            calls = len(self._calls)
+            failures = sum(1 for failed, _ in self._calls if failed)
+            slow_calls = sum(1 for _, is_slow in self._calls if is_slow)
+            retry_in = max(0.0, self.open_seconds - (time.monotonic() - self._opened_at)) if state == OPEN else 0.0
+        return {
+            'state': state,
+            'window_calls': calls,
+            'failure_rate': round(failures / calls, 3) if calls else 0.0,
+            'slow_call_rate': round(slow_calls / calls, 3) if calls else 0.0,
+            'slow_call_seconds': self.slow_call_seconds,
+            'retry_in_seconds': round(retry_in, 1),
+            'times_opened': self.times_opened,
+            'rejected': self.rejected
+        }
+
+
+_breakers: Dict[str, CircuitBreaker] = {}
+_registry_lock = threading.Lock()
+
+
+def get_breaker(name: str, slow_call_seconds: Optional[float] = None, **options) -> CircuitBreaker:
+    """获取（必要时创建）指定上游的熔断器"""
+    with _registry_lock:
+        breaker = _breakers.get(name)
+        if breaker is None:
+            breaker = CircuitBreaker(name, slow_call_seconds or 30.0, **options)
+            _breakers[name] = breaker
+        return breaker
+
+
+def snapshot_all() -> Dict[str, Dict[str, Any]]:
+    """所有熔断器的状态"""
+    with _registry_lock:
+        breakers = list(_breakers.values())
+    return {breaker.name: breaker.snapshot() for breaker in breakers}
@@ -0,0 +1,124 @@
+# compressed_text.py
+"""
+压缩存储的大文本字段
+
+Suno响应、回调数据这类JSON体积大、读取少，用zlib压缩后以文本形式保存
+（"z1:" 前缀 + base64），读取时自动解压。没有前缀的旧数据按原文返回，
+因此不需要修改列类型，也可以通过 compress_column 分批回填已有数据。
+"""
+import base64
+import os
+import time
+import zlib
+from typing import Dict, Optional
+
+from sqlalchemy import Text, cast, func, select
+from sqlalchemy.types import TypeDecorator
+
+COMPRESSED_PREFIX = 'z1:'
+COMPRESS_MIN_BYTES = int(os.getenv('PAYLOAD_COMPRESS_MIN_BYTES', 256))  # 小于此大小的内容不压缩
+COMPRESS_LEVEL = 6
+
+
+def is_compressed(value: Optional[str]) -> bool:
+    return isinstance(value, str) and value.startswith(COMPRESSED_PREFIX)
+
+
+def compress(value: Optional[str]) -> Optional[str]:
+    """压缩文本，内容过小或压缩后没有变小时返回原文"""
+    if value is None or is_compressed(value):
+        return value
+    raw = value.encode('utf-8')
+    if len(raw) < COMPRESS_MIN_BYTES:
+        return value
+    packed = COMPRESSED_PREFIX + base64.b64encode(zlib.compress(raw, COMPRESS_LEVEL)).decode('ascii')
+    return packed if len(packed) < len(raw) else value
+
+
+def decompress(value: Optional[str]) -> Optional[str]:
+    """解压文本，未压缩的内容原样返回"""
+    if not is_compressed(value):
+        return value
+    return zlib.decompress(base64.b64decode(value[len(COMPRESSED_PREFIX):])).decode('utf-8')
+
+
+class CompressedText(TypeDecorator):
+    """写入时压缩、读取时解压的Text列"""
+
+    impl = Text
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        return compress(value)
+
+    def process_result_value(self, value, dialect):
+        return decompress(value)
+
+
+def _raw(column):
+    """以原始文本读取列，绕过自动解压"""
+    return cast(column, Text)
+
+
+def compress_column(session, column, pk_column, batch_size: int = 500) -> Dict[str, int]:
+    """按主键分批压缩某列中尚未压缩的旧数据，返回处理统计"""
+    column = column.expression
+    table = column.table
+    summary = {'scanned': 0, 'compressed': 0, 'bytes_before': 0, 'bytes_after': 0}
+    extra_values = {}
+    # 回填不应改变记录的更新时间
+    if 'updated_at' in table.c:
+        extra_values['updated_at'] = table.c.updated_at
+
+    last_key = None
+    started = time.monotonic()
+    while True:
+        query = select(pk_column, _raw(column)).where(
+            column.isnot(None),
+            func.length(column) >= COMPRESS_MIN_BYTES,
+            ~_raw(column).startswith(COMPRESSED_PREFIX)
+        )
+        if last_key is not None:
+            query = query.where(pk_column > last_key)
+        rows = session.execute(query.order_by(pk_column).limit(batch_size)).all()
+        if not rows:
+            break
+
+        for key, value in rows:
+            summary['scanned'] += 1
+            packed = compress(value)
+            if packed == value:
+                continue
+            session.execute(
+                table.update()
+                .where(pk_column == key)
+                .values({column.name: value, **extra_values})
+            )
+            summary['compressed'] += 1
+            summary['bytes_before'] += len(value.encode('utf-8'))
+            summary['bytes_after'] += len(packed)
+
+        session.commit()
+        last_key = rows[-1][0]
+
+    summary['elapsed_seconds'] = round(time.monotonic() - started, 2)
+    return summary
+
+
+def column_space(session, column, batch_size: int = 1000) -> Dict[str, int]:
+    """统计某列的实际存储大小和解压后的大小"""
+    report = {'rows': 0, 'compressed_rows': 0, 'stored_bytes': 0, 'logical_bytes': 0}
+    rows = session.execute(
+        select(_raw(column)).where(column.isnot(None)).execution_options(yield_per=batch_size)
+    ).scalars()
+    for value in rows:
+        stored = len(value.encode('utf-8'))
+        report['rows'] += 1
+        report['stored_bytes'] += stored
+        if is_compressed(value):
+            report['compressed_rows'] += 1
+            report['logical_bytes'] += len(decompress(value).encode('utf-8'))
+        else:
+            report['logical_bytes'] += stored
+    report['saved_bytes'] = report['logical_bytes'] - report['stored_bytes']
+    return report
@@ -0,0 +1,160 @@
+# deadline.py
+"""
+任务截止时间和对冲请求
+
+每个任务开始处理时得到一个端到端的截止时间，各阶段在此基础上再按阶段预算限时：
+阶段可用时间 = min(阶段预算, 任务剩余时间)。超时后停止等待并抛出 DeadlineExceeded，
+同时把同样的超时传给HTTP客户端，使底层请求也被取消。
+
+文本类调用可以开启对冲：调用耗时超过历史延迟的某个百分位时再发一个备份请求，
+先返回的结果生效。
+"""
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Callable, Dict, Optional
+
+from task_timeline import percentile
+
+TASK_DEADLINE_SECONDS = float(os.getenv('TASK_DEADLINE_SECONDS', 900))
+
+# 各阶段的预算上限（秒）
+STAGE_BUDGETS = {
+    'analysis': float(os.getenv('ANALYSIS_BUDGET_SECONDS', 90)),
+    'description': float(os.getenv('DESCRIPTION_BUDGET_SECONDS', 30)),
+    'lyrics': float(os.getenv('LYRICS_BUDGET_SECONDS', 45)),
+    'suno_submit': float(os.getenv('SUNO_SUBMIT_BUDGET_SECONDS', 30)),
+    'suno_poll': float(os.getenv('SUNO_POLL_BUDGET_SECONDS', 30)),
+}
+
+# 对冲请求配置（默认关闭）
+HEDGE_ENABLED = os.getenv('HEDGE_ENABLED', 'false').lower() == 'true'
+HEDGE_PERCENTILE = float(os.getenv('HEDGE_PERCENTILE', 95))
+HEDGE_MIN_SAMPLES = int(os.getenv('HEDGE_MIN_SAMPLES', 20))
+CALL_WORKERS = int(os.getenv('UPSTREAM_CALL_WORKERS', 16))
+
+
+class DeadlineExceeded(Exception):
+    """任务或阶段超出时间预算"""
+
+    def __init__(self, stage: str, budget: float):
+        super().__init__(f"Deadline exceeded during {stage} (budget {budget:.1f}s)")
+        self.stage = stage
+        self.budget = budget
+
+
+class Deadline:
+    """任务的端到端截止时间"""
+
+    def __init__(self, seconds: float = TASK_DEADLINE_SECONDS):
+        self.seconds = seconds
+        self.expires_at = time.monotonic() + seconds
+
+    def remaining(self) -> float:
+        return self.expires_at - time.monotonic()
+
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+    def budget(self, stage: str) -> float:
+        """某阶段可用的时间（秒），任务已超时时抛出DeadlineExceeded"""
+        remaining = self.remaining()
+        if remaining <= 0:
+            raise DeadlineExceeded(stage, 0.0)
+        return min(STAGE_BUDGETS.get(stage, remaining), remaining)
+
+
+def stage_budget(deadline: Optional[Deadline], stage: str) -> float:
+    """没有任务截止时间时使用阶段预算上限"""
+    return deadline.budget(stage) if deadline else STAGE_BUDGETS[stage]
+
+
+class LatencyTracker:
+    """记录各阶段最近的调用耗时，用于计算对冲阈值"""
+
+    def __init__(self, size: int = 200):
+        self.size = size
+        self._samples: Dict[str, deque] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, stage: str, seconds: float):
+        with self._lock:
+            self._samples.setdefault(stage, deque(maxlen=self.size)).append(seconds)
+
+    def threshold(self, stage: str, p: float = HEDGE_PERCENTILE) -> Optional[float]:
+        """样本不足时返回None（不对冲）"""
+        with self._lock:
+            samples = list(self._samples.get(stage, ()))
+        if len(samples) < HEDGE_MIN_SAMPLES:
+            return None
+        return percentile(samples, p)
+
+
+latencies = LatencyTracker()
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    """上游调用线程池（首次使用时创建）"""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=CALL_WORKERS, thread_name_prefix='upstream-call')
+        return _executor
+
+
+def call_with_deadline(stage: str, func: Callable, timeout: float, hedge: bool = False,
+                       on_hedge: Optional[Callable[[str], None]] = None):
+    """
+    在限定时间内执行一次上游调用，超时抛出DeadlineExceeded。
+    线程池中排队的时间不计入预算，从调用开始执行时计时（与传给HTTP客户端的超时一致）；
+    排队超过一个预算仍未开始时同样抛出DeadlineExceeded。
+    hedge=True 且调用超过历史延迟百分位时发出一个备份请求，返回先成功的结果；
+    on_hedge 在备份请求发出（'fired'）和备份请求胜出（'won'）时被调用。
+    """
+    executor = _get_executor()
+    call_started = threading.Event()
+
+    def run():
+        call_started.set()
+        return func()
+
+    primary = executor.submit(run)
+    if not call_started.wait(timeout):
+        primary.cancel()
+        raise DeadlineExceeded(stage, timeout)
+    started = time.monotonic()
+    pending = {primary}
+
+    hedge_after = latencies.threshold(stage) if hedge and HEDGE_ENABLED else None
+    if hedge_after is not None and hedge_after < timeout:
+        done, _ = wait(pending, timeout=hedge_after)
+        if not done:
+            pending.add(executor.submit(run))
+            if on_hedge:
+                on_hedge('fired')
+
+    error = None
+    while pending:
+        remaining = timeout - (time.monotonic() - started)
+        if remaining <= 0:
+            break
+        done, pending = wait(pending, timeout=remaining, return_when=FIRST_COMPLETED)
+        for future in done:
+            try:
+                result = future.result()
+            except Exception as e:
+                error = e
+                continue
+            latencies.observe(stage, time.monotonic() - started)
+            if future is not primary and on_hedge:
+                on_hedge('won')
+            return result
+
+    if error is not None and not pending:
+        raise error
+    raise DeadlineExceeded(stage, timeout)
@@ -0,0 +1,169 @@
+# geo_index.py
+"""
+基于geohash的坐标空间索引工具
+
+任务表中保存每个任务坐标的geohash，附近查询时先用geohash前缀
+（中心格子 + 8个相邻格子）在索引上做范围扫描，再用球面距离精确过滤。
+"""
+import math
+from typing import List, Optional, Tuple
+
+GEOHASH_BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+GEOHASH_PRECISION = 9  # 约 4.8m x 4.8m
+
+EARTH_RADIUS_METERS = 6371008.8
+
+# 各精度下geohash格子在赤道处的近似尺寸（宽, 高，单位米），用于根据查询半径选择前缀长度
+_CELL_SIZE_METERS = {
+    1: (5009400, 4992600),
+    2: (1252300, 624100),
+    3: (156500, 156000),
+    4: (39100, 19500),
+    5: (4890, 4890),
+    6: (1220, 610),
+    7: (153, 153),
+    8: (38.2, 19.1),
+    9: (4.8, 4.8),
+}
+
+_NEIGHBOR_OFFSETS = [(-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, -1), (1, 0), (1, 1)]
+
+
+def encode(latitude: float, longitude: float, precision: int = GEOHASH_PRECISION) -> str:
+    """将经纬度编码为geohash字符串"""
+    lat_range = [-90.0, 90.0]
+    lon_range = [-180.0, 180.0]
+    chars = []
+    bits = 0
+    bit_count = 0
+    even = True
+
+    while len(chars) < precision:
+        if even:
+            mid = (lon_range[0] + lon_range[1]) / 2
+            if longitude >= mid:
+                bits = (bits << 1) | 1
+                lon_range[0] = mid
+            else:
+                bits <<= 1
+                lon_range[1] = mid
+        else:
+            mid = (lat_range[0] + lat_range[1]) / 2
+            if latitude >= mid:
+                bits = (bits << 1) | 1
+                lat_range[0] = mid
+            else:
+                bits <<= 1
+                lat_range[1] = mid
+        even = not even
+        bit_count += 1
+
+        if bit_count == 5:
+            chars.append(GEOHASH_BASE32[bits])
+            bits = 0
+            bit_count = 0
+
+    return ''.join(chars)
+
+
+def decode_bounds(geohash: str) -> Tuple[float, float, float, float]:
+    """返回geohash格子的边界 (min_lat, max_lat, min_lon, max_lon)"""
+    lat_range = [-90.0, 90.0]
+    lon_range = [-180.0, 180.0]
+    even = True
+
+    for char in geohash:
+        value = GEOHASH_BASE32.index(char)
+        for shift in range(4, -1, -1):
+            bit = (value >> shift) & 1
+            target = lon_range if even else lat_range
+            mid = (target[0] + target[1]) / 2
+            if bit:
+                target[0] = mid
+            else:
+                target[1] = mid
+            even = not even
+
+    return lat_range[0], lat_range[1], lon_range[0], lon_range[1]
+
+
+def neighbors(geohash: str) -> List[str]:
+    """返回相邻的8个同精度格子"""
+    min_lat, max_lat, min_lon, max_lon = decode_bounds(geohash)
+    lat_step = max_lat - min_lat
+    lon_step = max_lon - min_lon
+    center_lat = (min_lat + max_lat) / 2
+    center_lon = (min_lon + max_lon) / 2
+
+    result = []
+    for d_lat, d_lon in _NEIGHBOR_OFFSETS:
+        lat = center_lat + d_lat * lat_step
+        if lat > 90 or lat < -90:
+            continue
+        lon = center_lon + d_lon * lon_step
+        # 经度跨越±180时回绕
+        lon = (lon + 180) % 360 - 180
+        cell = encode(lat, lon, len(geohash))
+        if cell != geohash and cell not in result:
+            result.append(cell)
+    return result
+
+
+def precision_for_radius(radius_meters: float, latitude: float = 0.0) -> int:
+    """选择格子边长不小于查询半径的最大精度，保证中心格子+邻居覆盖整个圆"""
+    # 格子宽度随纬度按cos收缩
+    lon_scale = max(math.cos(math.radians(latitude)), 1e-6)
+    for precision in range(GEOHASH_PRECISION, 0, -1):
+        width, height = _CELL_SIZE_METERS[precision]
+        if min(width * lon_scale, height) >= radius_meters:
+            return precision
+    return 1
+
+
+def cover_cells(latitude: float, longitude: float, radius_meters: float) -> List[str]:
+    """返回覆盖以给定坐标为圆心、给定半径的圆的geohash前缀列表"""
+    precision = precision_for_radius(radius_meters, latitude)
+    center = encode(latitude, longitude, precision)
+    return [center] + neighbors(center)
+
+
+def prefix_range(prefix: str) -> Tuple[str, Optional[str]]:
+    """
+    将geohash前缀转换为可走索引的字符串区间 [low, high)，前缀全为'z'时high为None（无上界）。
+    上界由前缀的最后一个可进位字符在base32字母表中加一得到，区间两端都只含 [0-9a-z]，
+    在字节序和常见的语言排序规则（如en_US.utf8）下顺序一致。
+    """
+    chars = list(prefix)
+    while chars:
+        position = GEOHASH_BASE32.index(chars[-1])
+        if position + 1 < len(GEOHASH_BASE32):
+            chars[-1] = GEOHASH_BASE32[position + 1]
+            return prefix, ''.join(chars)
+        chars.pop()
+    return prefix, None
+
+
+def haversine_meters(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    """计算两点间的球面距离（米）"""
+    phi1 = math.radians(lat1)
+    phi2 = math.radians(lat2)
+    d_phi = math.radians(lat2 - lat1)
+    d_lambda = math.radians(lon2 - lon1)
+    a = math.sin(d_phi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(d_lambda / 2) ** 2
+    return 2 * EARTH_RADIUS_METERS * math.asin(math.sqrt(a))
+
+
+def parse_coordinates(latitude, longitude) -> Optional[Tuple[float, float]]:
+    """校验并解析经纬度，无效时返回None"""
+    if latitude is None or longitude is None:
+        return None
+    try:
+        lat = float(latitude)
+        lon = float(longitude)
+    except (TypeError, ValueError):
+        return None
+    if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+        return None
+    if math.isnan(lat) or math.isnan(lon):
+        return None
+    return lat, lon
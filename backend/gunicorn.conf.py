@@ -0,0 +1,54 @@
+# gunicorn.conf.py
+"""
+gunicorn配置
+"""
+import os
+import shutil
+import subprocess
+import sys
+
+bind = f"0.0.0.0:{os.getenv('PORT', 5000)}"
+workers = int(os.getenv('GUNICORN_WORKERS', 4))
+timeout = int(os.getenv('GUNICORN_TIMEOUT', 120))
+# 线程worker：长轮询（/api/task-status?wait=）和流式导出各占一个线程，不会阻塞整个worker；
+# 心跳由worker主循环发送，超过timeout的长请求也不会被杀掉
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'gthread')
+threads = int(os.getenv('GUNICORN_THREADS', 8))
+# 主进程导入一次应用，worker直接fork（共享已导入模块的内存，启动更快）
+preload_app = os.getenv('GUNICORN_PRELOAD', 'true').lower() == 'true'
+
+# 以下在主进程读取配置时执行，早于预加载导入应用，不依赖各个hook的调用顺序。
+# HUP重新加载时配置文件会再次执行：数据库升级是幂等的，指标目录每个主进程只清空一次。
+
+# 清空多进程指标目录，避免残留上次运行的数据（目录不存在时创建，导入metrics前必须存在）
+_multiproc_dir = os.getenv('PROMETHEUS_MULTIPROC_DIR')
+if _multiproc_dir and os.environ.get('TUNEMAP_MULTIPROC_CLEARED_BY') != str(os.getpid()):
+    shutil.rmtree(_multiproc_dir, ignore_errors=True)
+    os.makedirs(_multiproc_dir, exist_ok=True)
+    os.environ['TUNEMAP_MULTIPROC_CLEARED_BY'] = str(os.getpid())
+
+
+def _prepare_database():
+    """在独立进程中创建和升级数据库表，预加载与否都只由主进程执行一次，worker之间没有并发DDL"""
+    env = dict(os.environ)
+    env.pop('PROMETHEUS_MULTIPROC_DIR', None)  # 该进程的指标不计入服务的指标
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'setup_database.py')
+    subprocess.run([sys.executable, script, 'upgrade'], env=env, check=True)
+
+
+_prepare_database()
+
+
+def post_fork(server, worker):
+    """
+    worker启动时重新初始化日志线程和数据库连接池（预加载时继承自主进程），
+    并接管已退出worker留下的pending任务
+    """
+    from app import init_worker
+    init_worker()
+
+
+def child_exit(server, worker):
+    """worker退出时清理其实时指标"""
+    from metrics import mark_process_dead
+    mark_process_dead(worker.pid)
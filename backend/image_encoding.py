@@ -0,0 +1,128 @@
+# image_encoding.py
+"""
+视觉模型调用前的图片编码
+
+把上传的图片预先编码成模型实际使用的分辨率（Gemini按768px分块处理图片，
+更大的分辨率只会增加上传字节数和延迟），并限制单次请求的图片总字节数：
+超出上限时先降低质量，再缩小尺寸，直到满足上限或达到最低值。
+"""
+import io
+import os
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+from PIL import Image, ImageOps
+
+VISION_IMAGE_MAX_SIDE = int(os.getenv('VISION_IMAGE_MAX_SIDE', 768))
+VISION_IMAGE_FORMAT = os.getenv('VISION_IMAGE_FORMAT', 'JPEG').upper()  # JPEG 或 WEBP
+VISION_IMAGE_QUALITY = int(os.getenv('VISION_IMAGE_QUALITY', 80))
+VISION_PAYLOAD_MAX_BYTES = int(os.getenv('VISION_PAYLOAD_MAX_KB', 1024)) * 1024
+
+MIN_QUALITY = 50
+MIN_SIDE = 384
+QUALITY_STEP = 15
+SIDE_SCALE = 0.75
+
+MIME_TYPES = {'JPEG': 'image/jpeg', 'WEBP': 'image/webp'}
+
+
+@dataclass
+class EncodedImage:
+    """编码后的图片字节及尺寸信息"""
+    path: str
+    data: bytes
+    mime_type: str
+    width: int
+    height: int
+    source_bytes: int
+
+
+def _load_rgb(path: str, max_side: int) -> Image.Image:
+    """读取图片并转为RGB，按EXIF方向旋转，缩放到不超过max_side"""
+    with Image.open(path) as source:
+        # JPEG可以在解码阶段直接降采样
+        source.draft('RGB', (max_side, max_side))
+        img = ImageOps.exif_transpose(source)
+        img.load()
+
+    if img.mode in ('RGBA', 'LA', 'P'):
+        img = img.convert('RGBA')
+        background = Image.new('RGB', img.size, (255, 255, 255))
+        background.paste(img, mask=img.split()[-1])
+        img = background
+    elif img.mode != 'RGB':
+        img = img.convert('RGB')
+
+    if max(img.size) > max_side:
+        img.thumbnail((max_side, max_side), Image.Resampling.LANCZOS)
+    return img
+
+
+def _encode(img: Image.Image, fmt: str, quality: int) -> bytes:
+    buffer = io.BytesIO()
+    if fmt == 'WEBP':
+        img.save(buffer, format='WEBP', quality=quality, method=4)
+    else:
+        img.save(buffer, format='JPEG', quality=quality, optimize=True)
+    return buffer.getvalue()
+
+
+def encode_image(path: str, max_side: int = VISION_IMAGE_MAX_SIDE, fmt: str = VISION_IMAGE_FORMAT,
+                 quality: int = VISION_IMAGE_QUALITY) -> EncodedImage:
+    """把单张图片编码为指定尺寸和格式"""
+    fmt = fmt if fmt in MIME_TYPES else 'JPEG'
+    img = _load_rgb(path, max_side)
+    return EncodedImage(
+        path=path,
+        data=_encode(img, fmt, quality),
+        mime_type=MIME_TYPES[fmt],
+        width=img.width,
+        height=img.height,
+        source_bytes=os.path.getsize(path)
+    )
+
+
+def encode_images(paths: List[str], max_bytes: int = VISION_PAYLOAD_MAX_BYTES,
+                  max_side: int = VISION_IMAGE_MAX_SIDE, fmt: str = VISION_IMAGE_FORMAT,
+                  quality: int = VISION_IMAGE_QUALITY, on_error=None) -> List[EncodedImage]:
+    """
+    编码一组图片，总字节数超过max_bytes时逐步降低质量和尺寸后重新编码。
+    无法读取的图片会被跳过（on_error(path, exc) 可用于记录）。
+    """
+    def encode_all(side, q):
+        encoded = []
+        for path in paths:
+            try:
+                encoded.append(encode_image(path, side, fmt, q))
+            except Exception as e:
+                if on_error:
+                    on_error(path, e)
+        return encoded
+
+    encoded = encode_all(max_side, quality)
+    while encoded and payload_bytes(encoded) > max_bytes:
+        if quality - QUALITY_STEP >= MIN_QUALITY:
+            quality -= QUALITY_STEP
+        elif int(max_side * SIDE_SCALE) >= MIN_SIDE:
+            max_side = int(max_side * SIDE_SCALE)
+        else:
+            break
+        # 重新编码时不再重复报告读取失败的图片
+        paths = [image.path for image in encoded]
+        encoded = encode_all(max_side, quality)
+    return encoded
+
+
+def payload_bytes(images: List[EncodedImage]) -> int:
+    return sum(len(image.data) for image in images)
+
+
+def payload_report(images: List[EncodedImage], max_bytes: Optional[int] = VISION_PAYLOAD_MAX_BYTES) -> Dict:
+    """图片负载大小统计（用于日志和指标）"""
+    return {
+        'images': len(images),
+        'source_bytes': sum(image.source_bytes for image in images),
+        'payload_bytes': payload_bytes(images),
+        'max_bytes': max_bytes,
+        'sizes': [f"{image.width}x{image.height}" for image in images]
+    }
@@ -0,0 +1,126 @@
+# image_selection.py
+"""
+多图任务的代表图片选择
+
+客户端可能提交大量几乎相同的街景帧。这里用感知哈希（dHash）和颜色直方图
+把相似图片聚成一组，每组只保留第一张，再从各组代表中选出最多N张差异最大的图片，
+其余图片不再发送给视觉模型。
+"""
+import os
+from dataclasses import dataclass, field
+from typing import List, Optional, Tuple
+
+from PIL import Image
+
+MAX_ANALYSIS_IMAGES = int(os.getenv('MAX_ANALYSIS_IMAGES', 4))
+HASH_DISTANCE_THRESHOLD = int(os.getenv('IMAGE_HASH_DISTANCE', 10))  # 64位dHash的汉明距离
+HISTOGRAM_DISTANCE_THRESHOLD = float(os.getenv('IMAGE_HISTOGRAM_DISTANCE', 0.25))
+
+HISTOGRAM_BINS = 4  # 每个颜色通道的分桶数
+
+
+@dataclass
+class ImageSignature:
+    path: str
+    dhash: int
+    histogram: Tuple[float, ...]
+
+
+@dataclass
+class Selection:
+    """选择结果：选中的图片，以及因重复或超出数量被丢弃的图片"""
+    selected: List[str]
+    duplicates: List[str] = field(default_factory=list)
+    over_limit: List[str] = field(default_factory=list)
+    unreadable: List[str] = field(default_factory=list)
+
+    @property
+    def dropped(self) -> int:
+        return len(self.duplicates) + len(self.over_limit)
+
+
+def signature(path: str) -> ImageSignature:
+    """计算图片的dHash和归一化颜色直方图"""
+    with Image.open(path) as img:
+        img.draft('RGB', (64, 64))
+        rgb = img.convert('RGB')
+
+    gray = rgb.convert('L').resize((9, 8), Image.Resampling.BILINEAR)
+    pixels = list(gray.getdata())
+    dhash = 0
+    for row in range(8):
+        for col in range(8):
+            left = pixels[row * 9 + col]
+            right = pixels[row * 9 + col + 1]
+            dhash = (dhash << 1) | (1 if left > right else 0)
+
+    small = rgb.resize((32, 32), Image.Resampling.BILINEAR)
+    step = 256 // HISTOGRAM_BINS
+    counts = [0] * HISTOGRAM_BINS ** 3
+    for r, g, b in small.getdata():
+        counts[(r // step) * HISTOGRAM_BINS ** 2 + (g // step) * HISTOGRAM_BINS + b // step] += 1
+    total = float(sum(counts))
+    return ImageSignature(path, dhash, tuple(count / total for count in counts))
+
+
+def hash_distance(a: ImageSignature, b: ImageSignature) -> int:
+    return bin(a.dhash ^ b.dhash).count('1')
+
+
+def histogram_distance(a: ImageSignature, b: ImageSignature) -> float:
+    """1 - 直方图交集，0表示颜色分布相同"""
+    return 1.0 - sum(min(x, y) for x, y in zip(a.histogram, b.histogram))
+
+
+def distance(a: ImageSignature, b: ImageSignature) -> float:
+    """结构和颜色的综合差异（0~1）"""
+    return (hash_distance(a, b) / 64.0 + histogram_distance(a, b)) / 2
+
+
+def is_duplicate(a: ImageSignature, b: ImageSignature) -> bool:
+    return (hash_distance(a, b) <= HASH_DISTANCE_THRESHOLD
+            and histogram_distance(a, b) <= HISTOGRAM_DISTANCE_THRESHOLD)
+
+
+def select_representatives(paths: List[str], limit: Optional[int] = None) -> Selection:
+    """
+    聚类去重后选出最多limit张差异最大的图片（保持提交顺序）。
+    无法读取的图片不会被选中，单独列在unreadable中。
+    """
+    limit = limit or MAX_ANALYSIS_IMAGES
+    if len(paths) <= 1:
+        return Selection(selected=list(paths))
+
+    representatives: List[ImageSignature] = []
+    unreadable: List[str] = []
+    duplicates: List[str] = []
+    seen = set()
+    for path in paths:
+        if path in seen:
+            duplicates.append(path)
+            continue
+        seen.add(path)
+        try:
+            sig = signature(path)
+        except Exception:
+            unreadable.append(path)
+            continue
+        if any(is_duplicate(sig, rep) for rep in representatives):
+            duplicates.append(path)
+        else:
+            representatives.append(sig)
+
+    # 最远点采样：从第一张开始，每次选与已选图片差异最大的一张
+    chosen = representatives[:1]
+    remaining = representatives[1:]
+    while remaining and len(chosen) < limit:
+        best = max(remaining, key=lambda sig: min(distance(sig, other) for other in chosen))
+        chosen.append(best)
+        remaining.remove(best)
+
+    return Selection(
+        selected=[sig.path for sig in sorted(chosen, key=lambda sig: paths.index(sig.path))],
+        duplicates=duplicates,
+        over_limit=[sig.path for sig in remaining],
+        unreadable=unreadable
+    )
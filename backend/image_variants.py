@@ -0,0 +1,78 @@
+# image_variants.py
+"""
+上传图片的缩略图/尺寸变体
+
+只提供固定的几种宽度，变体在第一次请求时生成并缓存在磁盘上，
+之后直接返回缓存文件。上传文件名是唯一且不可变的，因此变体也不会失效。
+"""
+import os
+import uuid
+from typing import Optional
+
+from PIL import Image
+
+VARIANT_WIDTHS = (160, 320, 640, 1280)
+VARIANT_QUALITY = 80
+VARIANT_FOLDER_NAME = 'variants'
+
+
+def pick_width(requested: int) -> int:
+    """选择不小于请求宽度的最小固定尺寸，超过最大尺寸时使用最大尺寸"""
+    for width in VARIANT_WIDTHS:
+        if width >= requested:
+            return width
+    return VARIANT_WIDTHS[-1]
+
+
+def variant_path(variant_dir: str, filename: str, width: int) -> str:
+    """变体文件路径，统一编码为JPEG"""
+    name, _ = os.path.splitext(filename)
+    return os.path.join(variant_dir, f"{name}_w{width}.jpg")
+
+
+def get_or_create_variant(source_path: str, variant_dir: str, width: int) -> Optional[str]:
+    """返回指定宽度的变体路径，不存在时生成"""
+    path = variant_path(variant_dir, os.path.basename(source_path), width)
+    if os.path.exists(path):
+        return path
+
+    if not os.path.exists(source_path):
+        return None
+
+    os.makedirs(variant_dir, exist_ok=True)
+
+    with Image.open(source_path) as img:
+        # JPEG可以在解码阶段直接降采样，避免解码整张大图
+        img.draft('RGB', (width, width))
+
+        if img.mode in ('RGBA', 'LA', 'P'):
+            img = img.convert('RGBA')
+            background = Image.new('RGB', img.size, (255, 255, 255))
+            background.paste(img, mask=img.split()[-1])
+            img = background
+        elif img.mode != 'RGB':
+            img = img.convert('RGB')
+
+        if img.width > width:
+            height = max(1, round(img.height * width / img.width))
+            img = img.resize((width, height), Image.Resampling.LANCZOS)
+
+        # 先写临时文件再原子替换，避免并发请求读到不完整的文件
+        temp_path = f"{path}.{uuid.uuid4().hex[:8]}.tmp"
+        try:
+            img.save(temp_path, format='JPEG', quality=VARIANT_QUALITY, optimize=True, progressive=True)
+            os.replace(temp_path, path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    return path
+
+
+def remove_variants(variant_dir: str, filename: str):
+    """删除某个上传图片的所有变体"""
+    for width in VARIANT_WIDTHS:
+        try:
+            os.remove(variant_path(variant_dir, filename, width))
+        except OSError:
+            pass
@@ -0,0 +1,166 @@
+# log_config.py
+"""
+结构化日志
+
+所有日志以JSON行格式输出。业务线程只把日志记录放入内存队列，
+由后台线程负责格式化和写入stdout，避免gunicorn worker线程阻塞在管道I/O上。
+超长字段会被截断；带 sample_key 的重复日志（如轮询结果）按比例采样。
+"""
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+from collections import OrderedDict
+from datetime import datetime
+
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_MAX_FIELD_CHARS = int(os.getenv('LOG_MAX_FIELD_CHARS', 500))
+LOG_SAMPLE_EVERY = int(os.getenv('LOG_SAMPLE_EVERY', 5))  # 每个sample_key每N条输出1条
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', 10000))
+
+ROOT_LOGGER_NAME = 'tunemap'
+
+# LogRecord自带的属性，其余属性视为通过extra传入的结构化字段
+_RESERVED_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+
+def truncate(value, limit=None):
+    """截断过长的字符串，保留长度信息"""
+    limit = limit or LOG_MAX_FIELD_CHARS
+    if isinstance(value, str) and len(value) > limit:
+        return f"{value[:limit]}...(+{len(value) - limit} chars)"
+    return value
+
+
+class JsonFormatter(logging.Formatter):
+    """把日志记录格式化为一行JSON"""
+
+    def format(self, record):
+        entry = {
+            'ts': datetime.utcfromtimestamp(record.created).isoformat(timespec='milliseconds') + 'Z',
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RESERVED_ATTRS and key != 'sample_key' and not key.startswith('_'):
+                entry[key] = value
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class TruncateFilter(logging.Filter):
+    """截断消息和结构化字段中的超长内容"""
+
+    def filter(self, record):
+        if record.args:
+            record.msg = record.getMessage()
+            record.args = None
+        record.msg = truncate(str(record.msg))
+        for key, value in list(record.__dict__.items()):
+            if key in _RESERVED_ATTRS or key.startswith('_'):
+                continue
+            if isinstance(value, (dict, list)):
+                value = json.dumps(value, ensure_ascii=False, default=str)
+            record.__dict__[key] = truncate(value)
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """对带 sample_key 的重复日志采样：每个key的第1条以及之后每N条输出一次"""
+
+    def __init__(self, every, max_keys=10000):
+        super().__init__()
+        self.every = max(1, every)
+        self.max_keys = max_keys
+        self._counts = OrderedDict()
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        key = getattr(record, 'sample_key', None)
+        if key is None or record.levelno >= logging.WARNING:
+            return True
+        with self._lock:
+            count = self._counts.pop(key, 0)
+            self._counts[key] = count + 1
+            if len(self._counts) > self.max_keys:
+                self._counts.popitem(last=False)
+        return count % self.every == 0
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """队列满时丢弃日志而不是阻塞调用线程"""
+
+    dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def prepare(self, record):
+        # 格式化在后台线程中完成，这里只复制记录并处理异常信息
+        record = logging.makeLogRecord(record.__dict__)
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+_listener = None
+_listener_pid = None
+_handler = None
+_setup_lock = threading.Lock()
+
+
+def setup_logging(stream=None):
+    """
+    配置tunemap日志（重复调用安全）。
+    fork出的子进程没有父进程的写日志线程，在子进程中再次调用会重新创建队列和线程。
+    """
+    global _listener, _listener_pid, _handler
+    with _setup_lock:
+        if _listener is not None and _listener_pid == os.getpid():
+            return
+        first_setup = _listener_pid is None
+
+        output = logging.StreamHandler(stream or sys.stdout)
+        output.setFormatter(JsonFormatter())
+
+        log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+        _handler = DroppingQueueHandler(log_queue)
+        _handler.addFilter(SamplingFilter(LOG_SAMPLE_EVERY))
+        _handler.addFilter(TruncateFilter())
+
+        logger = logging.getLogger(ROOT_LOGGER_NAME)
+        logger.setLevel(LOG_LEVEL)
+        logger.handlers = [_handler]
+        logger.propagate = False
+
+        _listener = logging.handlers.QueueListener(log_queue, output, respect_handler_level=False)
+        _listener.start()
+        _listener_pid = os.getpid()
+        if first_setup:
+            atexit.register(shutdown_logging)
+
+
+def shutdown_logging():
+    """停止后台写日志线程并输出剩余日志"""
+    global _listener
+    with _setup_lock:
+        if _listener is not None and _listener_pid == os.getpid():
+            _listener.stop()
+        _listener = None
+
+
+def get_logger(name):
+    """获取tunemap命名空间下的logger"""
+    return logging.getLogger(f'{ROOT_LOGGER_NAME}.{name}')
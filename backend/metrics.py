@@ -0,0 +1,164 @@
+# metrics.py
+"""
+Prometheus监控指标
+
+gunicorn多worker部署时需要设置 PROMETHEUS_MULTIPROC_DIR 环境变量（见 gunicorn.conf.py），
+各worker把指标写入该目录下的共享文件，/metrics 接口汇总所有worker的数据。
+"""
+import os
+import threading
+import time
+
+from prometheus_client import (CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram,
+                               generate_latest, multiprocess)
+
+MULTIPROCESS_MODE = bool(os.getenv('PROMETHEUS_MULTIPROC_DIR'))
+# 每个worker刷新线程数指标的间隔（秒）
+THREAD_GAUGE_INTERVAL = float(os.getenv('METRICS_THREAD_GAUGE_INTERVAL', '15'))
+
+# 秒级的外部调用和流水线阶段
+STAGE_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 20, 30, 60, 120, 300)
+# 任务从创建到完成，通常为数分钟
+TASK_BUCKETS = (30, 60, 120, 180, 240, 300, 420, 600, 900, 1200, 1800)
+# 数据库提交和HTTP接口
+FAST_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+STAGE_SECONDS = Histogram(
+    'tunemap_stage_duration_seconds',
+    'Latency of music generation pipeline stages',
+    ['stage'],
+    buckets=STAGE_BUCKETS
+)
+
+TASK_TIME_TO_SUCCESS_SECONDS = Histogram(
+    'tunemap_task_time_to_success_seconds',
+    'Time from task creation until Suno reports SUCCESS',
+    buckets=TASK_BUCKETS
+)
+
+DB_COMMIT_SECONDS = Histogram(
+    'tunemap_db_commit_seconds',
+    'Database commit latency',
+    buckets=FAST_BUCKETS
+)
+
+HTTP_REQUEST_SECONDS = Histogram(
+    'tunemap_http_request_duration_seconds',
+    'HTTP endpoint latency',
+    ['method', 'endpoint', 'status'],
+    buckets=FAST_BUCKETS + (10, 30)
+)
+
+VISION_PAYLOAD_BYTES = Histogram(
+    'tunemap_vision_payload_bytes',
+    'Encoded image bytes sent to Gemini per analysis request',
+    buckets=(32e3, 64e3, 128e3, 256e3, 512e3, 1e6, 2e6, 4e6, 8e6)
+)
+
+PROMPT_TOKENS = Histogram(
+    'tunemap_prompt_tokens',
+    'Estimated prompt size sent to Gemini, in tokens (excluding images)',
+    ['stage'],
+    buckets=(100, 200, 300, 400, 500, 600, 800, 1000, 1500, 2000)
+)
+
+SCHEDULER_WAIT_SECONDS = Histogram(
+    'tunemap_scheduler_wait_seconds',
+    'Time tasks spend queued in the scheduler before processing starts',
+    ['lane'],
+    buckets=STAGE_BUCKETS
+)
+
+ADMISSION_REJECTED = Counter(
+    'tunemap_admission_rejected_total',
+    'Task creation requests rejected with 429 by admission control',
+    ['lane', 'reason']
+)
+
+TASK_CACHE_REQUESTS = Counter(
+    'tunemap_task_cache_requests_total',
+    'Task status and task list reads served from the task cache',
+    ['kind', 'result']
+)
+
+PREWARM_LOOKUPS = Counter(
+    'tunemap_prewarm_lookups_total',
+    'Tasks that found (hit) or did not find (miss) a prewarmed analysis for their location',
+    ['result']
+)
+
+HEDGED_REQUESTS = Counter(
+    'tunemap_hedged_requests_total',
+    'Backup requests fired for slow upstream calls, and how many of them won',
+    ['stage', 'outcome']
+)
+
+DEADLINE_EXCEEDED = Counter(
+    'tunemap_deadline_exceeded_total',
+    'Tasks stopped because a stage ran past its deadline budget',
+    ['stage']
+)
+
+DEDUPLICATED_REQUESTS = Counter(
+    'tunemap_task_requests_deduplicated_total',
+    'Task creation requests answered with an existing task instead of a new pipeline',
+    ['reason']
+)
+
+IN_FLIGHT_TASKS = Gauge(
+    'tunemap_tasks_in_flight',
+    'Tasks currently running the analysis/submission pipeline',
+    multiprocess_mode='livesum'
+)
+
+POLLING_TASKS = Gauge(
+    'tunemap_tasks_polling',
+    'Tasks currently being polled for Suno status',
+    multiprocess_mode='livesum'
+)
+
+THREADS = Gauge(
+    'tunemap_threads',
+    'Live Python threads',
+    multiprocess_mode='livesum'
+)
+
+
+def stage_timer(stage: str):
+    """返回统计某个流水线阶段耗时的上下文管理器"""
+    return STAGE_SECONDS.labels(stage=stage).time()
+
+
+def update_thread_gauge():
+    """刷新当前进程的线程数"""
+    THREADS.set(threading.active_count())
+
+
+def start_thread_gauge_updater(interval: float = THREAD_GAUGE_INTERVAL):
+    """
+    启动定时刷新当前进程线程数的后台线程。多worker时 /metrics 只由其中一个worker处理，
+    每个worker都需要在fork之后（init_worker）调用一次，汇总的线程数才包含所有worker。
+    """
+    def run():
+        while True:
+            update_thread_gauge()
+            time.sleep(interval)
+
+    threading.Thread(target=run, name='thread-gauge', daemon=True).start()
+
+
+def render_metrics():
+    """生成Prometheus文本格式的指标，返回 (内容, Content-Type)"""
+    update_thread_gauge()
+    if MULTIPROCESS_MODE:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+def mark_process_dead(pid: int):
+    """worker退出时清理其实时指标（由gunicorn的child_exit钩子调用）"""
+    if MULTIPROCESS_MODE:
+        multiprocess.mark_process_dead(pid)
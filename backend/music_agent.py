@@ -1,22 +1,34 @@
 # music_agent.py
 from dotenv import load_dotenv
-import google.generativeai as genai
-from google import genai as new_genai # 导入新的genai包并重命名以避免冲突
 import requests
 import base64
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Callable
 from dataclasses import dataclass, field
 import json
-from PIL import Image
-import io
 import os
-from dotenv import load_dotenv
+import threading
+import time
+from response_cache import ResponseCache
+import metrics
+from metrics import stage_timer
+import prompt_builder
+import image_encoding
+from deadline import Deadline, DeadlineExceeded, call_with_deadline, stage_budget
+from circuit_breaker import CircuitOpenError, get_breaker
+from log_config import setup_logging, get_logger
 
 # 获取当前文件所在目录
 current_dir = os.path.dirname(os.path.abspath(__file__))
 env_path = os.path.join(current_dir, '.env')
 load_dotenv(env_path)
 
+logger = get_logger('agent')
+
+# 上游调用超过该耗时计为慢调用（秒）
+GEMINI_SLOW_CALL_SECONDS = float(os.getenv('GEMINI_SLOW_CALL_SECONDS', 30))
+SUNO_SLOW_CALL_SECONDS = float(os.getenv('SUNO_SLOW_CALL_SECONDS', 15))
+
+
 @dataclass
 class AgentMemory:
     """Agent's memory storage"""
@@ -28,13 +40,21 @@ class AgentMemory:
 class MusicGenerationAgent:
     """Music Generation AI Agent using a Gemini Vision model"""
     
-    def __init__(self, gemini_api_key: str, suno_api_key: Optional[str] = None):
-        # 使用新的genai.Client来配置
-        self.client = new_genai.Client(api_key=gemini_api_key)
+    def __init__(self, gemini_api_key: str, suno_api_key: Optional[str] = None,
+                 response_cache: Optional[ResponseCache] = None):
+        # genai.Client在第一次调用Gemini时才创建（google.genai导入较慢，见client属性）
+        self.gemini_api_key = gemini_api_key
+        self._client = None
+        self._client_lock = threading.Lock()
         # 选择有图片理解能力的模型，例如 gemini-1.5-flash 或 gemini-1.0-pro-vision
         self.model_name = 'gemini-1.5-flash-latest'
         self.suno_api_key = suno_api_key
         self.memory = AgentMemory()
+        # 文本生成结果缓存（可选），相同分析结果直接复用歌词和风格描述
+        self.response_cache = response_cache
+        # 上游熔断器（Suno的提交和轮询共用一个）
+        self.gemini_breaker = get_breaker('gemini', slow_call_seconds=GEMINI_SLOW_CALL_SECONDS)
+        self.suno_breaker = get_breaker('suno', slow_call_seconds=SUNO_SLOW_CALL_SECONDS)
         
         # Agent's system prompt
         self.system_prompt = """
@@ -47,126 +67,77 @@ class MusicGenerationAgent:
         Please return the analysis results in JSON format.
         """
     
-    def load_and_compress_image(self, image_path: str, max_size: tuple = (1024, 1024), quality: int = 85) -> Image.Image:
-        """Load and compress PIL Image to reduce size"""
-        try:
-            # Load the image
-            img = Image.open(image_path)
-            
-            # Convert to RGB if it's in RGBA or other modes
-            if img.mode in ('RGBA', 'LA', 'P'):
-                # Create a white background for transparent images
-                background = Image.new('RGB', img.size, (255, 255, 255))
-                if img.mode == 'P':
-                    img = img.convert('RGBA')
-                background.paste(img, mask=img.split()[-1] if img.mode == 'RGBA' else None)
-                img = background
-            elif img.mode != 'RGB':
-                img = img.convert('RGB')
-            
-            # Get original size
-            original_size = img.size
-            original_file_size = self._get_file_size(image_path)
-            
-            # Resize if the image is larger than max_size
-            if img.size[0] > max_size[0] or img.size[1] > max_size[1]:
-                img.thumbnail(max_size, Image.Resampling.LANCZOS)
-                print(f"Image resized from {original_size} to {img.size}")
-            
-            # If the image is still potentially large, compress it further
-            if original_file_size > 2 * 1024 * 1024:  # If original file > 2MB
-                # Save to a BytesIO buffer to compress
-                buffer = io.BytesIO()
-                img.save(buffer, format='JPEG', quality=quality, optimize=True)
-                buffer.seek(0)
-                
-                # Load the compressed image back
-                img = Image.open(buffer)
-                compressed_size = len(buffer.getvalue())
-                print(f"Image compressed from {original_file_size/1024/1024:.2f}MB to {compressed_size/1024/1024:.2f}MB")
-            
-            return img
-            
-        except Exception as e:
-            print(f"Error loading/compressing image {image_path}: {e}")
-            return None
-    
-    def _get_file_size(self, file_path: str) -> int:
-        """Get file size in bytes"""
-        try:
-            import os
-            return os.path.getsize(file_path)
-        except:
-            return 0
-    
-    def analyze_images_and_location(self, image_paths: List[str], location: str) -> Dict[str, Any]:
+    @property
+    def client(self):
+        """Gemini client, created (and the SDK imported) on first use"""
+        if self._client is None:
+            with self._client_lock:
+                if self._client is None:
+                    from google import genai
+                    self._client = genai.Client(api_key=self.gemini_api_key)
+        return self._client
+
+    @client.setter
+    def client(self, client):
+        self._client = client
+
+    def _generate_content(self, stage: str, contents, deadline: Optional[Deadline] = None,
+                          hedge: bool = False):
+        """在阶段预算内调用Gemini，超时抛出DeadlineExceeded"""
+        timeout = stage_budget(deadline, stage)
+        # 同样的超时传给HTTP客户端，超时后底层请求也会被取消
+        config = {'http_options': {'timeout': int(timeout * 1000)}}
+
+        def call():
+            return self.client.models.generate_content(
+                model=self.model_name,
+                contents=contents,
+                config=config
+            )
+
+        def on_hedge(outcome):
+            metrics.HEDGED_REQUESTS.labels(stage=stage, outcome=outcome).inc()
+
+        with self.gemini_breaker.guard():
+            return call_with_deadline(stage, call, timeout, hedge=hedge, on_hedge=on_hedge)
+
+    def analyze_images_and_location(self, image_paths: List[str], location: str,
+                                    on_stage: Optional[Callable[[str], None]] = None,
+                                    deadline: Optional[Deadline] = None) -> Dict[str, Any]:
         """Analyze images and geographical location information using the new client method"""
         
-        # Load and compress images
-        images = []
-        for image_path in image_paths:
-            img = self.load_and_compress_image(image_path)
-            if img:
-                images.append(img)
-        
-        if not images:
+        # 预先编码为模型使用的分辨率，并限制总字节数
+        def on_image_error(path, error):
+            logger.error("Error encoding image: %s", error, extra={'path': path})
+
+        with stage_timer('image_encode'):
+            encoded_images = image_encoding.encode_images(image_paths, on_error=on_image_error)
+
+        if not encoded_images:
             return {"error": "No valid images could be loaded"}
-        print("!!!Location:",location)
+        if on_stage:
+            on_stage('images_loaded')
+
+        payload = image_encoding.payload_report(encoded_images)
+        metrics.VISION_PAYLOAD_BYTES.observe(payload['payload_bytes'])
+        logger.info("Encoded images for analysis", extra=dict(payload, location=location))
+        from google.genai import types
+        images = [
+            types.Part.from_bytes(data=image.data, mime_type=image.mime_type)
+            for image in encoded_images
+        ]
         
         # Construct prompt
-        prompt = f"""
-        Please analyze the following geographical location and accompanying image(s), and generate culturally and musically relevant insights.
-
-        Location: {location}
-
-        Please strictly follow the steps below to ensure strong regional identity in your analysis:
-
-        1. **Determine the unique cultural, historical, and emotional characteristics of the location.**  
-        For example:  
-        - "The Great Wall of China" → evokes Chinese imperial history, traditional Chinese aesthetics, heroic and historical atmosphere  
-        - "Milan Cathedral" → associated with Gothic architecture, Christian spirituality, and grand pipe organ music
-
-        2. **Visually analyze the provided image(s)**:  
-        Describe the visual elements (architecture, nature, colors, light) and how they reflect the location’s mood or atmosphere.  
-        **Always clearly state the location name** in your visual analysis.
-
-        3. **Extract cultural and geographical identity**:  
-        Reflect unique elements from the region's art, music, architecture, and customs.
-
-        4. **Recommend a music style that is native or symbolic of the location**.  
-        Do not recommend generic genres. For instance:  
-        - Chinese locations → Chinese traditional music, pentatonic scale, guzheng, erhu  
-        - Gothic European cathedrals → Church organ, Gregorian chant, modal harmony  
-        - South American towns → Andean music, pan flute, charango
-
-        5. **Generate detailed music creation parameters**, deeply rooted in the regional style:
-        - Tempo (in BPM or culturally relevant terms)
-        - Musical key or scale (e.g., pentatonic, Dorian mode, etc.)
-        - Culturally significant instruments (e.g., sitar, shakuhachi, duduk)
-        - Mood and atmosphere consistent with both visuals and cultural background
-
-        Return the result in the following strict JSON format:
-        {{
-            "visual_analysis": "The location is {location}, a place rich in cultural symbolism and emotional depth. The accompanying image supports this with visual cues such as brief visual description, e.g. 'ancient stone walls', 'towering spires', 'mist-covered mountains', but the essence is carried by the historical and geographical weight of {location}. This site conveys a powerful sense of emotional keywords, e.g. grandeur, serenity, isolation, rooted in its iconic status. The imagery further enhances the location’s unique character rather than defining it. The emotional atmosphere is shaped foremost by the cultural resonance of {location}, not just by visual elements.",
-            "cultural_context": "Brief explanation of the cultural, historical, or religious meaning of the location and its musical implications.",
-            "music_style": "Name of the musical genre or tradition that is most authentic to the location.",
-            "mood": "One or two emotional tones (e.g. majestic and solemn, nostalgic and warm, etc.)",
-            "tempo": "Suggested tempo (e.g., 60 BPM slow and reflective, or moderate-fast folk rhythm)",
-            "key": "Musical key or scale (e.g., D Dorian, traditional pentatonic, etc.)",
-            "instruments": ["list", "of", "authentic", "and", "representative", "instruments"],
-            "atmosphere": "Summarized description of the scene's overall emotional and cultural atmosphere."
-        }}
-        """
+        prompt = prompt_builder.build_analysis_prompt(location)
+        metrics.PROMPT_TOKENS.labels(stage='analysis').observe(prompt.tokens)
 
      
         try:
             # Use the new client.models.generate_content method for image analysis
-            # We need to construct the contents list with the prompt and image parts
-            contents = [prompt] + images
-            response = self.client.models.generate_content(
-                model=self.model_name, 
-                contents=contents
-            )
+            # The contents list holds the prompt followed by the pre-encoded image parts
+            contents = [prompt.text] + images
+            with stage_timer('gemini_analysis'):
+                response = self._generate_content('analysis', contents, deadline)
             result_text = response.text
             
             # Try to parse JSON, if failed save raw text
@@ -186,42 +157,46 @@ class MusicGenerationAgent:
             self.memory.extracted_info = parsed_result
             self.memory.conversation_history.append({
                 "step": "analysis",
-                "input": {"images": len(image_paths), "location": location},
+                "input": {"images": len(image_paths), "location": location, "payload_bytes": payload['payload_bytes']},
                 "output": parsed_result
             })
             
             return parsed_result
             
+        except DeadlineExceeded:
+            raise
         except Exception as e:
-            print(f"Error during analysis: {e}")
+            logger.error("Error during analysis: %s", e)
             return {"error": str(e)}
         
-    def generate_lyrics(self, analysis_result: Dict[str, Any]) -> str:
+    def generate_lyrics(self, analysis_result: Dict[str, Any], deadline: Optional[Deadline] = None) -> str:
         """Generate song lyrics based on image and location analysis"""
 
-        prompt = f"""
-        You are a professional lyricist. Based on the analysis result below, write concise, poetic lyrics that reflect the unique identity of the place.
-
-        Requirements:
-        - Structure: 2 short verses and 1 chorus
-        - Use the place name and highlight regional identity
-        - Include phrases in the local language if culturally appropriate
-        - Match the vision, style and mood: {analysis_result.get('visual_analysis', '')}, {analysis_result.get('cultural_context', '')}, {analysis_result.get('music_style', '')}, {analysis_result.get('mood', '')}
-        - Express the emotions and atmosphere from the analysis
-        - Avoid literal image descriptions; focus on tone and cultural feeling
+        prompt = prompt_builder.build_lyrics_prompt(analysis_result)
+        cache_key = None
+        if self.response_cache:
+            cache_key = self.response_cache.make_key(self.model_name, prompt.version, prompt.text)
+            cached_lyrics = self.response_cache.get(cache_key)
+            if cached_lyrics is not None:
+                self.memory.generated_lyrics = cached_lyrics
+                self.memory.conversation_history.append({
+                    "step": "lyric_generation",
+                    "input": analysis_result,
+                    "output": cached_lyrics,
+                    "cached": True
+                })
+                logger.info("Lyrics served from cache")
+                return cached_lyrics
 
-        Analysis:
-        {json.dumps(analysis_result, indent=2)}
-
-        Output only lyrics, no explanations.
-        """
+        metrics.PROMPT_TOKENS.labels(stage='lyrics').observe(prompt.tokens)
 
         try:
-            response = self.client.models.generate_content(
-                model='gemini-1.5-flash-latest',
-                contents=prompt
-            )
+            with stage_timer('gemini_lyrics'):
+                response = self._generate_content('lyrics', prompt.text, deadline, hedge=True)
             lyrics = response.text.strip()
+
+            if cache_key:
+                self.response_cache.set(cache_key, lyrics)
             
             # Store lyrics in memory
             self.memory.generated_lyrics = lyrics
@@ -231,51 +206,49 @@ class MusicGenerationAgent:
                 "output": lyrics
             })
             
-            print("Generated lyrics:\n", lyrics)
+            logger.debug("Generated lyrics", extra={'lyrics': lyrics})
             return lyrics
-            
+
+        except (CircuitOpenError, DeadlineExceeded):
+            raise
         except Exception as e:
-            print(f"Error generating lyrics: {e}")
+            logger.error("Error generating lyrics: %s", e)
             return f"Error generating lyrics: {e}"
     
-    def generate_music_description(self, analysis_result: Dict[str, Any]) -> str:
+    def generate_music_description(self, analysis_result: Dict[str, Any],
+                                   deadline: Optional[Deadline] = None) -> str:
         """Generate music description based on analysis results"""
-        
-        prompt = f"""
-        You are a music production expert. Based on the analysis result below, generate a **concise, regionally distinctive** music style description for Suno AI.
-
-        Analysis Result:
-        {json.dumps(analysis_result, indent=2)}
-
-        Instructions:
-        - Focus on traditional or culturally unique **regional genres, instruments, scales, and moods**
-        - Do **not** use generic styles like "pop", "neo-classical", or "ambient"
-        - Must include:
-        - Specific **regional genre**
-        - Representative **local instruments**
-        - **Tempo** and **energy**
-        - **Key** or **mode** if mentioned or implied
-        - **Atmosphere** tied to the location’s emotion
-        - Limit: **max 200 characters**
-        - Output only the style description, no explanation
-
-        Example format:
-        "Japanese gagaku with sho and koto, slow tempo, pentatonic scale, meditative and sacred mood"
-
-        Now generate one for the input below.
-        """
+
+        prompt = prompt_builder.build_description_prompt(analysis_result)
+        cache_key = None
+        if self.response_cache:
+            cache_key = self.response_cache.make_key(self.model_name, prompt.version, prompt.text)
+            cached_description = self.response_cache.get(cache_key)
+            if cached_description is not None:
+                self.memory.generated_description = cached_description
+                self.memory.conversation_history.append({
+                    "step": "music_description",
+                    "input": analysis_result,
+                    "output": cached_description,
+                    "cached": True
+                })
+                logger.info("Music description served from cache", extra={'description': cached_description})
+                return cached_description
+
+        metrics.PROMPT_TOKENS.labels(stage='description').observe(prompt.tokens)
 
         
         try:
-            response = self.client.models.generate_content(
-                model='gemini-1.5-flash-latest',
-                contents=prompt
-            )
+            with stage_timer('gemini_description'):
+                response = self._generate_content('description', prompt.text, deadline, hedge=True)
             description = response.text.strip()
             
             # Ensure description is within character limit
             if len(description) > 120:
                 description = description[:117] + "..."
+
+            if cache_key:
+                self.response_cache.set(cache_key, description)
             
             self.memory.generated_description = description
             self.memory.conversation_history.append({
@@ -284,16 +257,19 @@ class MusicGenerationAgent:
                 "output": description
             })
             
-            print("Generated music description:", description)
+            logger.info("Generated music description", extra={'description': description})
             return description
-            
+
+        except (CircuitOpenError, DeadlineExceeded):
+            raise
         except Exception as e:
-            print(f"Error generating music description: {e}")
+            logger.error("Error generating music description: %s", e)
             return f"Error: {e}"
     
     def generate_music_with_suno(self, lyrics: str, style_description: str, 
                                 title: str = "AI Generated Song", 
-                                callback_url: str = "https://api.example.com/callback") -> Dict[str, Any]:
+                                callback_url: str = "https://api.example.com/callback",
+                                deadline: Optional[Deadline] = None) -> Dict[str, Any]:
         """Call Suno API to generate music with lyrics and style"""
         
         if not self.suno_api_key:
@@ -324,25 +300,35 @@ class MusicGenerationAgent:
             "Content-Type": "application/json"
         }
         
+        timeout = stage_budget(deadline, 'suno_submit')
+        if not self.suno_breaker.allow():
+            return {"error": f"Suno circuit breaker is open, retry in {self.suno_breaker.retry_in():.0f}s"}
+
+        started = time.monotonic()
         try:
-            print(f"Calling Suno API with:")
-            print(f"Title: {title}")
-            print(f"Style: {style_description}")
-            print(f"Lyrics preview: {lyrics[:100]}...")
+            logger.info("Calling Suno API", extra={
+                'title': title,
+                'style': style_description,
+                'lyrics_preview': lyrics[:100]
+            })
             
-            response = requests.post(suno_endpoint, json=payload, headers=headers)
+            with stage_timer('suno_submit'):
+                response = requests.post(suno_endpoint, json=payload, headers=headers,
+                                         timeout=timeout)
             
-            print("Suno API response status:", response.status_code)
+            logger.info("Suno API response status", extra={'status_code': response.status_code})
+            # 4xx是请求本身的问题，不计入上游故障
+            self.suno_breaker.record(response.status_code < 500, time.monotonic() - started)
             
             if response.status_code == 200:
                 result = response.json()
-                print("Suno API response:", result)
+                logger.debug("Suno API response", extra={'response': result})
             else:
                 result = {
                     "error": f"HTTP {response.status_code}",
                     "message": response.text
                 }
-                print("Suno API error:", result)
+                logger.warning("Suno API error", extra={'response': result})
             
             self.memory.conversation_history.append({
                 "step": "music_generation",
@@ -358,7 +344,8 @@ class MusicGenerationAgent:
             return result
             
         except Exception as e:
-            print(f"Suno API call failed: {e}")
+            self.suno_breaker.record(False, time.monotonic() - started)
+            logger.error("Suno API call failed: %s", e)
             return {"error": str(e)}
     
     def execute_full_pipeline(self, image_paths: List[str], location: str, 
@@ -366,24 +353,24 @@ class MusicGenerationAgent:
                              song_title: str = "AI Generated Song") -> Dict[str, Any]:
         """Execute the complete music generation pipeline"""
         
-        print("Starting music generation pipeline...")
+        logger.info("Starting music generation pipeline")
         
         # Step 1: Analyze images and location
-        print("Step 1: Analyzing images and location...")
+        logger.info("Step 1: Analyzing images and location")
         analysis = self.analyze_images_and_location(image_paths, location)
         
         if "error" in analysis:
             return {"error": "Analysis step failed", "details": analysis}
         
         # Step 2: Generate lyrics
-        print("Step 2: Generating lyrics...")
+        logger.info("Step 2: Generating lyrics")
         lyrics = self.generate_lyrics(analysis)
         
         if "Error" in lyrics:
             return {"error": "Lyrics generation failed", "details": lyrics}
         
         # Step 3: Generate music description
-        print("Step 3: Generating music style description...")
+        logger.info("Step 3: Generating music style description")
         music_description = self.generate_music_description(analysis)
         
         result = {
@@ -399,7 +386,7 @@ class MusicGenerationAgent:
         
         # Step 4: Generate music (optional)
         if generate_music:
-            print("Step 4: Generating music with Suno API...")
+            logger.info("Step 4: Generating music with Suno API")
             music_result = self.generate_music_with_suno(
                 lyrics=lyrics,
                 style_description=music_description,
@@ -407,7 +394,7 @@ class MusicGenerationAgent:
             )
             result["music_generation"] = music_result
         
-        print("Pipeline completed successfully!")
+        logger.info("Pipeline completed successfully")
         return result
     
     def get_agent_memory(self) -> AgentMemory:
@@ -436,12 +423,14 @@ def generate_music_from_images(image_paths: List[str], location: str,
     Returns:
         Dictionary containing the generated music result
     """
-    print(f"Generating music for {len(image_paths)} images at {location}")
+    logger.info("Generating music from images", extra={'images': len(image_paths), 'location': location})
     agent = MusicGenerationAgent(gemini_api_key, suno_api_key)
     return agent.execute_full_pipeline(image_paths, location, generate_music, song_title)
 
 # 示例使用代码
 if __name__ == "__main__":
+    setup_logging()
+
     # 示例配置
     GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
     SUNO_API_KEY = os.getenv("SUNO_API_KEY")
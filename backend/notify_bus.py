@@ -0,0 +1,265 @@
+# notify_bus.py
+"""
+跨worker的任务变更通知
+
+gunicorn的每个worker都会在后台线程中更新任务，其他worker原本只能反复查询数据库才能发现变化。
+任务的状态或进度变化时发布一条通知，所有worker的订阅者（长轮询的等待者、进程内缓存）立即收到：
+- PostgreSQL：在写入任务的同一事务中执行 pg_notify，提交后才投递，回滚时自动丢弃；
+  每个worker用一个独立连接 LISTEN
+- 其他数据库（SQLite）：每个worker在共享目录下绑定一个Unix数据报套接字，
+  提交后向目录中所有套接字发送通知；不支持Unix套接字的平台只在进程内通知
+"""
+import glob
+import json
+import os
+import select
+import socket
+import threading
+import time
+from dataclasses import asdict, dataclass
+from typing import Callable, Dict, List, Optional
+
+from sqlalchemy.engine import make_url
+
+from log_config import get_logger
+
+logger = get_logger('notify_bus')
+
+NOTIFY_CHANNEL = os.getenv('NOTIFY_CHANNEL', 'tunemap_task_changes')
+NOTIFY_SOCKET_DIR = os.getenv('NOTIFY_SOCKET_DIR', os.path.join('cache', 'notify'))
+LISTEN_RECONNECT_SECONDS = 5
+MAX_DATAGRAM_BYTES = 4096
+
+
+@dataclass
+class TaskEvent:
+    """一次任务变更"""
+    task_id: str
+    status: Optional[str]
+    progress: Optional[int]
+    status_changed: bool = True  # False 表示只有进度变化
+    deleted: bool = False
+    pid: int = 0
+
+    def encode(self) -> str:
+        return json.dumps(asdict(self), separators=(',', ':'))
+
+    @classmethod
+    def decode(cls, payload) -> Optional['TaskEvent']:
+        try:
+            return cls(**json.loads(payload))
+        except (TypeError, ValueError):
+            return None
+
+
+class NotificationBus:
+    """
+    进程内分发：订阅者回调和按任务等待。
+    子类负责跨进程传输；transactional=True 的实现在刷新（flush）时随事务发布，
+    否则在提交后发布。
+    """
+    transactional = False
+    backend = 'local'
+
+    def __init__(self):
+        self._subscribers: List[Callable[[TaskEvent], None]] = []
+        self._waiters: Dict[str, List[threading.Event]] = {}
+        self._lock = threading.Lock()
+        self._started = False
+        self.published = 0
+        self.received = 0
+
+    def subscribe(self, callback: Callable[[TaskEvent], None]):
+        """注册回调（在通知线程中调用，应尽快返回）"""
+        with self._lock:
+            self._subscribers.append(callback)
+
+    def ensure_started(self):
+        """启动监听线程（每个进程一次；在fork之后调用）"""
+        if self._started:
+            return
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        self._start_listener()
+
+    def _start_listener(self):
+        pass
+
+    def publish(self, events: List[TaskEvent], connection=None):
+        """发布一组事件；transactional实现需要传入当前事务的连接"""
+        self.published += len(events)
+        for event in events:
+            self.deliver(event)
+
+    def deliver(self, event: TaskEvent):
+        """分发给本进程的订阅者和等待者"""
+        self.received += 1
+        with self._lock:
+            subscribers = list(self._subscribers)
+            waiters = self._waiters.pop(event.task_id, [])
+        for waiter in waiters:
+            waiter.set()
+        for callback in subscribers:
+            try:
+                callback(event)
+            except Exception:
+                logger.exception("Notification subscriber failed", extra={'task_id': event.task_id})
+
+    def watch(self, task_id: str) -> threading.Event:
+        """
+        登记对任务下一次变更的等待，返回的Event在收到通知时被设置。
+        先登记再读取任务状态，避免读取和等待之间的变更被漏掉；用完后调用unwatch。
+        """
+        self.ensure_started()
+        waiter = threading.Event()
+        with self._lock:
+            self._waiters.setdefault(task_id, []).append(waiter)
+        return waiter
+
+    def unwatch(self, task_id: str, waiter: threading.Event):
+        with self._lock:
+            waiters = self._waiters.get(task_id, [])
+            if waiter in waiters:
+                waiters.remove(waiter)
+            if not waiters:
+                self._waiters.pop(task_id, None)
+
+    def wait(self, task_id: str, timeout: float) -> bool:
+        """等待任务的下一次变更，收到通知返回True，超时返回False"""
+        waiter = self.watch(task_id)
+        try:
+            return waiter.wait(timeout)
+        finally:
+            self.unwatch(task_id, waiter)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            waiting = sum(len(waiters) for waiters in self._waiters.values())
+        return {
+            'backend': self.backend,
+            'published': self.published,
+            'received': self.received,
+            'waiting': waiting
+        }
+
+
+class PostgresNotificationBus(NotificationBus):
+    """基于 LISTEN/NOTIFY 的通知（psycopg2驱动）"""
+    transactional = True
+    backend = 'postgres'
+
+    def __init__(self, connect: Callable):
+        super().__init__()
+        self._connect = connect
+
+    def publish(self, events: List[TaskEvent], connection=None):
+        # NOTIFY随事务提交投递，本进程也通过LISTEN收到，这里不直接分发
+        for event in events:
+            connection.exec_driver_sql('SELECT pg_notify(%(channel)s, %(payload)s)',
+                                       {'channel': NOTIFY_CHANNEL, 'payload': event.encode()})
+        self.published += len(events)
+
+    def _start_listener(self):
+        thread = threading.Thread(target=self._listen_forever, name='notify-listener', daemon=True)
+        thread.start()
+
+    def _listen_forever(self):
+        while True:
+            try:
+                self._listen()
+            except Exception:
+                logger.exception("Notification listener disconnected, reconnecting")
+            time.sleep(LISTEN_RECONNECT_SECONDS)
+
+    def _listen(self):
+        connection = self._connect()
+        try:
+            connection.autocommit = True
+            with connection.cursor() as cursor:
+                cursor.execute(f'LISTEN "{NOTIFY_CHANNEL}"')
+            while True:
+                if select.select([connection], [], [], 60) == ([], [], []):
+                    continue
+                connection.poll()
+                while connection.notifies:
+                    event = TaskEvent.decode(connection.notifies.pop(0).payload)
+                    if event:
+                        self.deliver(event)
+        finally:
+            connection.close()
+
+
+class SocketNotificationBus(NotificationBus):
+    """基于共享目录中Unix数据报套接字的通知（单机多worker）"""
+    backend = 'socket'
+
+    def __init__(self, directory: str = NOTIFY_SOCKET_DIR):
+        super().__init__()
+        self.directory = directory
+        self._socket = None
+        self._path = None
+
+    def _start_listener(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self._path = os.path.join(self.directory, f'{os.getpid()}.sock')
+        if os.path.exists(self._path):
+            os.remove(self._path)
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._socket.bind(self._path)
+        thread = threading.Thread(target=self._receive_forever, name='notify-listener', daemon=True)
+        thread.start()
+
+    def _receive_forever(self):
+        pid = os.getpid()
+        while True:
+            try:
+                payload = self._socket.recv(MAX_DATAGRAM_BYTES)
+            except OSError:
+                logger.exception("Notification socket closed")
+                return
+            event = TaskEvent.decode(payload)
+            # 本进程的事件在发布时已直接分发
+            if event and event.pid != pid:
+                self.deliver(event)
+
+    def publish(self, events: List[TaskEvent], connection=None):
+        super().publish(events)
+        own_path = os.path.join(self.directory, f'{os.getpid()}.sock')
+        payloads = [event.encode().encode('utf-8') for event in events]
+        sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sender.setblocking(False)
+        try:
+            for path in glob.glob(os.path.join(self.directory, '*.sock')):
+                if path == own_path:
+                    continue
+                for payload in payloads:
+                    try:
+                        sender.sendto(payload, path)
+                    except (ConnectionRefusedError, FileNotFoundError):
+                        # 已退出的worker留下的套接字文件
+                        self._remove_stale(path)
+                        break
+                    except OSError:
+                        # 对方接收缓冲区已满，丢弃通知（订阅者仍可依靠数据库读取）
+                        break
+        finally:
+            sender.close()
+
+    @staticmethod
+    def _remove_stale(path: str):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def create_bus(database_url: str, connect: Optional[Callable] = None) -> NotificationBus:
+    """按数据库类型选择通知方式；connect 返回一个新的（不属于连接池的）psycopg2连接"""
+    url = make_url(database_url)
+    if url.get_backend_name() == 'postgresql' and url.get_driver_name() == 'psycopg2' and connect is not None:
+        return PostgresNotificationBus(connect)
+    if hasattr(socket, 'AF_UNIX'):
+        return SocketNotificationBus()
+    return NotificationBus()
@@ -0,0 +1,184 @@
+# prewarm.py
+"""
+热门地点的分析结果预热
+
+为热门地点预先执行图片分析、音乐描述和歌词生成并保存结果，
+之后第一个请求该地点、且图片内容与预热所用图片相同的真实任务直接从Suno阶段开始
+（结果使用一次后删除，由下一次预热补充）。
+
+- 热门地点来自任务历史（最近N天完成次数最多的地点，使用最近一次任务的图片）
+  或JSON配置文件：[{"location": "...", "image_paths": ["uploads/..."]}, ...]
+- 低优先级：只在系统空闲（处理中的任务数低于阈值）时执行，繁忙时等待，等待太久则停止
+- 每天最多预热 PREWARM_DAILY_BUDGET 个地点（每个地点约3次Gemini调用），用量记录在维护状态表中
+"""
+import json
+import os
+import time
+from datetime import datetime, timedelta
+
+from app import (app, db, agent, MusicTask, StatCounter, MaintenanceState, PrewarmedAnalysis,
+                 images_fingerprint, location_key, prewarm_prompt_versions, task_counter_name)
+from circuit_breaker import CircuitOpenError
+from deadline import DeadlineExceeded
+import image_selection
+
+PREWARM_STATE_KEY = 'prewarm'
+PREWARM_DAILY_BUDGET = int(os.getenv('PREWARM_DAILY_BUDGET', 50))
+PREWARM_TTL = timedelta(hours=int(os.getenv('PREWARM_TTL_HOURS', 24 * 7)))
+PREWARM_MAX_ACTIVE_TASKS = int(os.getenv('PREWARM_MAX_ACTIVE_TASKS', 2))  # 处理中的任务数低于此值视为空闲
+PREWARM_LOCATIONS_FILE = os.getenv('PREWARM_LOCATIONS_FILE', '')
+
+IDLE_CHECK_SECONDS = 15
+MAX_IDLE_WAIT_SECONDS = 15 * 60
+
+
+def hot_locations(days=30, limit=20):
+    """最近days天完成次数最多的地点，附带最近一次任务仍然存在的图片"""
+    since = datetime.utcnow() - timedelta(days=days)
+    normalized = db.func.lower(db.func.trim(MusicTask.location))
+    rows = db.session.execute(
+        db.select(normalized, db.func.count(MusicTask.id).label('tasks'))
+        .where(MusicTask.status == 'completed', MusicTask.created_at >= since)
+        .group_by(normalized)
+        .order_by(db.desc('tasks'))
+        .limit(limit * 2)
+    ).all()
+
+    # 数据库只做了大小写和首尾空白的规范化，按location_key再合并一次
+    groups = {}
+    for name, count in rows:
+        group = groups.setdefault(location_key(name), {'name': name, 'tasks': 0})
+        group['tasks'] += count
+    ranked = sorted(groups.values(), key=lambda group: group['tasks'], reverse=True)[:limit]
+
+    locations = []
+    for name in (group['name'] for group in ranked):
+        latest = db.session.execute(
+            db.select(MusicTask.location, MusicTask.image_paths)
+            .where(MusicTask.status == 'completed', normalized == name)
+            .order_by(MusicTask.created_at.desc())
+            .limit(1)
+        ).first()
+        image_paths = [path for path in json.loads(latest.image_paths or '[]') if os.path.exists(path)]
+        if image_paths:
+            locations.append({'location': latest.location, 'image_paths': image_paths})
+    return locations
+
+
+def load_locations_file(path):
+    """读取热门地点配置文件"""
+    with open(path, 'r', encoding='utf-8') as f:
+        entries = json.load(f)
+    return [
+        {'location': entry['location'], 'image_paths': [p for p in entry.get('image_paths', []) if os.path.exists(p)]}
+        for entry in entries if entry.get('location')
+    ]
+
+
+def active_tasks():
+    """所有worker中等待或正在分析的任务数"""
+    names = [task_counter_name('pending'), task_counter_name('analyzing')]
+    return db.session.execute(
+        db.select(db.func.coalesce(db.func.sum(StatCounter.value), 0)).where(StatCounter.name.in_(names))
+    ).scalar()
+
+
+def wait_for_idle(max_wait=MAX_IDLE_WAIT_SECONDS):
+    """等待系统空闲，超时返回False"""
+    waited = 0
+    while active_tasks() >= PREWARM_MAX_ACTIVE_TASKS:
+        if waited >= max_wait:
+            return False
+        time.sleep(IDLE_CHECK_SECONDS)
+        waited += IDLE_CHECK_SECONDS
+        db.session.rollback()  # 结束读事务，重新读取计数
+    return True
+
+
+def _load_budget():
+    today = datetime.utcnow().date().isoformat()
+    state = MaintenanceState.load(PREWARM_STATE_KEY) or {}
+    if state.get('date') != today:
+        state = {'date': today, 'used': 0}
+    return state
+
+
+def prewarm_location(location, image_paths):
+    """为一个地点生成分析结果、音乐描述和歌词，失败时返回错误信息"""
+    selection = image_selection.select_representatives(image_paths)
+    analysis = agent.analyze_images_and_location(selection.selected or image_paths, location)
+    if 'error' in analysis:
+        return None, f"analysis failed: {analysis['error']}"
+
+    music_description = agent.generate_music_description(analysis)
+    lyrics = agent.generate_lyrics(analysis)
+    if music_description.startswith('Error') or lyrics.startswith('Error generating lyrics'):
+        return None, 'description or lyrics generation failed'
+
+    now = datetime.utcnow()
+    return PrewarmedAnalysis(
+        location_key=location_key(location),
+        location=location,
+        image_paths=json.dumps(image_paths),
+        images_fingerprint=images_fingerprint(image_paths),
+        analysis_result=json.dumps(analysis),
+        music_description=music_description,
+        lyrics=lyrics,
+        prompt_versions=prewarm_prompt_versions(),
+        created_at=now,
+        expires_at=now + PREWARM_TTL
+    ), None
+
+
+def run_prewarm(source='history', path=None, limit=20, days=30, budget=PREWARM_DAILY_BUDGET):
+    """按热门程度依次预热尚无可用结果的地点，返回统计"""
+    summary = {'prewarmed': 0, 'skipped': 0, 'failed': 0, 'stopped': None}
+    with app.app_context():
+        expired = db.session.execute(
+            db.delete(PrewarmedAnalysis).where(PrewarmedAnalysis.expires_at <= datetime.utcnow())
+        ).rowcount
+        db.session.commit()
+        summary['expired'] = expired
+
+        if source == 'file':
+            candidates = load_locations_file(path or PREWARM_LOCATIONS_FILE)
+        else:
+            candidates = hot_locations(days=days, limit=limit)
+
+        for candidate in candidates[:limit]:
+            location, image_paths = candidate['location'], candidate['image_paths']
+            existing = db.session.get(PrewarmedAnalysis, location_key(location))
+            if not image_paths or (existing and existing.expires_at > datetime.utcnow()
+                                   and existing.prompt_versions == prewarm_prompt_versions()
+                                   and existing.images_fingerprint):
+                summary['skipped'] += 1
+                continue
+
+            state = _load_budget()
+            if state['used'] >= budget:
+                summary['stopped'] = 'daily budget exhausted'
+                break
+            if not wait_for_idle():
+                summary['stopped'] = 'system busy'
+                break
+
+            try:
+                prewarmed, error = prewarm_location(location, image_paths)
+            except (CircuitOpenError, DeadlineExceeded) as e:
+                summary['stopped'] = f'upstream unavailable: {e}'
+                break
+
+            # 失败的调用同样消耗预算
+            state['used'] += 1
+            MaintenanceState.save(PREWARM_STATE_KEY, state)
+            if prewarmed:
+                db.session.merge(prewarmed)
+                summary['prewarmed'] += 1
+                print(f"Prewarmed {location}")
+            else:
+                summary['failed'] += 1
+                print(f"Failed to prewarm {location}: {error}")
+            db.session.commit()
+
+        summary['budget_used'] = _load_budget()['used']
+    return summary
@@ -0,0 +1,174 @@
+# prompt_benchmark.py
+"""
+提示词大小基准测试
+
+用数据库中已保存的分析结果作为语料，对比旧版提示词模板和 prompt_builder
+生成的新版提示词的token数（离线估算）和字节数。
+
+用法: python prompt_benchmark.py [limit]
+"""
+import json
+import sys
+from typing import Any, Dict
+
+import prompt_builder
+from prompt_builder import estimate_tokens
+
+
+def legacy_analysis_prompt(location: str) -> str:
+    """旧版分析提示词"""
+    return f"""
+        Please analyze the following geographical location and accompanying image(s), and generate culturally and musically relevant insights.
+
+        Location: {location}
+
+        Please strictly follow the steps below to ensure strong regional identity in your analysis:
+
+        1. **Determine the unique cultural, historical, and emotional characteristics of the location.**  
+        For example:  
+        - "The Great Wall of China" → evokes Chinese imperial history, traditional Chinese aesthetics, heroic and historical atmosphere  
+        - "Milan Cathedral" → associated with Gothic architecture, Christian spirituality, and grand pipe organ music
+
+        2. **Visually analyze the provided image(s)**:  
+        Describe the visual elements (architecture, nature, colors, light) and how they reflect the location’s mood or atmosphere.  
+        **Always clearly state the location name** in your visual analysis.
+
+        3. **Extract cultural and geographical identity**:  
+        Reflect unique elements from the region's art, music, architecture, and customs.
+
+        4. **Recommend a music style that is native or symbolic of the location**.  
+        Do not recommend generic genres. For instance:  
+        - Chinese locations → Chinese traditional music, pentatonic scale, guzheng, erhu  
+        - Gothic European cathedrals → Church organ, Gregorian chant, modal harmony  
+        - South American towns → Andean music, pan flute, charango
+
+        5. **Generate detailed music creation parameters**, deeply rooted in the regional style:
+        - Tempo (in BPM or culturally relevant terms)
+        - Musical key or scale (e.g., pentatonic, Dorian mode, etc.)
+        - Culturally significant instruments (e.g., sitar, shakuhachi, duduk)
+        - Mood and atmosphere consistent with both visuals and cultural background
+
+        Return the result in the following strict JSON format:
+        {{
+            "visual_analysis": "The location is {location}, a place rich in cultural symbolism and emotional depth. The accompanying image supports this with visual cues such as brief visual description, e.g. 'ancient stone walls', 'towering spires', 'mist-covered mountains', but the essence is carried by the historical and geographical weight of {location}. This site conveys a powerful sense of emotional keywords, e.g. grandeur, serenity, isolation, rooted in its iconic status. The imagery further enhances the location’s unique character rather than defining it. The emotional atmosphere is shaped foremost by the cultural resonance of {location}, not just by visual elements.",
+            "cultural_context": "Brief explanation of the cultural, historical, or religious meaning of the location and its musical implications.",
+            "music_style": "Name of the musical genre or tradition that is most authentic to the location.",
+            "mood": "One or two emotional tones (e.g. majestic and solemn, nostalgic and warm, etc.)",
+            "tempo": "Suggested tempo (e.g., 60 BPM slow and reflective, or moderate-fast folk rhythm)",
+            "key": "Musical key or scale (e.g., D Dorian, traditional pentatonic, etc.)",
+            "instruments": ["list", "of", "authentic", "and", "representative", "instruments"],
+            "atmosphere": "Summarized description of the scene's overall emotional and cultural atmosphere."
+        }}
+        """
+
+
+def legacy_lyrics_prompt(analysis_result: Dict[str, Any]) -> str:
+    """旧版歌词提示词（选取字段后又附带了完整的缩进JSON）"""
+    return f"""
+        You are a professional lyricist. Based on the analysis result below, write concise, poetic lyrics that reflect the unique identity of the place.
+
+        Requirements:
+        - Structure: 2 short verses and 1 chorus
+        - Use the place name and highlight regional identity
+        - Include phrases in the local language if culturally appropriate
+        - Match the vision, style and mood: {analysis_result.get('visual_analysis', '')}, {analysis_result.get('cultural_context', '')}, {analysis_result.get('music_style', '')}, {analysis_result.get('mood', '')}
+        - Express the emotions and atmosphere from the analysis
+        - Avoid literal image descriptions; focus on tone and cultural feeling
+
+        Analysis:
+        {json.dumps(analysis_result, indent=2)}
+
+        Output only lyrics, no explanations.
+        """
+
+
+def legacy_description_prompt(analysis_result: Dict[str, Any]) -> str:
+    """旧版风格描述提示词"""
+    return f"""
+        You are a music production expert. Based on the analysis result below, generate a **concise, regionally distinctive** music style description for Suno AI.
+
+        Analysis Result:
+        {json.dumps(analysis_result, indent=2)}
+
+        Instructions:
+        - Focus on traditional or culturally unique **regional genres, instruments, scales, and moods**
+        - Do **not** use generic styles like "pop", "neo-classical", or "ambient"
+        - Must include:
+        - Specific **regional genre**
+        - Representative **local instruments**
+        - **Tempo** and **energy**
+        - **Key** or **mode** if mentioned or implied
+        - **Atmosphere** tied to the location’s emotion
+        - Limit: **max 200 characters**
+        - Output only the style description, no explanation
+
+        Example format:
+        "Japanese gagaku with sho and koto, slow tempo, pentatonic scale, meditative and sacred mood"
+
+        Now generate one for the input below.
+        """
+
+
+
+STAGES = (
+    ('analysis', lambda task, analysis: legacy_analysis_prompt(task.location),
+     lambda task, analysis: prompt_builder.build_analysis_prompt(task.location).text),
+    ('lyrics', lambda task, analysis: legacy_lyrics_prompt(analysis),
+     lambda task, analysis: prompt_builder.build_lyrics_prompt(analysis).text),
+    ('description', lambda task, analysis: legacy_description_prompt(analysis),
+     lambda task, analysis: prompt_builder.build_description_prompt(analysis).text),
+)
+
+
+def run_benchmark(limit: int = 500) -> Dict[str, Dict[str, int]]:
+    """对最近的分析结果分别构建新旧提示词，统计总token数和字节数"""
+    from app import app, db, MusicTask
+
+    totals = {stage: {'samples': 0, 'old_tokens': 0, 'new_tokens': 0, 'old_bytes': 0, 'new_bytes': 0}
+              for stage, _, _ in STAGES}
+    with app.app_context():
+        tasks = db.session.execute(
+            db.select(MusicTask)
+            .where(MusicTask.analysis_result.isnot(None))
+            .order_by(MusicTask.created_at.desc())
+            .limit(limit)
+        ).scalars()
+        for task in tasks:
+            try:
+                analysis = json.loads(task.analysis_result)
+            except ValueError:
+                continue
+            if not isinstance(analysis, dict):
+                continue
+            for stage, build_old, build_new in STAGES:
+                old, new = build_old(task, analysis), build_new(task, analysis)
+                row = totals[stage]
+                row['samples'] += 1
+                row['old_tokens'] += estimate_tokens(old)
+                row['new_tokens'] += estimate_tokens(new)
+                row['old_bytes'] += len(old.encode('utf-8'))
+                row['new_bytes'] += len(new.encode('utf-8'))
+    return totals
+
+
+def print_report(totals: Dict[str, Dict[str, int]]):
+    print(f"  {'stage':<14}{'samples':>8}{'old tokens':>12}{'new tokens':>12}{'saved':>8}"
+          f"{'old bytes':>12}{'new bytes':>12}{'saved':>8}")
+    for stage, row in totals.items():
+        if not row['samples']:
+            continue
+        token_saving = 1 - row['new_tokens'] / row['old_tokens']
+        byte_saving = 1 - row['new_bytes'] / row['old_bytes']
+        print(f"  {stage:<14}{row['samples']:>8}"
+              f"{row['old_tokens'] // row['samples']:>12}{row['new_tokens'] // row['samples']:>12}{token_saving:>8.0%}"
+              f"{row['old_bytes'] // row['samples']:>12}{row['new_bytes'] // row['samples']:>12}{byte_saving:>8.0%}")
+
+
+if __name__ == '__main__':
+    limit = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    totals = run_benchmark(limit)
+    if not any(row['samples'] for row in totals.values()):
+        print("No stored analyses found")
+        sys.exit(0)
+    print("Prompt size per call (averages over stored analyses, estimated tokens):")
+    print_report(totals)
@@ -0,0 +1,158 @@
+# prompt_builder.py
+"""
+Gemini提示词构建
+
+集中管理各阶段的提示词模板和版本号：
+- 模板去掉缩进空白，分析结果用紧凑JSON并只保留该阶段需要的字段，不重复发送
+- 离线估算每次调用的token数，超出阶段预算时优先截短最长的字段
+- 模板内容变化时需要更新对应的版本号（版本号也是响应缓存键的一部分）
+"""
+import json
+import math
+import os
+import re
+from dataclasses import dataclass
+from typing import Any, Dict, List, Tuple
+
+ANALYSIS_PROMPT_VERSION = 'analysis-v2'
+LYRICS_PROMPT_VERSION = 'lyrics-v2'
+DESCRIPTION_PROMPT_VERSION = 'description-v2'
+
+# 各阶段提示词的token预算（估算值，不含图片）
+PROMPT_TOKEN_BUDGETS = {
+    'analysis': int(os.getenv('ANALYSIS_PROMPT_TOKEN_BUDGET', 700)),
+    'lyrics': int(os.getenv('LYRICS_PROMPT_TOKEN_BUDGET', 600)),
+    'description': int(os.getenv('DESCRIPTION_PROMPT_TOKEN_BUDGET', 500)),
+}
+
+# 各阶段使用的分析结果字段（按重要性排序）
+LYRICS_FIELDS = ('cultural_context', 'music_style', 'mood', 'atmosphere', 'visual_analysis')
+DESCRIPTION_FIELDS = ('music_style', 'instruments', 'tempo', 'key', 'mood', 'atmosphere', 'cultural_context')
+
+MIN_FIELD_CHARS = 80
+
+_TOKEN_PATTERN = re.compile(r'[぀-ヿ㐀-鿿가-힯]|[A-Za-z0-9]+|[^\sA-Za-z0-9]')
+
+
+@dataclass
+class Prompt:
+    """构建好的提示词及其大小"""
+    stage: str
+    version: str
+    text: str
+    tokens: int
+    truncated_fields: Tuple[str, ...] = ()
+
+    @property
+    def bytes(self) -> int:
+        return len(self.text.encode('utf-8'))
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    离线估算token数：中日韩字符和标点各算1个，
+    英文单词和数字按每4个字符1个token计算。
+    """
+    tokens = 0
+    for piece in _TOKEN_PATTERN.findall(text):
+        if piece[0].isascii() and piece[0].isalnum():
+            tokens += math.ceil(len(piece) / 4)
+        else:
+            tokens += 1
+    return tokens
+
+
+def compact_json(value: Any) -> str:
+    return json.dumps(value, separators=(',', ':'), ensure_ascii=False)
+
+
+def _dedent(template: str) -> str:
+    """去掉模板每行的缩进和多余空行"""
+    lines = [line.strip() for line in template.strip().splitlines()]
+    return '\n'.join(line for line in lines if line)
+
+
+def select_fields(analysis: Dict[str, Any], fields: Tuple[str, ...]) -> Dict[str, Any]:
+    """只保留指定的非空字段；没有结构化字段时退回原始分析文本"""
+    selected = {field: analysis[field] for field in fields if analysis.get(field)}
+    if not selected and analysis.get('raw_analysis'):
+        selected['raw_analysis'] = analysis['raw_analysis']
+    return selected
+
+
+def _fit_to_budget(stage: str, render, fields: Dict[str, Any]) -> Tuple[str, int, Tuple[str, ...]]:
+    """渲染提示词，超出预算时逐步截短最长的文本字段"""
+    budget = PROMPT_TOKEN_BUDGETS[stage]
+    fields = dict(fields)
+    truncated: List[str] = []
+    while True:
+        text = render(fields)
+        tokens = estimate_tokens(text)
+        if tokens <= budget:
+            break
+        candidates = [(len(value), name) for name, value in fields.items()
+                      if isinstance(value, str) and len(value) > MIN_FIELD_CHARS + 1]
+        if not candidates:
+            break
+        length, name = max(candidates)
+        fields[name] = fields[name][:max(MIN_FIELD_CHARS, length * 2 // 3)].rstrip() + '…'
+        if name not in truncated:
+            truncated.append(name)
+    return text, tokens, tuple(truncated)
+
+
+def build_analysis_prompt(location: str) -> Prompt:
+    """图片和地点分析提示词"""
+    def render(fields):
+        return _dedent(f"""
+            Analyze the location and the accompanying image(s) to derive culturally and musically relevant insights.
+            Location: {fields['location']}
+            Steps:
+            1. Identify the location's distinctive cultural, historical and emotional character (e.g. Great Wall → Chinese imperial history, heroic; Milan Cathedral → Gothic, Christian spirituality, pipe organ).
+            2. Describe the visual elements (architecture, nature, colors, light) and how they reflect the location's mood; always name the location.
+            3. Extract regional identity from local art, music, architecture and customs.
+            4. Recommend a music style native to or symbolic of the location, never a generic genre (e.g. Chinese → pentatonic, guzheng, erhu; Gothic cathedral → organ, Gregorian chant; Andes → pan flute, charango).
+            5. Give regionally rooted parameters: tempo, key or scale, culturally significant instruments, mood.
+            The location's cultural resonance shapes the atmosphere first; the imagery supports it.
+            Return strict JSON with these keys:
+            {{"visual_analysis": "the location named, key visual cues and emotional keywords", "cultural_context": "cultural/historical meaning and its musical implications", "music_style": "most authentic genre or tradition", "mood": "one or two emotional tones", "tempo": "BPM or descriptive tempo", "key": "key, mode or scale", "instruments": ["authentic instruments"], "atmosphere": "overall emotional and cultural atmosphere"}}
+        """)
+
+    text, tokens, truncated = _fit_to_budget('analysis', render, {'location': location})
+    return Prompt('analysis', ANALYSIS_PROMPT_VERSION, text, tokens, truncated)
+
+
+def build_lyrics_prompt(analysis: Dict[str, Any]) -> Prompt:
+    """歌词生成提示词"""
+    def render(fields):
+        return _dedent(f"""
+            You are a professional lyricist. Write concise, poetic lyrics reflecting the unique identity of the place in the analysis.
+            Requirements:
+            - 2 short verses and 1 chorus
+            - Use the place name and highlight regional identity
+            - Include phrases in the local language if culturally appropriate
+            - Match the style, mood and emotional atmosphere of the analysis
+            - Avoid literal image descriptions; focus on tone and cultural feeling
+            Analysis: {compact_json(fields)}
+            Output only lyrics, no explanations.
+        """)
+
+    text, tokens, truncated = _fit_to_budget('lyrics', render, select_fields(analysis, LYRICS_FIELDS))
+    return Prompt('lyrics', LYRICS_PROMPT_VERSION, text, tokens, truncated)
+
+
+def build_description_prompt(analysis: Dict[str, Any]) -> Prompt:
+    """Suno音乐风格描述提示词"""
+    def render(fields):
+        return _dedent(f"""
+            You are a music production expert. Write a concise, regionally distinctive music style description for Suno AI.
+            Analysis: {compact_json(fields)}
+            - Focus on traditional or culturally unique regional genres, instruments, scales and moods
+            - No generic styles like "pop", "neo-classical" or "ambient"
+            - Include: regional genre, local instruments, tempo and energy, key or mode if implied, atmosphere tied to the location
+            - Max 200 characters; output only the description
+            Example: "Japanese gagaku with sho and koto, slow tempo, pentatonic scale, meditative and sacred mood"
+        """)
+
+    text, tokens, truncated = _fit_to_budget('description', render, select_fields(analysis, DESCRIPTION_FIELDS))
+    return Prompt('description', DESCRIPTION_PROMPT_VERSION, text, tokens, truncated)
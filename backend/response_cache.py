@@ -0,0 +1,186 @@
+# response_cache.py
+"""
+文本类LLM调用的持久化响应缓存
+
+缓存键由 模型名 + 提示词模板版本 + 规范化后的输入 组成，
+存储在本地SQLite文件中，多个gunicorn worker可以共享同一个缓存文件。
+支持按总大小的LRU淘汰、TTL过期以及命中/未命中统计。
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Optional
+
+from log_config import get_logger
+
+logger = get_logger('response_cache')
+
+
+class ResponseCache:
+    """基于SQLite的提示词级响应缓存"""
+
+    def __init__(self, path: str, max_bytes: int = 64 * 1024 * 1024, ttl_seconds: int = 30 * 24 * 3600):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self._local = threading.local()
+
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+
+        conn = self._connect()
+        with conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS responses (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    created_at REAL NOT NULL,
+                    last_access REAL NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS ix_responses_last_access ON responses (last_access)")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS counters (
+                    name TEXT PRIMARY KEY,
+                    value INTEGER NOT NULL
+                )
+            """)
+            for name in ('hits', 'misses', 'expired', 'evictions'):
+                conn.execute("INSERT OR IGNORE INTO counters (name, value) VALUES (?, 0)", (name,))
+
+    def _connect(self) -> sqlite3.Connection:
+        """每个线程使用独立的连接（fork之后不沿用父进程创建的连接）"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    @staticmethod
+    def make_key(model_name: str, prompt_version: str, payload: Any) -> str:
+        """根据模型、提示词版本和规范化输入生成缓存键"""
+        canonical = json.dumps(payload, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+        digest = hashlib.sha256()
+        digest.update(model_name.encode('utf-8'))
+        digest.update(b'\x00')
+        digest.update(prompt_version.encode('utf-8'))
+        digest.update(b'\x00')
+        digest.update(canonical.encode('utf-8'))
+        return digest.hexdigest()
+
+    def _bump(self, conn: sqlite3.Connection, name: str, amount: int = 1):
+        conn.execute("UPDATE counters SET value = value + ? WHERE name = ?", (amount, name))
+
+    def get(self, key: str) -> Optional[str]:
+        """读取缓存，过期或不存在时返回None"""
+        try:
+            conn = self._connect()
+            now = time.time()
+            row = conn.execute(
+                "SELECT value, created_at FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+
+            if row is None:
+                self._bump(conn, 'misses')
+                return None
+
+            value, created_at = row
+            if self.ttl_seconds and now - created_at > self.ttl_seconds:
+                with conn:
+                    conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                    self._bump(conn, 'expired')
+                    self._bump(conn, 'misses')
+                return None
+
+            with conn:
+                conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (now, key))
+                self._bump(conn, 'hits')
+            return value
+
+        except sqlite3.Error as e:
+            logger.warning("Response cache read error: %s", e)
+            return None
+
+    def set(self, key: str, value: str):
+        """写入缓存，并在超过大小上限时按LRU淘汰"""
+        try:
+            conn = self._connect()
+            now = time.time()
+            size = len(value.encode('utf-8'))
+            with conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO responses (key, value, size, created_at, last_access) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (key, value, size, now, now)
+                )
+            self._evict(conn)
+
+        except sqlite3.Error as e:
+            logger.warning("Response cache write error: %s", e)
+
+    def _evict(self, conn: sqlite3.Connection):
+        """删除过期条目，并按最近访问时间淘汰直到总大小低于上限"""
+        with conn:
+            if self.ttl_seconds:
+                cursor = conn.execute(
+                    "DELETE FROM responses WHERE created_at < ?",
+                    (time.time() - self.ttl_seconds,)
+                )
+                if cursor.rowcount:
+                    self._bump(conn, 'expired', cursor.rowcount)
+
+            total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+            if total <= self.max_bytes:
+                return
+
+            # 淘汰到上限的90%，避免每次写入都触发淘汰
+            target = int(self.max_bytes * 0.9)
+            evicted = 0
+            for key, size in conn.execute(
+                "SELECT key, size FROM responses ORDER BY last_access ASC"
+            ).fetchall():
+                if total <= target:
+                    break
+                conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                total -= size
+                evicted += 1
+
+            if evicted:
+                self._bump(conn, 'evictions', evicted)
+
+    def stats(self) -> Dict[str, Any]:
+        """返回缓存命中统计信息"""
+        try:
+            conn = self._connect()
+            counters = dict(conn.execute("SELECT name, value FROM counters").fetchall())
+            entries, total_bytes = conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses"
+            ).fetchone()
+        except sqlite3.Error as e:
+            return {'error': str(e)}
+
+        lookups = counters.get('hits', 0) + counters.get('misses', 0)
+        return {
+            'entries': entries,
+            'bytes': total_bytes,
+            'max_bytes': self.max_bytes,
+            'ttl_seconds': self.ttl_seconds,
+            'hits': counters.get('hits', 0),
+            'misses': counters.get('misses', 0),
+            'expired': counters.get('expired', 0),
+            'evictions': counters.get('evictions', 0),
+            'hit_rate': round(counters.get('hits', 0) / lookups, 4) if lookups else 0.0
+        }
+
+    def clear(self):
+        """清空缓存条目（保留统计信息）"""
+        conn = self._connect()
+        with conn:
+            conn.execute("DELETE FROM responses")
@@ -0,0 +1,143 @@
+# retention.py
+"""
+旧任务数据保留/清理
+
+按固定大小的分块删除过期任务：每块只查询任务ID和图片路径，
+用集合删除语句一次删除该块的回调日志、任务和文件引用，提交后删除缓存音频，
+以及不再被任何任务引用的图片（批量或重试任务可能共用同一张图片）。
+每块提交时同时写入检查点，中断后重新运行会沿用同一个截止时间继续清理。
+"""
+import json
+import time
+from datetime import datetime, timedelta
+
+from app import (app, db, MusicTask, CallbackLog, MaintenanceState, audio_cache,
+                 remove_image_file, remove_file_references, remove_request_keys, unreferenced_paths,
+                 apply_counter_deltas, task_counter_name, CALLBACK_COUNTER)
+
+RETENTION_STATE_KEY = 'retention'
+DEFAULT_STATUSES = ('completed', 'failed')
+
+
+def _remove_task_files(rows):
+    """
+    删除已清理任务的缓存音频，以及其中已没有任务引用的图片文件，返回已删除的图片路径。
+    需要在删除这些任务的文件引用并提交之后调用；仍被其他任务引用的图片保留。
+    """
+    paths = []
+    for task_id, image_paths in rows:
+        audio_cache.remove(task_id)
+        if not image_paths:
+            continue
+        try:
+            paths.extend(json.loads(image_paths))
+        except ValueError:
+            continue
+
+    removed = []
+    for path in unreferenced_paths(paths):
+        try:
+            if remove_image_file(path):
+                removed.append(path)
+        except OSError as e:
+            print(f"Error deleting image file {path}: {e}")
+    return removed
+
+
+def run_retention(days=30, chunk_size=500, statuses=DEFAULT_STATUSES, max_chunks=None,
+                  pause_seconds=0.0, resume=True):
+    """分块清理超过保留期限的任务，返回清理统计"""
+    with app.app_context():
+        state = MaintenanceState.load(RETENTION_STATE_KEY) if resume else None
+
+        if state and not state.get('finished'):
+            print(f"Resuming retention job started at {state['started_at']} (cutoff {state['cutoff']})")
+        else:
+            state = {
+                'cutoff': (datetime.utcnow() - timedelta(days=days)).isoformat(),
+                'statuses': list(statuses),
+                'started_at': datetime.utcnow().isoformat(),
+                'deleted_tasks': 0,
+                'deleted_callbacks': 0,
+                'deleted_files': 0,
+                'chunks': 0,
+                'finished': False
+            }
+
+        cutoff = datetime.fromisoformat(state['cutoff'])
+        statuses = state['statuses']
+        start_time = time.monotonic()
+        run_tasks = 0
+        run_chunks = 0
+
+        while max_chunks is None or run_chunks < max_chunks:
+            # 只读取ID和图片路径，按 (created_at, id) 顺序取最旧的一块
+            rows = db.session.execute(
+                db.select(MusicTask.id, MusicTask.image_paths)
+                .where(MusicTask.created_at < cutoff, MusicTask.status.in_(statuses))
+                .order_by(MusicTask.created_at, MusicTask.id)
+                .limit(chunk_size)
+            ).all()
+
+            if not rows:
+                state['finished'] = True
+                state['finished_at'] = datetime.utcnow().isoformat()
+                MaintenanceState.save(RETENTION_STATE_KEY, state)
+                db.session.commit()
+                break
+
+            task_ids = [row[0] for row in rows]
+
+            # 集合删除不会触发ORM事件，需要手动扣减统计计数
+            status_counts = db.session.execute(
+                db.select(MusicTask.status, db.func.count(MusicTask.id))
+                .where(MusicTask.id.in_(task_ids))
+                .group_by(MusicTask.status)
+            ).all()
+
+            callbacks_deleted = db.session.execute(
+                db.delete(CallbackLog).where(CallbackLog.task_id.in_(task_ids))
+            ).rowcount
+            tasks_deleted = db.session.execute(
+                db.delete(MusicTask).where(MusicTask.id.in_(task_ids))
+            ).rowcount
+            remove_file_references(task_ids)
+            remove_request_keys(task_ids)
+
+            deltas = {task_counter_name(status): -count for status, count in status_counts}
+            deltas[CALLBACK_COUNTER] = -callbacks_deleted
+            apply_counter_deltas(db.session.connection(), deltas)
+
+            state['deleted_tasks'] += tasks_deleted
+            state['deleted_callbacks'] += callbacks_deleted
+            state['chunks'] += 1
+            MaintenanceState.save(RETENTION_STATE_KEY, state)
+            db.session.commit()
+
+            # 文件在事务提交之后删除；如果此处中断，残留文件由孤立文件清理处理
+            removed_paths = _remove_task_files(rows)
+            files_deleted = len(removed_paths)
+            if files_deleted:
+                remove_file_references([], removed_paths)
+                state['deleted_files'] += files_deleted
+                MaintenanceState.save(RETENTION_STATE_KEY, state)
+                db.session.commit()
+
+            run_tasks += tasks_deleted
+            run_chunks += 1
+            elapsed = time.monotonic() - start_time
+            print(f"Chunk {state['chunks']}: deleted {tasks_deleted} tasks, {callbacks_deleted} callbacks, "
+                  f"{files_deleted} files ({run_tasks / elapsed if elapsed else 0:.1f} rows/sec)")
+
+            if pause_seconds:
+                time.sleep(pause_seconds)
+
+        elapsed = time.monotonic() - start_time
+        summary = dict(state)
+        summary.update({
+            'run_deleted_tasks': run_tasks,
+            'run_chunks': run_chunks,
+            'elapsed_seconds': round(elapsed, 2),
+            'rows_per_second': round(run_tasks / elapsed, 1) if elapsed else 0.0
+        })
+        return summary
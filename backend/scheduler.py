@@ -0,0 +1,214 @@
+# scheduler.py
+"""
+任务处理调度器（按用户公平分享 + 优先级通道）
+
+所有待处理任务先进入调度器排队，由固定数量的工作线程取出执行：
+- 通道：interactive（用户实时请求）和 batch（批量生成、预热），按通道权重分配处理份额，
+  batch 通道最多占用 lane_limits 指定的线程数，保证实时请求总有空闲线程
+- 同一通道内按 user_id 做加权公平排队（start-time fair queuing）：
+  每个用户是一条独立队列，提交大量任务的用户只会拉长自己的队列
+- 每个用户同时处理的任务数不超过 max_per_user（匿名任务不受此限制）
+
+状态保存在进程内，每个gunicorn worker独立调度。进程退出后队列随之丢失，
+任务记录所属进程的标识（process_identity），之后的worker据此找回已退出进程的任务。
+"""
+import os
+import socket
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from log_config import get_logger
+
+logger = get_logger('scheduler')
+
+INTERACTIVE = 'interactive'
+BATCH = 'batch'
+
+SCHEDULER_WORKERS = int(os.getenv('SCHEDULER_WORKERS', 8))
+SCHEDULER_MAX_PER_USER = int(os.getenv('SCHEDULER_MAX_PER_USER', 2))
+LANE_WEIGHTS = {
+    INTERACTIVE: float(os.getenv('INTERACTIVE_LANE_WEIGHT', 8)),
+    BATCH: float(os.getenv('BATCH_LANE_WEIGHT', 1)),
+}
+# 各通道最多占用的工作线程数（默认沿用批量任务的并发配置）
+LANE_LIMITS = {
+    INTERACTIVE: SCHEDULER_WORKERS,
+    BATCH: int(os.getenv('BATCH_MAX_CONCURRENCY', 4)),
+}
+
+
+def _process_start_time(pid: int) -> Optional[str]:
+    """进程的启动时间（/proc/<pid>/stat 第22个字段），没有/proc时返回None"""
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            stat = f.read()
+    except OSError:
+        return None
+    # 进程名可能包含空格和括号，从最后一个 ')' 之后开始的是第3个字段
+    return stat.rsplit(')', 1)[1].split()[19]
+
+
+def process_identity(pid: Optional[int] = None) -> str:
+    """本机进程的唯一标识 主机名:pid:启动时间，启动时间用于区分被复用的pid"""
+    pid = pid or os.getpid()
+    return f'{socket.gethostname()}:{pid}:{_process_start_time(pid) or ""}'
+
+
+def process_alive(identity: str) -> Optional[bool]:
+    """标识对应的进程是否仍在运行；其他主机上的进程无法判断，返回None"""
+    host, pid, started = identity.rsplit(':', 2)
+    if host != socket.gethostname():
+        return None
+    pid = int(pid)
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return not started or _process_start_time(pid) == started
+
+
+@dataclass
+class Job:
+    """排队中的一次处理"""
+    key: str
+    lane: str
+    flow: str
+    capped: bool
+    start_tag: float
+    finish_tag: float
+    args: Tuple[Any, ...] = ()
+    enqueued_at: float = field(default_factory=time.monotonic)
+
+
+class FairScheduler:
+    """按通道和用户公平分享工作线程的调度器"""
+
+    def __init__(self, handler: Callable, workers: int = SCHEDULER_WORKERS,
+                 lane_weights: Optional[Dict[str, float]] = None,
+                 lane_limits: Optional[Dict[str, int]] = None,
+                 max_per_user: int = SCHEDULER_MAX_PER_USER,
+                 on_dispatch: Optional[Callable[[Job, float], None]] = None):
+        self.handler = handler
+        self.workers = workers
+        self.lane_weights = dict(lane_weights or LANE_WEIGHTS)
+        self.lane_limits = dict(lane_limits or LANE_LIMITS)
+        self.max_per_user = max_per_user
+        self.on_dispatch = on_dispatch
+
+        self._cond = threading.Condition()
+        self._flows: Dict[Tuple[str, str], deque] = {}  # (通道, 用户) -> 排队的任务
+        self._last_finish: Dict[Tuple[str, str], float] = {}
+        self._virtual_time = 0.0
+        self._running_lanes: Dict[str, int] = {}
+        self._running_flows: Dict[str, int] = {}
+        self._threads = []
+        self.dispatched = 0
+
+    def _ensure_started(self):
+        """首次提交时启动工作线程"""
+        if self._threads:
+            return
+        for index in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f'scheduler-{index}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, key: str, *args, user_id: Optional[str] = None, lane: str = INTERACTIVE):
+        """提交一个任务；没有user_id的任务单独成一条队列，不受每用户并发上限限制"""
+        lane = lane if lane in self.lane_weights else INTERACTIVE
+        flow = f'user:{user_id}' if user_id else f'task:{key}'
+        with self._cond:
+            self._ensure_started()
+            flow_key = (lane, flow)
+            start = max(self._virtual_time, self._last_finish.get(flow_key, 0.0))
+            finish = start + 1.0 / self.lane_weights[lane]
+            self._last_finish[flow_key] = finish
+            job = Job(key, lane, flow, bool(user_id), start, finish, args)
+            self._flows.setdefault(flow_key, deque()).append(job)
+            self._cond.notify()
+        return job
+
+    def _eligible(self, job: Job) -> bool:
+        if self._running_lanes.get(job.lane, 0) >= self.lane_limits.get(job.lane, self.workers):
+            return False
+        return not job.capped or self._running_flows.get(job.flow, 0) < self.max_per_user
+
+    def _next_job(self) -> Optional[Job]:
+        """取出可执行任务中开始标签最小的一个"""
+        best_key = None
+        best = None
+        for flow_key, queue in self._flows.items():
+            job = queue[0]
+            if self._eligible(job) and (best is None or (job.start_tag, job.enqueued_at) < (best.start_tag, best.enqueued_at)):
+                best_key, best = flow_key, job
+        if best is None:
+            return None
+
+        queue = self._flows[best_key]
+        queue.popleft()
+        if not queue:
+            del self._flows[best_key]
+        self._virtual_time = max(self._virtual_time, best.start_tag)
+        self._running_lanes[best.lane] = self._running_lanes.get(best.lane, 0) + 1
+        self._running_flows[best.flow] = self._running_flows.get(best.flow, 0) + 1
+        return best
+
+    def _release(self, job: Job):
+        with self._cond:
+            self._running_lanes[job.lane] -= 1
+            self._running_flows[job.flow] -= 1
+            if not self._running_flows[job.flow]:
+                del self._running_flows[job.flow]
+            # 结束标签已落后于虚拟时间的空闲队列不影响排序，可以丢弃
+            self._last_finish = {
+                flow_key: finish for flow_key, finish in self._last_finish.items()
+                if finish > self._virtual_time or flow_key in self._flows
+            }
+            self._cond.notify_all()
+
+    def _work(self):
+        while True:
+            with self._cond:
+                job = self._next_job()
+                while job is None:
+                    self._cond.wait()
+                    job = self._next_job()
+                self.dispatched += 1
+            if self.on_dispatch:
+                self.on_dispatch(job, time.monotonic() - job.enqueued_at)
+            try:
+                self.handler(job.key, *job.args)
+            except Exception:
+                logger.exception("Scheduled job failed", extra={'key': job.key, 'lane': job.lane})
+            finally:
+                self._release(job)
+
+    def queue_depth(self, lane: Optional[str] = None) -> int:
+        """排队中（未开始处理）的任务数"""
+        with self._cond:
+            return sum(len(queue) for (queue_lane, _), queue in self._flows.items()
+                       if lane is None or queue_lane == lane)
+
+    def snapshot(self) -> Dict[str, Any]:
+        """当前状态（用于 /health）"""
+        with self._cond:
+            lanes = {}
+            for lane in self.lane_weights:
+                lanes[lane] = {
+                    'queued': sum(len(queue) for (queue_lane, _), queue in self._flows.items() if queue_lane == lane),
+                    'running': self._running_lanes.get(lane, 0),
+                    'limit': self.lane_limits.get(lane, self.workers),
+                    'weight': self.lane_weights[lane],
+                }
+            return {
+                'workers': self.workers,
+                'max_per_user': self.max_per_user,
+                'queued_users': len({flow for _, flow in self._flows}),
+                'dispatched': self.dispatched,
+                'lanes': lanes
+            }
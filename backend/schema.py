@@ -0,0 +1,45 @@
+# schema.py
+"""
+轻量级的数据库结构升级
+
+db.create_all() 只会创建缺失的表，不会为已存在的表添加新列。
+这里对比模型定义和实际数据库结构，为旧表补充新增的可空列和索引，
+只做增量变更，不会删除或修改已有的列。
+"""
+from typing import List
+
+from sqlalchemy import inspect, text
+
+
+def upgrade_schema(db) -> List[str]:
+    """为已存在的表补充缺失的列和索引，返回执行的变更列表"""
+    changes = []
+    engine = db.engine
+    preparer = engine.dialect.identifier_preparer
+    inspector = inspect(engine)
+
+    with engine.begin() as conn:
+        for table in db.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+
+            existing_columns = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing_columns:
+                    continue
+
+                column_type = column.type.compile(dialect=engine.dialect)
+                conn.execute(text(
+                    f"ALTER TABLE {preparer.quote(table.name)} "
+                    f"ADD COLUMN {preparer.quote(column.name)} {column_type}"
+                ))
+                changes.append(f"added column {table.name}.{column.name}")
+
+            existing_indexes = {index['name'] for index in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name in existing_indexes:
+                    continue
+                index.create(bind=conn)
+                changes.append(f"created index {index.name}")
+
+    return changes
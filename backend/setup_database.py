@@ -3,7 +3,7 @@
 数据库初始化和管理脚本
 """
 import os
-from app import app, db, MusicTask, CallbackLog
+from app import app, db, MusicTask, CallbackLog, prepare_database
 from datetime import datetime, timedelta
 
 def init_database():
@@ -12,50 +12,116 @@ def init_database():
         # 删除所有表（谨慎使用）
         # db.drop_all()
         
-        # 创建所有表
-        db.create_all()
+        # 创建所有表并初始化统计计数
+        prepare_database()
         print("Database tables created successfully!")
 
-def clear_old_tasks(days=30):
-    """清理旧任务数据"""
+def upgrade_database():
+    """为已有的表补充新增的列和索引（gunicorn主进程启动时也会执行）"""
     with app.app_context():
-        cutoff_date = datetime.utcnow() - timedelta(days=days)
-        
-        # 删除旧的已完成或失败的任务
-        old_tasks = MusicTask.query.filter(
-            MusicTask.created_at < cutoff_date,
-            MusicTask.status.in_(['completed', 'failed'])
-        ).all()
-        
-        for task in old_tasks:
-            # 删除相关的回调日志
-            CallbackLog.query.filter_by(task_id=task.id).delete()
-            # 删除任务
-            db.session.delete(task)
-        
-        db.session.commit()
-        print(f"Cleaned up {len(old_tasks)} old tasks")
+        changes = prepare_database()
+        for change in changes:
+            print(f"  {change}")
+        print(f"Schema upgrade finished, {len(changes)} changes applied")
+
+def clear_old_tasks(days=30, chunk_size=500):
+    """清理旧任务数据（分块删除任务、回调日志及其文件，可断点续跑）"""
+    from retention import run_retention
+
+    summary = run_retention(days=days, chunk_size=chunk_size)
+    print(f"Cleaned up {summary['run_deleted_tasks']} old tasks in {summary['run_chunks']} chunks "
+          f"({summary['rows_per_second']} rows/sec)")
+    print(f"Retention job total: {summary['deleted_tasks']} tasks, {summary['deleted_callbacks']} callbacks, "
+          f"{summary['deleted_files']} files")
+
+def prewarm_locations(source='history', limit=20, path=None):
+    """在空闲时为热门地点预先生成分析结果（受每日预算限制）"""
+    from prewarm import run_prewarm
+
+    summary = run_prewarm(source=source, path=path, limit=limit)
+    print(f"Prewarmed {summary['prewarmed']} locations, {summary['skipped']} already warm, "
+          f"{summary['failed']} failed; {summary['budget_used']} of today's budget used")
+    if summary['stopped']:
+        print(f"Stopped early: {summary['stopped']}")
+
+def reconcile_files(full=False, dry_run=False):
+    """增量清理上传目录中的孤立文件"""
+    from app import reconcile_uploads
+
+    summary = reconcile_uploads(full=full, dry_run=dry_run)
+    action = 'Found' if dry_run else 'Deleted'
+    print(f"{action} {summary['orphaned_files']} orphaned files "
+          f"(inspected {summary['inspected_files']} of {summary['scanned_files']} files "
+          f"in {summary['elapsed_seconds']}s)")
 
 def get_database_stats():
     """获取数据库统计信息"""
+    from app import compute_task_stats
+
     with app.app_context():
-        stats = {
-            'total_tasks': MusicTask.query.count(),
-            'pending_tasks': MusicTask.query.filter_by(status='pending').count(),
-            'analyzing_tasks': MusicTask.query.filter_by(status='analyzing').count(),
-            'generating_tasks': MusicTask.query.filter_by(status='generating').count(),
-            'completed_tasks': MusicTask.query.filter_by(status='completed').count(),
-            'failed_tasks': MusicTask.query.filter_by(status='failed').count(),
-            'total_callbacks': CallbackLog.query.count()
-        }
-        
-        # 最近24小时的任务数
-        last_24h = datetime.utcnow() - timedelta(hours=24)
-        stats['tasks_last_24h'] = MusicTask.query.filter(
-            MusicTask.created_at >= last_24h
-        ).count()
-        
-        return stats
+        return compute_task_stats()
+
+def rebuild_counters():
+    """根据实际数据重建统计计数表"""
+    from app import rebuild_stat_counters
+
+    counts = rebuild_stat_counters()
+    print("Stat counters rebuilt:")
+    for name, value in counts.items():
+        print(f"  {name}: {value}")
+
+def timeline_report(hours=24):
+    """统计时间窗口内任务各阶段耗时的p50/p95"""
+    import task_timeline
+
+    with app.app_context():
+        since = datetime.utcnow() - timedelta(hours=hours)
+        timelines = db.session.execute(
+            db.select(MusicTask.timeline)
+            .where(MusicTask.created_at >= since, MusicTask.timeline.isnot(None))
+            .execution_options(yield_per=1000)
+        ).scalars()
+        summary = task_timeline.summarize(timelines)
+
+    if not summary:
+        print(f"No task timelines in the last {hours} hours")
+        return summary
+
+    print(f"Stage latency over the last {hours} hours (ms, duration since previous stage / offset from creation):")
+    print(f"  {'stage':<24}{'count':>8}{'p50':>10}{'p95':>10}{'offset p50':>14}{'offset p95':>14}")
+    for stage, row in summary.items():
+        print(f"  {stage:<24}{row['count']:>8}{row['p50_ms']:>10}{row['p95_ms']:>10}"
+              f"{row['offset_p50_ms']:>14}{row['offset_p95_ms']:>14}")
+    return summary
+
+def compress_payloads(batch_size=500):
+    """分批压缩已有的Suno响应和回调数据"""
+    from compressed_text import compress_column
+
+    with app.app_context():
+        for name, column, pk_column in (
+            ('music_task.suno_response', MusicTask.suno_response, MusicTask.id),
+            ('callback_log.callback_data', CallbackLog.callback_data, CallbackLog.id),
+        ):
+            summary = compress_column(db.session, column, pk_column, batch_size=batch_size)
+            print(f"{name}: compressed {summary['compressed']} rows, "
+                  f"{summary['bytes_before']} -> {summary['bytes_after']} bytes "
+                  f"in {summary['elapsed_seconds']}s")
+
+def payload_space_report():
+    """统计压缩字段的存储空间和节省的空间"""
+    from compressed_text import column_space
+
+    with app.app_context():
+        for name, column in (
+            ('music_task.suno_response', MusicTask.suno_response),
+            ('callback_log.callback_data', CallbackLog.callback_data),
+        ):
+            report = column_space(db.session, column)
+            ratio = report['logical_bytes'] / report['stored_bytes'] if report['stored_bytes'] else 0
+            print(f"{name}: {report['rows']} rows ({report['compressed_rows']} compressed), "
+                  f"stored {report['stored_bytes']} bytes, uncompressed {report['logical_bytes']} bytes, "
+                  f"saved {report['saved_bytes']} bytes ({ratio:.1f}x)")
 
 def reset_stuck_tasks():
     """重置卡住的任务"""
@@ -79,13 +145,15 @@ if __name__ == '__main__':
     import sys
     
     if len(sys.argv) < 2:
-        print("Usage: python setup_database.py [init|stats|cleanup|reset]")
+        print("Usage: python setup_database.py [init|upgrade|stats|cleanup [days] [chunk_size]|reset|reconcile [--full] [--dry-run]|rebuild-counters|timeline [hours]|compress-payloads [batch_size]|payload-report|prewarm [history|file] [limit] [path]]")
         sys.exit(1)
     
     command = sys.argv[1]
     
     if command == 'init':
         init_database()
+    elif command == 'upgrade':
+        upgrade_database()
     elif command == 'stats':
         stats = get_database_stats()
         print("Database Statistics:")
@@ -93,8 +161,26 @@ if __name__ == '__main__':
             print(f"  {key}: {value}")
     elif command == 'cleanup':
         days = int(sys.argv[2]) if len(sys.argv) > 2 else 30
-        clear_old_tasks(days)
+        chunk_size = int(sys.argv[3]) if len(sys.argv) > 3 else 500
+        clear_old_tasks(days, chunk_size)
     elif command == 'reset':
         reset_stuck_tasks()
+    elif command == 'timeline':
+        hours = int(sys.argv[2]) if len(sys.argv) > 2 else 24
+        timeline_report(hours)
+    elif command == 'rebuild-counters':
+        rebuild_counters()
+    elif command == 'reconcile':
+        reconcile_files(full='--full' in sys.argv, dry_run='--dry-run' in sys.argv)
+    elif command == 'compress-payloads':
+        batch_size = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+        compress_payloads(batch_size)
+    elif command == 'payload-report':
+        payload_space_report()
+    elif command == 'prewarm':
+        source = sys.argv[2] if len(sys.argv) > 2 else 'history'
+        limit = int(sys.argv[3]) if len(sys.argv) > 3 else 20
+        path = sys.argv[4] if len(sys.argv) > 4 else None
+        prewarm_locations(source, limit, path)
     else:
-        print("Unknown command. Available commands: init, stats, cleanup, reset")
\ No newline at end of file
+        print("Unknown command. Available commands: init, upgrade, stats, cleanup, reset, reconcile, rebuild-counters, timeline, compress-payloads, payload-report, prewarm")
\ No newline at end of file
@@ -0,0 +1,147 @@
+# startup_benchmark.py
+"""
+worker冷启动基准测试
+
+在独立的子进程中导入 app（使用临时目录中的SQLite数据库），测量：
+- 导入耗时和导入后的常驻内存（VmRSS）
+- 创建数据库表的耗时（prepare_database，旧版本在导入时执行，已计入导入耗时）
+- 从导入完成的进程fork出的worker的私有内存（gunicorn预加载时每个worker实际新增的内存，仅Linux）
+- 导入后是否已经加载了Gemini SDK
+
+指定git版本时用 git archive 取出该版本的backend目录做同样的测量，对比前后差异。
+
+用法: python startup_benchmark.py [runs] [git_ref]
+"""
+import json
+import os
+import subprocess
+import sys
+import tempfile
+from statistics import median
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+RESULT_PREFIX = 'STARTUP_BENCHMARK '
+
+# 在子进程中执行的测量代码（argv[1]为backend目录）
+MEASURE_SCRIPT = r'''
+import json, os, sys, time
+
+def memory_kb(fields, path):
+    values = {}
+    try:
+        with open(path) as f:
+            for line in f:
+                name, _, rest = line.partition(':')
+                if name in fields:
+                    values[name] = int(rest.split()[0])
+    except OSError:
+        pass
+    return values
+
+sys.path.insert(0, sys.argv[1])
+started = time.perf_counter()
+import app
+import_seconds = time.perf_counter() - started
+
+prepare_seconds = None
+if hasattr(app, 'prepare_database'):
+    started = time.perf_counter()
+    app.prepare_database()
+    prepare_seconds = time.perf_counter() - started
+
+rss_kb = memory_kb(('VmRSS',), '/proc/self/status').get('VmRSS')
+if rss_kb is None:
+    import resource
+    rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+worker_private_kb = None
+if hasattr(os, 'fork') and os.path.exists('/proc/self/smaps_rollup'):
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        if hasattr(app, 'init_worker'):
+            app.init_worker()
+        with app.app.test_client() as client:
+            client.get('/health')
+        values = memory_kb(('Private_Clean', 'Private_Dirty'), '/proc/self/smaps_rollup')
+        os.write(write_fd, str(sum(values.values())).encode())
+        os._exit(0)
+    os.close(write_fd)
+    with os.fdopen(read_fd) as pipe:
+        output = pipe.read()
+    os.waitpid(pid, 0)
+    worker_private_kb = int(output) if output else None
+
+print(%r + json.dumps({
+    'import_seconds': import_seconds,
+    'prepare_seconds': prepare_seconds,
+    'rss_mb': rss_kb / 1024,
+    'worker_private_mb': worker_private_kb / 1024 if worker_private_kb is not None else None,
+    'genai_loaded': 'google.genai' in sys.modules or 'google.generativeai' in sys.modules
+}), flush=True)
+''' % RESULT_PREFIX
+
+
+def measure_once(backend_dir: str) -> dict:
+    """在全新的子进程和临时数据库中测量一次"""
+    with tempfile.TemporaryDirectory(prefix='startup_benchmark') as workdir:
+        env = dict(os.environ)
+        env['DATABASE_URL'] = 'sqlite:///' + os.path.join(workdir, 'benchmark.sqlite3')
+        env.setdefault('GEMINI_API_KEY', 'benchmark')
+        env.pop('REDIS_URL', None)
+        result = subprocess.run([sys.executable, '-c', MEASURE_SCRIPT, backend_dir],
+                                cwd=workdir, env=env, capture_output=True, text=True)
+    for line in result.stdout.splitlines():
+        if line.startswith(RESULT_PREFIX):
+            return json.loads(line[len(RESULT_PREFIX):])
+    raise RuntimeError(f"Benchmark process failed:\n{result.stderr[-2000:]}")
+
+
+def measure(backend_dir: str, runs: int) -> dict:
+    """多次测量，数值取中位数"""
+    samples = [measure_once(backend_dir) for _ in range(runs)]
+    summary = {'genai_loaded': samples[-1]['genai_loaded']}
+    for name in ('import_seconds', 'prepare_seconds', 'rss_mb', 'worker_private_mb'):
+        values = [sample[name] for sample in samples if sample[name] is not None]
+        summary[name] = median(values) if values else None
+    return summary
+
+
+def export_backend(ref: str, target: str) -> str:
+    """用git archive取出指定版本的backend目录"""
+    root = subprocess.run(['git', 'rev-parse', '--show-toplevel'], cwd=BACKEND_DIR,
+                          capture_output=True, text=True, check=True).stdout.strip()
+    prefix = os.path.relpath(BACKEND_DIR, root)
+    archive = subprocess.run(['git', 'archive', '--format=tar', ref, prefix], cwd=root,
+                             capture_output=True, check=True).stdout
+    subprocess.run(['tar', '-x', '-C', target], input=archive, check=True)
+    return os.path.join(target, prefix)
+
+
+def print_report(results: dict):
+    def fmt(value, unit, digits=2):
+        return f"{value:.{digits}f}{unit}" if value is not None else '-'
+
+    print(f"{'':<12}{'import':>10}{'prepare_db':>12}{'rss':>10}{'worker':>10}  gemini sdk")
+    for label, summary in results.items():
+        print(f"{label:<12}"
+              f"{fmt(summary['import_seconds'], 's'):>10}"
+              f"{fmt(summary['prepare_seconds'], 's'):>12}"
+              f"{fmt(summary['rss_mb'], 'MB', 1):>10}"
+              f"{fmt(summary['worker_private_mb'], 'MB', 1):>10}"
+              f"  {'loaded' if summary['genai_loaded'] else 'lazy'}")
+    print("worker = private memory of a worker forked from the imported app (preload)")
+
+
+if __name__ == '__main__':
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    baseline_ref = sys.argv[2] if len(sys.argv) > 2 else None
+
+    results = {}
+    if baseline_ref:
+        with tempfile.TemporaryDirectory(prefix='startup_baseline') as target:
+            results[baseline_ref] = measure(export_backend(baseline_ref, target), runs)
+    results['current'] = measure(BACKEND_DIR, runs)
+    print(f"Worker cold start (median of {runs} runs):")
+    print_report(results)
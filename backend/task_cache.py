@@ -0,0 +1,208 @@
+# task_cache.py
+"""
+任务状态和任务列表的读穿透缓存
+
+轮询 /api/task-status 和 /api/tasks 的请求大多读到没有变化的数据，
+这里把序列化好的JSON缓存起来，多个gunicorn worker通过Redis共享：
+- 单个任务：task:<id>:<版本>，版本记录在 task:<id>:v 中，任务写入时（任务变更通知）换成新的随机版本；
+  读取数据库之前先取版本，写缓存时使用读取前的版本，读库期间发生的写入不会让旧数据被后续请求读到
+- 任务列表：tasks:<代数>:<查询参数>，任何任务写入时代数加一，旧的列表缓存自然失效
+- 所有条目都有TTL，通知丢失或集合删除（不触发通知）时最多读到TTL时长的旧数据
+
+Redis不可用（未安装、未配置或连接失败）时退回进程内缓存，之后定期重试Redis。
+"""
+import os
+import threading
+import uuid
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+from log_config import get_logger
+
+try:
+    import redis
+except ImportError:  # 可选依赖
+    redis = None
+
+logger = get_logger('task_cache')
+
+REDIS_URL = os.getenv('REDIS_URL', '')
+TASK_CACHE_TTL = int(os.getenv('TASK_CACHE_TTL', 30))
+TASK_LIST_CACHE_TTL = int(os.getenv('TASK_LIST_CACHE_TTL', 10))
+MEMORY_CACHE_MAX_ENTRIES = int(os.getenv('TASK_CACHE_MAX_ENTRIES', 5000))
+TASK_VERSION_TTL = 24 * 3600  # 版本过期后重新生成，旧版本的缓存条目随之失效
+REDIS_RETRY_SECONDS = 30
+KEY_PREFIX = 'tunemap:'
+GENERATION_KEY = 'tasks:generation'
+
+
+class MemoryStore:
+    """进程内的TTL + LRU存储（也可在测试中代替Redis）"""
+    backend = 'memory'
+
+    def __init__(self, max_entries: int = MEMORY_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._data: OrderedDict = OrderedDict()  # key -> (过期时间, 值)
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            if entry[0] <= time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return entry[1]
+
+    def _store(self, key: str, expires_at: float, value: str):
+        self._data[key] = (expires_at, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_entries:
+            self._data.popitem(last=False)
+
+    def set(self, key: str, value: str, ttl: int):
+        with self._lock:
+            self._store(key, time.monotonic() + ttl, value)
+
+    def add(self, key: str, value: str, ttl: int) -> bool:
+        """键不存在（或已过期）时写入，返回是否写入"""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                return False
+            self._store(key, time.monotonic() + ttl, value)
+            return True
+
+    def delete(self, key: str):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def incr(self, key: str) -> int:
+        with self._lock:
+            expires_at, value = self._data.get(key, (float('inf'), '0'))
+            value = str(int(value) + 1)
+            self._store(key, expires_at, value)
+            return int(value)
+
+
+class RedisStore:
+    """Redis存储；client 可以是 redis.Redis 或接口相同的替身"""
+    backend = 'redis'
+
+    def __init__(self, client):
+        self.client = client
+
+    def get(self, key: str) -> Optional[str]:
+        value = self.client.get(KEY_PREFIX + key)
+        return value.decode('utf-8') if isinstance(value, bytes) else value
+
+    def set(self, key: str, value: str, ttl: int):
+        self.client.set(KEY_PREFIX + key, value, ex=ttl)
+
+    def add(self, key: str, value: str, ttl: int) -> bool:
+        return bool(self.client.set(KEY_PREFIX + key, value, ex=ttl, nx=True))
+
+    def delete(self, key: str):
+        self.client.delete(KEY_PREFIX + key)
+
+    def incr(self, key: str) -> int:
+        return int(self.client.incr(KEY_PREFIX + key))
+
+
+class TaskCache:
+    """任务JSON的读穿透缓存，主存储出错时退回进程内存储"""
+
+    def __init__(self, store=None, task_ttl: int = TASK_CACHE_TTL, list_ttl: int = TASK_LIST_CACHE_TTL):
+        self.primary = store
+        self.fallback = MemoryStore()
+        self.task_ttl = task_ttl
+        self.list_ttl = list_ttl
+        self._primary_down_until = 0.0
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+
+    def _call(self, method: str, *args):
+        """调用主存储，失败后一段时间内改用进程内存储"""
+        if self.primary is not None and time.monotonic() >= self._primary_down_until:
+            try:
+                return getattr(self.primary, method)(*args)
+            except Exception as e:
+                self.errors += 1
+                self._primary_down_until = time.monotonic() + REDIS_RETRY_SECONDS
+                logger.warning("Task cache store unavailable, using in-process cache: %s", e,
+                               extra={'sample_key': 'task_cache:down'})
+        return getattr(self.fallback, method)(*args)
+
+    @property
+    def backend(self) -> str:
+        if self.primary is not None and time.monotonic() >= self._primary_down_until:
+            return self.primary.backend
+        return self.fallback.backend
+
+    def _get(self, key: str) -> Optional[str]:
+        value = self._call('get', key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    # 单个任务
+    def task_version(self, task_id: str) -> str:
+        """任务缓存的当前版本，没有时生成一个；需要在读取数据库之前获取"""
+        key = f'task:{task_id}:v'
+        version = self._call('get', key)
+        if version is None:
+            version = uuid.uuid4().hex
+            if not self._call('add', key, version, TASK_VERSION_TTL):
+                # 并发请求已生成了版本
+                version = self._call('get', key) or version
+        return version
+
+    def get_task(self, task_id: str, version: str) -> Optional[str]:
+        return self._get(f'task:{task_id}:{version}')
+
+    def set_task(self, task_id: str, version: str, payload: str):
+        """以读取数据库之前取得的版本写入；期间任务有写入时版本已变，这份数据不会再被读到"""
+        self._call('set', f'task:{task_id}:{version}', payload, self.task_ttl)
+
+    # 任务列表
+    def list_key(self, **params) -> str:
+        generation = self._call('get', GENERATION_KEY) or '0'
+        query = ':'.join(f'{name}={params[name] if params[name] is not None else ""}' for name in sorted(params))
+        return f'tasks:{generation}:{query}'
+
+    def get_list(self, key: str) -> Optional[str]:
+        return self._get(key)
+
+    def set_list(self, key: str, payload: str):
+        self._call('set', key, payload, self.list_ttl)
+
+    def invalidate(self, task_id: str):
+        """任务写入后换成新的版本，并让所有列表缓存失效"""
+        self._call('set', f'task:{task_id}:v', uuid.uuid4().hex, TASK_VERSION_TTL)
+        self._call('incr', GENERATION_KEY)
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            'backend': self.backend,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / total, 3) if total else 0.0,
+            'errors': self.errors
+        }
+
+
+def create_task_cache(url: str = REDIS_URL) -> TaskCache:
+    """配置了REDIS_URL且安装了redis时使用Redis，否则只用进程内缓存"""
+    if url and redis is not None:
+        client = redis.Redis.from_url(url, socket_timeout=0.5, socket_connect_timeout=0.5)
+        return TaskCache(RedisStore(client))
+    if url:
+        logger.warning("REDIS_URL is set but the redis package is not installed, using in-process task cache")
+    return TaskCache()
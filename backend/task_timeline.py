@@ -0,0 +1,90 @@
+# task_timeline.py
+"""
+任务阶段时间线
+
+每个任务用一个紧凑的JSON数组记录各阶段发生的时间：
+[["queued", 0], ["images_loaded", 812], ["analysis_returned", 9453], ...]
+第二个值是相对任务创建时间的毫秒偏移，同一个阶段只记录第一次出现的时间。
+"""
+import json
+import math
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Optional
+
+
+def load_events(timeline: Optional[str]) -> List[list]:
+    """解析时间线JSON，无效时返回空列表"""
+    if not timeline:
+        return []
+    try:
+        events = json.loads(timeline)
+    except ValueError:
+        return []
+    return events if isinstance(events, list) else []
+
+
+def append_event(timeline: Optional[str], stage: str, created_at: datetime,
+                 now: Optional[datetime] = None) -> str:
+    """追加一个阶段事件，返回新的时间线JSON（阶段已存在时保持不变）"""
+    events = load_events(timeline)
+    if any(event[0] == stage for event in events):
+        return timeline
+
+    now = now or datetime.utcnow()
+    offset_ms = max(0, int((now - created_at).total_seconds() * 1000))
+    events.append([stage, offset_ms])
+    return json.dumps(events, separators=(',', ':'))
+
+
+def expand(timeline: Optional[str], created_at: datetime) -> List[Dict]:
+    """展开为带绝对时间和阶段耗时的事件列表（用于接口返回）"""
+    result = []
+    previous_offset = 0
+    for stage, offset_ms in load_events(timeline):
+        result.append({
+            'stage': stage,
+            'at': (created_at + timedelta(milliseconds=offset_ms)).isoformat(),
+            'offset_ms': offset_ms,
+            'duration_ms': offset_ms - previous_offset
+        })
+        previous_offset = offset_ms
+    return result
+
+
+def percentile(values: List[float], p: float) -> Optional[float]:
+    """最近秩法计算百分位数"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, math.ceil(p / 100 * len(ordered)))
+    return ordered[rank - 1]
+
+
+def summarize(timelines: Iterable[Optional[str]]) -> Dict[str, Dict]:
+    """汇总多条时间线，计算每个阶段耗时和相对创建时间偏移的p50/p95"""
+    durations = {}
+    offsets = {}
+    order = []
+    for timeline in timelines:
+        previous_offset = 0
+        for stage, offset_ms in load_events(timeline):
+            if stage not in durations:
+                durations[stage] = []
+                offsets[stage] = []
+                order.append(stage)
+            durations[stage].append(offset_ms - previous_offset)
+            offsets[stage].append(offset_ms)
+            previous_offset = offset_ms
+
+    # 按各阶段典型出现时间排序，便于阅读
+    order.sort(key=lambda stage: percentile(offsets[stage], 50))
+    return {
+        stage: {
+            'count': len(durations[stage]),
+            'p50_ms': percentile(durations[stage], 50),
+            'p95_ms': percentile(durations[stage], 95),
+            'offset_p50_ms': percentile(offsets[stage], 50),
+            'offset_p95_ms': percentile(offsets[stage], 95)
+        }
+        for stage in order
+    }
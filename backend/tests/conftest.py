@@ -0,0 +1,6 @@
+# conftest.py
+import os
+import sys
+
+# 测试直接导入backend目录下的模块
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,45 @@
+# test_admission.py
+import admission
+from admission import StageEstimates
+
+ESTIMATES = StageEstimates(processing_seconds=30.0, completion_seconds=120.0, suno_seconds=90.0, samples=10)
+
+
+def evaluate(**overrides):
+    params = dict(queued=0, running=0, lane_limit=4, max_queued=10, suno_in_flight=0)
+    params.update(overrides)
+    return admission.evaluate(ESTIMATES, **params)
+
+
+def test_admits_idle_lane_without_wait():
+    decision = evaluate()
+    assert decision.admitted
+    assert decision.estimated_wait_seconds == 0.0
+    assert decision.estimated_completion_seconds == 120.0
+
+
+def test_rejects_full_queue_with_retry_after():
+    decision = evaluate(queued=10, running=4)
+    assert not decision.admitted
+    assert decision.reason == 'queue_full'
+    assert decision.retry_after >= 1
+
+
+def test_open_breaker_rejects_when_failing_fast():
+    decision = evaluate(upstream_retry_in=42.0)
+    assert not decision.admitted
+    assert decision.reason == 'upstream_unavailable'
+    assert decision.retry_after == 42
+
+
+def test_open_breaker_admits_when_parking():
+    decision = evaluate(upstream_retry_in=42.0, park_upstream=True)
+    assert decision.admitted
+    assert decision.estimated_wait_seconds == 42.0
+    assert decision.estimated_completion_seconds == 162.0
+
+
+def test_parking_still_enforces_queue_limit():
+    decision = evaluate(queued=10, upstream_retry_in=42.0, park_upstream=True)
+    assert not decision.admitted
+    assert decision.reason == 'queue_full'
@@ -0,0 +1,152 @@
+# test_circuit_breaker.py
+import pytest
+
+import circuit_breaker
+from circuit_breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, CircuitOpenError
+
+
+class FakeClock:
+    """替换circuit_breaker模块中的time，手动推进单调时钟"""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeClock()
+    monkeypatch.setattr(circuit_breaker, 'time', fake)
+    return fake
+
+
+def make_breaker(**options):
+    settings = dict(slow_call_seconds=5, window_size=10, min_calls=4, failure_rate=0.5,
+                    slow_call_rate=0.75, open_seconds=60, half_open_probes=2)
+    settings.update(options)
+    return CircuitBreaker('suno', **settings)
+
+
+def open_breaker(breaker):
+    for _ in range(breaker.min_calls):
+        assert breaker.allow()
+        breaker.record(False, 0.1)
+    assert breaker.state == OPEN
+
+
+def test_opens_on_failure_rate(clock):
+    breaker = make_breaker()
+    for success in (True, False, True):
+        breaker.record(success, 0.1)
+    # 调用次数不足min_calls时不判断
+    assert breaker.state == CLOSED
+    breaker.record(False, 0.1)
+    assert breaker.state == OPEN
+    assert not breaker.allow()
+    assert breaker.rejected == 1
+
+
+def test_opens_on_slow_call_rate(clock):
+    breaker = make_breaker()
+    breaker.record(True, 0.1)
+    for _ in range(3):
+        breaker.record(True, 6)
+    assert breaker.state == OPEN
+    assert breaker.times_opened == 1
+
+
+def test_stays_closed_below_thresholds(clock):
+    breaker = make_breaker()
+    for success in (True, True, True, False, True, True):
+        breaker.record(success, 0.1)
+    assert breaker.state == CLOSED
+
+
+def test_half_open_after_open_seconds(clock):
+    breaker = make_breaker()
+    open_breaker(breaker)
+    clock.advance(30)
+    assert breaker.state == OPEN
+    assert breaker.retry_in() == pytest.approx(30)
+    clock.advance(30)
+    assert breaker.state == HALF_OPEN
+    assert breaker.retry_in() == 0.0
+
+
+def test_successful_probes_close_the_breaker(clock):
+    breaker = make_breaker()
+    open_breaker(breaker)
+    clock.advance(60)
+
+    assert breaker.allow() and breaker.allow()
+    # 探测名额用完后拒绝其他调用
+    assert not breaker.allow()
+    breaker.record(True, 0.1)
+    assert breaker.state == HALF_OPEN
+    breaker.record(True, 0.1)
+    assert breaker.state == CLOSED
+    assert breaker.snapshot()['window_calls'] == 0
+
+
+def test_failed_or_slow_probe_reopens(clock):
+    breaker = make_breaker()
+    open_breaker(breaker)
+    clock.advance(60)
+    assert breaker.allow()
+    breaker.record(False, 0.1)
+    assert breaker.state == OPEN
+
+    clock.advance(60)
+    assert breaker.allow()
+    breaker.record(True, 6)
+    assert breaker.state == OPEN
+    assert breaker.times_opened == 3
+
+
+def test_leaked_probe_is_released_after_probe_timeout(clock):
+    breaker = make_breaker()
+    open_breaker(breaker)
+    clock.advance(60)
+
+    # 调用方占用探测名额后没有记录结果（例如在发出请求前抛出了异常）
+    assert breaker.allow() and breaker.allow()
+    assert not breaker.allow()
+    clock.advance(4)
+    assert not breaker.allow()
+    clock.advance(1)
+    assert breaker.allow()
+    breaker.record(True, 0.1)
+    assert breaker.allow()
+    breaker.record(True, 0.1)
+    assert breaker.state == CLOSED
+
+
+def test_guard_records_results(clock):
+    breaker = make_breaker(min_calls=2)
+    for _ in range(2):
+        with pytest.raises(ValueError):
+            with breaker.guard():
+                raise ValueError('upstream error')
+    assert breaker.state == OPEN
+    with pytest.raises(CircuitOpenError) as excinfo:
+        with breaker.guard():
+            pass
+    assert excinfo.value.retry_in == pytest.approx(60)
+
+    clock.advance(60)
+    for _ in range(2):
+        with breaker.guard():
+            clock.advance(0.1)
+    assert breaker.state == CLOSED
+
+
+def test_get_breaker_returns_shared_instance():
+    breaker = circuit_breaker.get_breaker('test-shared', slow_call_seconds=3)
+    assert circuit_breaker.get_breaker('test-shared') is breaker
+    assert breaker.slow_call_seconds == 3
+    assert 'test-shared' in circuit_breaker.snapshot_all()
@@ -0,0 +1,89 @@
+# test_compressed_text.py
+import json
+
+import pytest
+from sqlalchemy import Column, Integer, MetaData, Table, Text, cast, create_engine, insert, select
+from sqlalchemy.orm import Session
+
+import compressed_text
+from compressed_text import COMPRESSED_PREFIX, CompressedText, column_space, compress_column
+
+LARGE_TEXT = json.dumps({'data': [{'id': index, 'title': '海边的晚风', 'tags': 'ambient, piano'}
+                                  for index in range(200)]}, ensure_ascii=False)
+
+
+@pytest.fixture
+def table():
+    engine = create_engine('sqlite://')
+    metadata = MetaData()
+    payloads = Table(
+        'payloads', metadata,
+        Column('id', Integer, primary_key=True),
+        Column('body', CompressedText, nullable=True)
+    )
+    metadata.create_all(engine)
+    with Session(engine) as session:
+        yield session, payloads
+
+
+def stored(session, payloads, row_id):
+    """绕过类型转换读取数据库中实际保存的文本"""
+    return session.execute(
+        select(cast(payloads.c.body, Text)).where(payloads.c.id == row_id)
+    ).scalar()
+
+
+@pytest.mark.parametrize('value', [None, '', 'short', LARGE_TEXT])
+def test_roundtrip(table, value):
+    session, payloads = table
+    session.execute(insert(payloads).values(id=1, body=value))
+    assert session.execute(select(payloads.c.body)).scalar() == value
+
+
+def test_large_text_is_stored_compressed(table):
+    session, payloads = table
+    session.execute(insert(payloads).values(id=1, body=LARGE_TEXT))
+    raw = stored(session, payloads, 1)
+    assert raw.startswith(COMPRESSED_PREFIX)
+    assert len(raw) < len(LARGE_TEXT.encode('utf-8'))
+
+
+def test_small_text_is_stored_as_is(table):
+    session, payloads = table
+    session.execute(insert(payloads).values(id=1, body='{"code": 200}'))
+    assert stored(session, payloads, 1) == '{"code": 200}'
+
+
+def test_reads_uncompressed_legacy_rows(table):
+    session, payloads = table
+    # 引入压缩之前写入的数据：直接以原文保存在Text列中
+    legacy = Table('payloads', MetaData(), Column('id', Integer, primary_key=True), Column('body', Text))
+    session.execute(insert(legacy).values(id=1, body=LARGE_TEXT))
+    assert stored(session, payloads, 1) == LARGE_TEXT
+    assert session.execute(select(payloads.c.body)).scalar() == LARGE_TEXT
+
+
+def test_compress_column_backfills_legacy_rows(table):
+    session, payloads = table
+    legacy = Table('payloads', MetaData(), Column('id', Integer, primary_key=True), Column('body', Text))
+    session.execute(insert(legacy), [{'id': 1, 'body': LARGE_TEXT}, {'id': 2, 'body': 'tiny'},
+                                     {'id': 3, 'body': None}])
+    session.commit()
+
+    summary = compress_column(session, payloads.c.body, payloads.c.id, batch_size=1)
+    assert summary['compressed'] == 1
+    assert stored(session, payloads, 1).startswith(COMPRESSED_PREFIX)
+    assert stored(session, payloads, 2) == 'tiny'
+    assert session.execute(select(payloads.c.body).order_by(payloads.c.id)).scalars().all() == \
+        [LARGE_TEXT, 'tiny', None]
+
+    report = column_space(session, payloads.c.body)
+    assert report['compressed_rows'] == 1
+    assert report['logical_bytes'] == len(LARGE_TEXT.encode('utf-8')) + len('tiny')
+
+
+def test_incompressible_text_is_kept(monkeypatch):
+    monkeypatch.setattr(compressed_text, 'COMPRESS_MIN_BYTES', 1)
+    value = 'x'
+    assert compressed_text.compress(value) == value
+    assert compressed_text.decompress(value) == value
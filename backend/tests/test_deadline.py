@@ -0,0 +1,66 @@
+# test_deadline.py
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import deadline
+from deadline import DeadlineExceeded, call_with_deadline
+
+
+@pytest.fixture
+def single_worker(monkeypatch):
+    executor = ThreadPoolExecutor(max_workers=1)
+    monkeypatch.setattr(deadline, '_executor', executor)
+    yield executor
+    executor.shutdown(wait=True)
+
+
+def occupy(executor, seconds):
+    """占用唯一的线程一段时间"""
+    started = threading.Event()
+
+    def block():
+        started.set()
+        time.sleep(seconds)
+
+    executor.submit(block)
+    started.wait(1)
+
+
+def test_returns_result_within_budget(single_worker):
+    assert call_with_deadline('description', lambda: 'ok', timeout=1) == 'ok'
+
+
+def test_raises_when_call_runs_past_budget(single_worker):
+    with pytest.raises(DeadlineExceeded):
+        call_with_deadline('description', lambda: time.sleep(0.5), timeout=0.1)
+
+
+def test_queue_time_does_not_count_against_budget(single_worker):
+    occupy(single_worker, 0.3)
+
+    def call():
+        time.sleep(0.3)
+        return 'ok'
+
+    # 排队0.3秒加执行0.3秒超过0.5秒，但调用本身在预算之内
+    assert call_with_deadline('description', call, timeout=0.5) == 'ok'
+
+
+def test_gives_up_when_call_never_starts(single_worker):
+    occupy(single_worker, 0.5)
+    calls = []
+    with pytest.raises(DeadlineExceeded):
+        call_with_deadline('description', lambda: calls.append(1), timeout=0.1)
+    time.sleep(0.5)
+    assert calls == []
+
+
+def test_propagates_upstream_errors(single_worker):
+    def call():
+        raise ValueError('bad request')
+
+    with pytest.raises(ValueError):
+        call_with_deadline('description', call, timeout=1)
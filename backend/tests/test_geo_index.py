@@ -0,0 +1,41 @@
+# test_geo_index.py
+import random
+
+import geo_index
+
+
+def in_range(value, low, high):
+    return value >= low and (high is None or value < high)
+
+
+def test_prefix_range_increments_last_character():
+    assert geo_index.prefix_range('wx4g') == ('wx4g', 'wx4h')
+    assert geo_index.prefix_range('wx49') == ('wx49', 'wx4b')
+
+
+def test_prefix_range_carries_over_z():
+    assert geo_index.prefix_range('wx4z') == ('wx4z', 'wx5')
+    assert geo_index.prefix_range('wzz') == ('wzz', 'x')
+    assert geo_index.prefix_range('zz') == ('zz', None)
+
+
+def test_prefix_range_bounds_use_geohash_alphabet_only():
+    for prefix in ('0', 'b', 'wx4g0', 'yzzz'):
+        low, high = geo_index.prefix_range(prefix)
+        assert set(low + (high or '')) <= set(geo_index.GEOHASH_BASE32)
+
+
+def test_prefix_range_matches_exactly_the_prefixed_cells():
+    rng = random.Random(7)
+    prefix = geo_index.encode(39.9, 116.4, 5)
+    low, high = geo_index.prefix_range(prefix)
+    for _ in range(2000):
+        cell = ''.join(rng.choice(geo_index.GEOHASH_BASE32) for _ in range(geo_index.GEOHASH_PRECISION))
+        cell = prefix[:rng.randint(0, len(prefix))] + cell[:geo_index.GEOHASH_PRECISION]
+        assert in_range(cell, low, high) == cell.startswith(prefix)
+
+
+def test_cover_cells_contain_nearby_point():
+    center = geo_index.encode(39.9, 116.4)
+    cells = geo_index.cover_cells(39.9, 116.4, 150)
+    assert any(center.startswith(cell) for cell in cells)
@@ -0,0 +1,141 @@
+# test_scheduler.py
+import os
+import subprocess
+import threading
+import time
+
+import pytest
+
+import scheduler
+from scheduler import BATCH, INTERACTIVE, FairScheduler
+
+
+class Recorder:
+    """记录处理顺序和并发数的处理函数；gate打开前所有任务阻塞"""
+
+    def __init__(self, hold: float = 0.0):
+        self.gate = threading.Event()
+        self.hold = hold
+        self.order = []
+        self.running = {}
+        self.peak = {}
+        self.lock = threading.Lock()
+
+    def __call__(self, key, group=None):
+        self.gate.wait(5)
+        with self.lock:
+            self.order.append(key)
+            self.running[group] = self.running.get(group, 0) + 1
+            self.peak[group] = max(self.peak.get(group, 0), self.running[group])
+        time.sleep(self.hold)
+        with self.lock:
+            self.running[group] -= 1
+
+
+def wait_for(scheduler_, count, timeout=5):
+    deadline = time.monotonic() + timeout
+    while scheduler_.dispatched < count or scheduler_.snapshot()['lanes'][INTERACTIVE]['running'] \
+            or scheduler_.snapshot()['lanes'][BATCH]['running']:
+        if time.monotonic() > deadline:
+            pytest.fail('scheduler did not drain')
+        time.sleep(0.01)
+
+
+def test_users_share_the_lane_fairly():
+    handler = Recorder()
+    s = FairScheduler(handler, workers=1, lane_limits={INTERACTIVE: 1, BATCH: 1})
+    s.submit('block')
+    for index in range(4):
+        s.submit(f'A{index}', user_id='A')
+    for index in range(2):
+        s.submit(f'B{index}', user_id='B')
+    handler.gate.set()
+    wait_for(s, 7)
+
+    assert handler.order[0] == 'block'
+    # 提交大量任务的用户A不会让B排到最后
+    assert handler.order[1:5] == ['A0', 'B0', 'A1', 'B1']
+    assert handler.order[5:] == ['A2', 'A3']
+
+
+def test_interactive_lane_outweighs_batch_lane():
+    handler = Recorder()
+    s = FairScheduler(handler, workers=1, lane_weights={INTERACTIVE: 4, BATCH: 1},
+                      lane_limits={INTERACTIVE: 1, BATCH: 1})
+    s.submit('block')
+    for index in range(4):
+        s.submit(f'bat{index}', user_id='C', lane=BATCH)
+    for index in range(4):
+        s.submit(f'A{index}', user_id='A')
+    handler.gate.set()
+    wait_for(s, 9)
+
+    first_batch = handler.order.index('bat1')
+    assert all(handler.order.index(f'A{index}') < first_batch for index in range(4))
+
+
+def test_per_user_cap_limits_concurrency():
+    handler = Recorder(hold=0.05)
+    handler.gate.set()
+    s = FairScheduler(handler, workers=6, max_per_user=2, lane_limits={INTERACTIVE: 6, BATCH: 6})
+    for index in range(8):
+        s.submit(f'A{index}', 'A', user_id='A')
+    for index in range(4):
+        s.submit(f'anon{index}', 'anon')
+    wait_for(s, 12)
+
+    assert handler.peak['A'] == 2
+    # 匿名任务各自成一条队列，不受每用户上限限制
+    assert handler.peak['anon'] > 2
+
+
+def test_batch_lane_limit_leaves_threads_for_interactive():
+    handler = Recorder()
+    s = FairScheduler(handler, workers=4, lane_limits={INTERACTIVE: 4, BATCH: 2})
+    for index in range(6):
+        s.submit(f'bat{index}', BATCH, lane=BATCH)
+    time.sleep(0.1)
+    lanes = s.snapshot()['lanes']
+    assert lanes[BATCH]['running'] == 2
+    assert lanes[BATCH]['queued'] == 4
+
+    s.submit('live', INTERACTIVE)
+    time.sleep(0.1)
+    assert s.snapshot()['lanes'][INTERACTIVE]['running'] == 1
+    handler.gate.set()
+    wait_for(s, 7)
+    assert handler.peak[BATCH] == 2
+
+
+def test_unknown_lane_falls_back_to_interactive():
+    handler = Recorder()
+    s = FairScheduler(handler, workers=1)
+    job = s.submit('x', lane='bulk')
+    assert job.lane == INTERACTIVE
+    handler.gate.set()
+    wait_for(s, 1)
+
+
+def test_failing_handler_releases_its_slot():
+    calls = []
+
+    def handler(key):
+        calls.append(key)
+        raise RuntimeError('boom')
+
+    s = FairScheduler(handler, workers=1, max_per_user=1)
+    s.submit('first', user_id='u')
+    s.submit('second', user_id='u')
+    wait_for(s, 2)
+    assert calls == ['first', 'second']
+
+
+def test_process_identity_tracks_liveness():
+    identity = scheduler.process_identity()
+    assert identity.rsplit(':', 2)[1] == str(os.getpid())
+    assert scheduler.process_alive(identity) is True
+
+    child = subprocess.Popen(['true'])
+    child.wait()
+    assert scheduler.process_alive(scheduler.process_identity(child.pid)) is False
+    assert scheduler.process_alive('another-host:1:1') is None
@@ -0,0 +1,154 @@
+# test_task_cache.py
+import time
+
+import pytest
+
+import task_cache
+from task_cache import MemoryStore, RedisStore, TaskCache
+
+
+class FakeRedis:
+    """实现RedisStore用到的命令的内存替身"""
+
+    def __init__(self):
+        self.data = {}
+        self.fail = False
+
+    def _check(self):
+        if self.fail:
+            raise ConnectionError('redis is down')
+
+    def get(self, key):
+        self._check()
+        entry = self.data.get(key)
+        if entry is None or entry[0] <= time.monotonic():
+            return None
+        return entry[1].encode('utf-8')
+
+    def set(self, key, value, ex=None, nx=False):
+        self._check()
+        if nx and self.get(key) is not None:
+            return None
+        self.data[key] = (time.monotonic() + ex if ex else float('inf'), str(value))
+        return True
+
+    def delete(self, key):
+        self._check()
+        self.data.pop(key, None)
+
+    def incr(self, key):
+        self._check()
+        expires_at, value = self.data.get(key, (float('inf'), '0'))
+        self.data[key] = (expires_at, str(int(value) + 1))
+        return int(value) + 1
+
+
+@pytest.fixture(params=['memory', 'redis'])
+def cache(request):
+    if request.param == 'memory':
+        return TaskCache()
+    return TaskCache(RedisStore(FakeRedis()))
+
+
+def test_memory_store_expires_entries():
+    store = MemoryStore()
+    store.set('a', '1', ttl=0)
+    store.set('b', '2', ttl=60)
+    assert store.get('a') is None
+    assert store.get('b') == '2'
+
+
+def test_memory_store_evicts_least_recently_used():
+    store = MemoryStore(max_entries=2)
+    store.set('a', '1', 60)
+    store.set('b', '2', 60)
+    store.get('a')
+    store.set('c', '3', 60)
+    assert store.get('b') is None
+    assert store.get('a') == '1'
+    assert store.get('c') == '3'
+
+
+def test_memory_store_add_only_when_absent():
+    store = MemoryStore()
+    assert store.add('k', 'first', 60)
+    assert not store.add('k', 'second', 60)
+    assert store.get('k') == 'first'
+
+
+def test_redis_store_prefixes_keys_and_decodes_values():
+    client = FakeRedis()
+    store = RedisStore(client)
+    store.set('task:1', 'payload', 30)
+    assert store.get('task:1') == 'payload'
+    assert task_cache.KEY_PREFIX + 'task:1' in client.data
+    assert store.add('v', 'x', 30) and not store.add('v', 'y', 30)
+    assert store.incr('gen') == 1
+
+
+def test_task_roundtrip_and_stats(cache):
+    version = cache.task_version('t1')
+    assert cache.get_task('t1', version) is None
+    cache.set_task('t1', version, '{"status":"pending"}')
+    assert cache.task_version('t1') == version
+    assert cache.get_task('t1', version) == '{"status":"pending"}'
+    assert cache.stats()['hits'] == 1
+    assert cache.stats()['misses'] == 1
+
+
+def test_invalidate_hides_cached_task(cache):
+    version = cache.task_version('t1')
+    cache.set_task('t1', version, 'old')
+    cache.invalidate('t1')
+    assert cache.get_task('t1', cache.task_version('t1')) is None
+
+
+def test_write_back_after_concurrent_invalidation_is_not_served(cache):
+    # 请求A读取版本和数据库，期间后台任务提交并发出失效通知，A随后写回旧数据
+    version = cache.task_version('t1')
+    cache.invalidate('t1')
+    cache.set_task('t1', version, '{"status":"generating"}')
+
+    current = cache.task_version('t1')
+    assert current != version
+    assert cache.get_task('t1', current) is None
+
+
+def test_list_keys_change_after_any_task_write(cache):
+    key = cache.list_key(user_id='u', status=None, limit=50, offset=0)
+    cache.set_list(key, '[]')
+    assert cache.get_list(key) == '[]'
+    cache.invalidate('t2')
+    new_key = cache.list_key(user_id='u', status=None, limit=50, offset=0)
+    assert new_key != key
+    assert cache.get_list(new_key) is None
+
+
+def test_falls_back_to_memory_when_redis_fails():
+    client = FakeRedis()
+    cache = TaskCache(RedisStore(client))
+    assert cache.backend == 'redis'
+
+    client.fail = True
+    version = cache.task_version('t1')
+    cache.set_task('t1', version, 'payload')
+    assert cache.backend == 'memory'
+    assert cache.get_task('t1', version) == 'payload'
+    assert cache.stats()['errors'] == 1
+
+
+def test_retries_redis_after_backoff(monkeypatch):
+    client = FakeRedis()
+    cache = TaskCache(RedisStore(client))
+    client.fail = True
+    cache.task_version('t1')
+    assert cache.backend == 'memory'
+
+    client.fail = False
+    monkeypatch.setattr(task_cache, 'REDIS_RETRY_SECONDS', 0)
+    cache._primary_down_until = 0.0
+    assert cache.backend == 'redis'
+
+
+def test_create_task_cache_without_url_uses_memory():
+    assert task_cache.create_task_cache('').backend == 'memory'
@@ -769,8 +769,10 @@ const handleGenerateMusic = async () => {
     if (finalResult.status === TASK_STATUS.COMPLETED) {
       let audioUrl;
       
-      // 处理音频URL
-      if (finalResult.music_url) {
+      // 处理音频URL（优先使用后端缓存的音频地址）
+      if (finalResult.audio_url) {
+        audioUrl = `${import.meta.env.VITE_APP_API_URL || ''}${finalResult.audio_url}`;
+      } else if (finalResult.music_url) {
         audioUrl = finalResult.music_url;
       } else if (finalResult.result && finalResult.result.audio_url) {
         audioUrl = finalResult.result.audio_url;
@@ -88,9 +88,13 @@ export const musicApi = {
    * @param {string[]} params.imagePaths - 图片路径数组
    * @param {string} params.location - 位置信息
    * @param {string} params.userId - 用户ID (可选)
+   * @param {number} params.latitude - 纬度 (可选)
+   * @param {number} params.longitude - 经度 (可选)
+   * @param {boolean} params.reuseNearby - 是否复用附近已完成的歌曲 (可选，需要坐标)
+   * @param {number} params.reuseRadius - 复用半径，单位米 (可选)
    * @returns {Promise<Object>} 任务创建结果
    */
-  createMusicTask: async ({ imagePaths, location, userId }) => {
+  createMusicTask: async ({ imagePaths, location, userId, latitude, longitude, reuseNearby, reuseRadius }) => {
     if (!imagePaths || !Array.isArray(imagePaths) || imagePaths.length === 0) {
       throw new Error('图片路径不能为空');
     }
@@ -105,6 +109,10 @@ export const musicApi = {
         image_paths: imagePaths,
         location: location,
         user_id: userId,
+        latitude: latitude,
+        longitude: longitude,
+        reuse_nearby: reuseNearby,
+        reuse_radius: reuseRadius,
       }),
     });
   },
@@ -148,6 +156,17 @@ export const musicApi = {
     });
   },
 
+  /**
+   * 获取上传图片的地址
+   * @param {string} imageUrl - 上传接口返回的 image_urls 中的地址
+   * @param {number} width - 缩略图宽度 (可选，服务端会取最接近的固定尺寸)
+   * @returns {string} 完整的图片地址
+   */
+  getImageUrl: (imageUrl, width) => {
+    const query = width ? `?w=${width}` : '';
+    return `${API_BASE_URL}${imageUrl}${query}`;
+  },
+
   /**
    * 健康检查
    * @returns {Promise<Object>} 健康状态